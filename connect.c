@@ -66,6 +66,9 @@
  *   command line option.
  *
  *   usage:  connect [-dnhst45] [-R resolve] [-p local-port] [-w sec]
+ *                   [-D local-port] [-U socket-path] [-A socket-path]
+ *                   [-F local-port]
+ *                   [-B buffer-size] [-O [local:|remote:]tcp-options]
  *                   [-H [user@]proxy-server[:port]]
  *                   [-S [user@]socks-server[:port]]
  *                   [-T proxy-server[:port]]
@@ -80,11 +83,39 @@
  *   value in the environment variable HTTP_PROXY and pass the -h option
  *   to use it.
  *
+ *   When the http proxy asks for authentication, the request is sent
+ *   again on the same connection if the proxy keeps it. Basic and Digest
+ *   (MD5 and SHA-256, RFC 7616) schemes are supported. The scheme it
+ *   asked, and for Digest the nonce with its count, is remembered in
+ *   ~/.cache/connect/auth (without password) for a day, and later
+ *   connections send credentials with the first request. If they are
+ *   rejected, the new challenge is answered once. Set the parameter
+ *   CONNECT_AUTH_CACHE to "no" not to use the cache.
+ *
  *   The -S option specifys the hostname and port number of the SOCKS
  *   server to relay.  Like -H, port number can be omitted and the default
  *   is 1080. You can also specify this value pair in the environment
  *   variable SOCKS5_SERVER and give the -s option to use it.
  *
+ *   Relay servers can be chained by giving -S, -H and -T more than once
+ *   (ex. "-S hop1 -H hop2:8080 -S hop3"). The program connects to the
+ *   first one, asks it to connect to the second one and so on, and the
+ *   last one is asked to connect to the target host. All is done over
+ *   one connection in one process, instead of chaining programs with
+ *   pipes. The '-4' and '-5' options apply to all SOCKS servers in the
+ *   chain, and passwords are taken from the same variables. Only the
+ *   last server can be given as a list described below.
+ *
+ *   Several servers can be given to -H, -S or the variables above,
+ *   separated by comma (ex. "proxy1:8080,proxy2:8080"). The parameter
+ *   CONNECT_PROXY_STRATEGY decides how they are used: "failover" tries
+ *   them in order (default), "race" negotiates with all of them at once
+ *   and uses the first one ready to relay, and "latency" tries the one
+ *   which got ready fastest before first. A server which failed recently is tried
+ *   after the others for a while, 30 seconds at first and doubled for
+ *   each failure in a row. Timings and failures are kept in
+ *   ~/.cache/connect/proxies, shared by later invocations.
+ *
  *   The '-4' and the '-5' options are for specifying SOCKS relaying and
  *   indicates protocol version to use. It is valid only when used with
  *   '-s' or '-S'. Default is '-5' (protocol version 5)
@@ -103,10 +134,145 @@
  *   The '-P' option is same to '-p' except keep remote session. The
  *   program repeats waiting the port with holding remote session without
  *   disconnecting. To disconnect the remote session, send EOF to stdin or
- *   kill the program.
+ *   kill the program. Data from remote while no client is attached is
+ *   kept and delivered to the next client first, so the remote is not
+ *   stalled. It is kept in memory up to CONNECT_SPILL_MEMORY bytes
+ *   (default 1m), then in a temporary file mapped into memory, up to
+ *   CONNECT_SPILL_SIZE bytes in total (default 64m, 0 to disable).
+ *   Beyond that the remote is left unread until a client comes.
+ *
+ *   The '-D' option is like '-p' but serves many local clients at once
+ *   in one process. Each accepted client gets its own connection to the
+ *   destination, and all sessions are relayed in one event loop. This
+ *   saves starting a new process, reading parameter files and resolving
+ *   names for each connection. The program runs until killed.
+ *
+ *   With '-D', the parameter CONNECT_POOL_SIZE makes the program keep
+ *   that many connections to the relay server open in advance. SOCKS5
+ *   authentication is already done on them, so a new client waits only
+ *   for the CONNECT request. Pooled connections idle for more than
+ *   CONNECT_POOL_IDLE seconds (default 30) are closed and replaced.
+ *   They are opened without blocking other sessions, and if opening
+ *   fails, it is retried after a second, doubled up to a minute.
+ *
+ *   The '-U' option makes a resident process like '-D', listening on a
+ *   Unix domain socket of given path instead of a TCP port. If the
+ *   environment variable CONNECT_RESIDENT is set to the path, the program
+ *   started as usual with host and port (ex. as ProxyCommand of ssh)
+ *   passes its stdin and stdout to the resident and exits at once, and
+ *   the resident makes the connection and relays them through the relay
+ *   server it was started with. If no resident is running, or stdio is a
+ *   terminal, or '-d' or an option choosing relay server or method
+ *   (-s, -h, -t, -n, -S, -H, -T, -c, -4, -5, -a, -R) is given, the
+ *   program works by itself as usual. Other options like '-w', '-B' and
+ *   '-O' given to a launcher are ignored. The resident needs no host
+ *   argument:
+ *
+ *     $ connect -U ~/.connect.sock -S socks.example.com &
+ *     $ export CONNECT_RESIDENT=~/.connect.sock
+ *
+ *   The '-F' option is like '-D' but serves as a local proxy server, so
+ *   the destination is told by each client instead of the command line.
+ *   It listens on the loopback address only, as clients are not
+ *   authenticated.
+ *   SOCKS5 clients without authentication and HTTP clients using
+ *   CONNECT method are accepted on the same port. Each destination is
+ *   connected directly or via the relay server as decided by the rules
+ *   of SOCKS5_DIRECT, HTTP_DIRECT etc., so one setting of them is shared
+ *   by all applications:
+ *
+ *     $ SOCKS5_DIRECT=192.168.0.0/16 connect -F 1080 -S socks.example.com &
+ *     $ curl --proxy socks5h://localhost:1080 https://www.example.org/
+ *
+ *   The '-A' option runs the program as a credential agent listening on
+ *   a Unix domain socket of given path, instead of relaying. If the
+ *   parameter CONNECT_AGENT is set to the path, passwords of relay
+ *   servers are asked to the agent before prompting (tty or SSH_ASKPASS),
+ *   and the entered one is given to the agent. It is kept for
+ *   CONNECT_AGENT_TTL seconds (default 3600) in memory locked not to be
+ *   swapped out, and forgotten when the server rejects it. The agent
+ *   answers only to processes of the same user.
+ *
+ *   CONNECT_RATE limits sending of each session to "UP[:DOWN]" bytes per
+ *   second (ex. "64k:1m"), where UP is toward the remote. With '-D',
+ *   CONNECT_RATE_TOTAL limits all sessions together, and the bandwidth
+ *   is shared among sessions of higher class first, then in turn among
+ *   sessions of the same class. The class is "interactive", "normal" or
+ *   "bulk", decided by destination with CONNECT_CLASS, a list of rules
+ *   like "interactive:22,23 bulk:873,8000-8100,.mirror.example.org"
+ *   (ports, port ranges or host names, a leading dot matches the domain).
+ *   The default is "interactive:22,23", others are normal. Limits of 0
+ *   mean unlimited.
+ *
+ *   Parameters read from /etc/connectrc and ~/.connectrc, and the parsed
+ *   direct list, are cached in ~/.cache/connect/config while the files
+ *   are unchanged, unless they set a password. Set CONNECT_CONFIG_CACHE
+ *   to "no" to disable it.
+ *
+ *   If CONNECT_METRICS is set, one line of JSON is written for each
+ *   session when it ends: time spent for name resolution, TCP connect
+ *   and each negotiation phase, bytes relayed in each direction, time
+ *   stalled with a full buffer, round trip time of the remote socket
+ *   and the reason of close. The value is a file name to append to,
+ *   "unix:" followed by the path of a listening Unix domain socket, or
+ *   "-" for standard error. Sending SIGUSR1 dumps the same line for
+ *   every active session (to standard error if CONNECT_METRICS is not
+ *   set).
+ *
+ *   CONNECT_TRACE_CAPTURE keeps the last given KB of data sent and
+ *   received (except authentication) in memory, and dumps them to
+ *   standard error in hex when an error occurs. It costs one copy of
+ *   the data, so it can be left enabled. Relaying with splice() is not
+ *   used while capturing.
+ *
+ *   The value of *_DIRECT parameters (ex. SOCKS5_DIRECT) can be given
+ *   as '@' followed by a file name. Entries in the file are separated by
+ *   comma, space or newline, and '#' starts a comment. There is no limit
+ *   on the number of entries.
  *
  *   The '-w' option specifys timeout seconds for making connection with
- *   TARGET host.
+ *   TARGET host. It also bounds each phase of negotiation with relay
+ *   server (waiting one reply), which defaults to 60 seconds without
+ *   '-w'. The time to enter password is not counted.
+ *
+ *   When a host name has several addresses (IPv4 and IPv6), they are
+ *   tried in parallel: a new attempt is started every 250 ms while
+ *   earlier ones are pending, alternating address families, and the
+ *   first connection established is used (RFC 8305 "Happy Eyeballs").
+ *   A dead address no longer stalls the connection.
+ *
+ *   If the parameter CONNECT_DNS_CACHE is "yes", resolved addresses are
+ *   kept in ~/.cache/connect/dns and shared by later invocations. A file
+ *   name can be given instead of "yes". They are kept for
+ *   CONNECT_DNS_CACHE_TTL seconds (default 60) regardless of the TTL of
+ *   the DNS records, which the resolver does not tell, so keep it short
+ *   for hosts whose addresses change.
+ *
+ *   The '-B' option specifys the size of relay buffer for each direction
+ *   in bytes. Suffix 'k' or 'm' can be used (ex. 256k). The default is
+ *   64k. You can also specify this value in the parameter
+ *   CONNECT_BUFFER_SIZE.
+ *
+ *   The '-O' option sets TCP options of relayed sockets. The value is a
+ *   comma separated list of "nodelay", "quickack", "sndbuf=SIZE",
+ *   "rcvbuf=SIZE", "keepalive[=IDLE[:INTVL[:CNT]]]" (seconds) and
+ *   "notsent_lowat=SIZE", or one of the presets "interactive" (no Nagle
+ *   delay, quick ACK, keepalive, small unsent queue) and "bulk" (4m
+ *   socket buffers). Later items override earlier ones, and "=0" turns
+ *   a flag off (ex. "bulk,nodelay"). The value applies to both sides
+ *   unless prefixed with "local:" or "remote:", and the option can be
+ *   repeated. The parameters CONNECT_TCP_LOCAL and CONNECT_TCP_REMOTE
+ *   give the same per side; '-O' overrides them. For example,
+ *   interactive ssh sessions do well with "-O interactive" and large
+ *   transfers over long fat pipes with "-O bulk".
+ *
+ *   On Linux, when the local side is a pipe or a socket, relayed data is
+ *   moved with splice() and never copied into the program. Set the
+ *   parameter CONNECT_SPLICE to "no" to use the usual buffered relay.
+ *
+ *   The event loop uses epoll on Linux and select() elsewhere. Set the
+ *   parameter CONNECT_EVLOOP to "select" to use select() on Linux too,
+ *   which is mainly for testing.
  *
  *   The '-d' option is used for debug. If you fail to connect, use this
  *   and check request to and response from server.
@@ -153,10 +319,17 @@
  *
  *   Only USER/PASS authentication is supported.
  *
+ *   If the parameter SOCKS5_PIPELINE is "yes" and only one method
+ *   ("none" or "userpass") is given by the '-a' option or SOCKS5_AUTH,
+ *   the method selection, authentication and CONNECT request are sent
+ *   at once without waiting each reply. This saves two round trips but
+ *   some servers may not accept it.
+ *
  * Proxy authentication
  * ====================
  *
- *   Only BASIC scheme is supported.
+ *   Basic and Digest (MD5, SHA-256 and their -sess variants) schemes
+ *   are supported, see the -H option above.
  *
  * Authentication informations
  * ===========================
@@ -202,17 +375,22 @@
  *
  ***********************************************************************/
 
+#if defined(__linux__) && !defined(_GNU_SOURCE)
+#define _GNU_SOURCE                             /* for splice() */
+#endif /* __linux__ */
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
 #include <ctype.h>
 #include <memory.h>
 #include <errno.h>
+#include <limits.h>
 #include <assert.h>
 #include <sys/types.h>
 #include <stdarg.h>
 #include <fcntl.h>
 #include <signal.h>
+#include <time.h>
 
 #ifdef __CYGWIN32__
 #undef _WIN32
@@ -229,6 +407,7 @@
 #include <pwd.h>
 #include <termios.h>
 #include <sys/time.h>
+#include <sys/stat.h>
 #ifndef __hpux
 #include <sys/select.h>
 #endif /* __hpux */
@@ -236,6 +415,17 @@
 #include <netinet/in.h>
 #include <arpa/inet.h>
 #include <netdb.h>
+#include <sys/mman.h>
+#include <sys/un.h>
+#include <netinet/tcp.h>
+#define WITH_GETADDRINFO 1
+#define WITH_DNS_CACHE 1
+#define WITH_CONFIG_CACHE 1
+#ifdef __linux__
+#define WITH_EPOLL 1
+#include <sys/epoll.h>
+#define WITH_SPLICE 1
+#endif /* __linux__ */
 #if !defined(_WIN32) && !defined(__CYGWIN32__)
 #define WITH_RESOLVER 1
 #include <arpa/nameser.h>
@@ -271,7 +461,8 @@ static char *vcid = "$Id: connect.c 100 2007-07-03 10:48:26Z gotoh $";
    Win32 environment does not support -R option (vc and cygwin)
    Win32 native compilers does not support -w option, yet (vc)
 */
-static char *usage = "usage: %s [-dnhst45] [-p local-port]"
+static char *usage = "usage: %s [-dnhst45] [-p local-port] [-B buffer-size] "
+"[-O tcp-options] "
 #ifdef _WIN32
 #ifdef __CYGWIN32__
 "[-w timeout] \n"                               /* cygwin cannot -R */
@@ -280,7 +471,8 @@ static char *usage = "usage: %s [-dnhst45] [-p local-port]"
 #endif /* not __CYGWIN32__ */
 #else  /* not _WIN32 */
 /* help message for UNIX */
-"[-R resolve] [-w timeout] \n"
+"[-R resolve] [-w timeout] [-D local-port] [-U socket-path] \n"
+"          [-A agent-socket-path] [-F local-port] \n"
 #endif /* not _WIN32 */
 "          [-H proxy-server[:port]] [-S [user@]socks-server[:port]] \n"
 "          [-T proxy-server[:port]]\n"
@@ -307,6 +499,14 @@ int f_report = 1;
 
 int connect_timeout = 0;
 
+/* size of relay buffer for each direction */
+#define RELAY_BUFSIZ_DEFAULT    (64*1024)
+#define RELAY_BUFSIZ_MIN        1024
+#define RELAY_BUFSIZ_MAX        (4*1024*1024)
+int relay_bufsize = 0;                          /* option 'B' */
+long spill_memory = 1024*1024;                  /* for option 'P' */
+long spill_max = 64*1024*1024;
+
 /* local input type */
 #define LOCAL_STDIO     0
 #define LOCAL_SOCKET    1
@@ -314,6 +514,10 @@ char *local_type_names[] = { "stdio", "socket" };
 int   local_type = LOCAL_STDIO;
 u_short local_port = 0;                         /* option 'p' */
 int f_hold_session = 0;                         /* option 'P' */
+int f_daemon = 0;                               /* option 'D' */
+char *resident_path = NULL;                     /* option 'U' */
+char *agent_path = NULL;                        /* option 'A' */
+int f_frontend = 0;                             /* option 'F' */
 
 char *telnet_command = "telnet %h %p";
 
@@ -336,6 +540,33 @@ char *relay_host = NULL;                        /* hostname of relay server */
 u_short relay_port = 0;                         /* port of relay server */
 char *relay_user = NULL;                        /* user name for auth */
 
+/* list of relay servers, relay_host and relay_port are set from the
+   one being used */
+typedef struct {
+    char *host;
+    u_short port;
+    char *user;                                 /* user name for auth */
+    long srtt;                                  /* ms to connect, 0: unknown */
+    int fails;                                  /* consecutive failures */
+    time_t last_fail;                           /* time of last failure */
+} PROXY_SERVER;
+
+PROXY_SERVER *proxy_list = NULL;
+int n_proxy_list = 0;
+
+/* relay servers to pass through before the relay server above, from
+   local side.  They are given by repeated -S, -H or -T. */
+typedef struct {
+    int method;
+    char *host;
+    u_short port;
+    char *user;                                 /* user name for auth */
+    int auth_type;                              /* proxy_auth_type */
+} RELAY;
+
+RELAY *relay_chain = NULL;
+int n_relay_chain = 0;
+
 /* destination target host and port */
 char *dest_host = NULL;
 struct sockaddr_in dest_addr;
@@ -353,6 +584,11 @@ u_short dest_port = 0;
 #define SOCKS5_REP_ANOTSUP      0x08    /* Address not supported */
 #define SOCKS5_REP_INVADDR      0x09    /* Inalid address */
 
+/* SOCKS5 command and address types */
+#define SOCKS5_CMD_CONNECT      0x01    /* CONNECT */
+#define SOCKS5_ATYP_IPv4        0x01    /* IP V4 address */
+#define SOCKS5_ATYP_FQDN        0x03    /* domain name */
+
 LOOKUP_ITEM socks5_rep_names[] = {
     { SOCKS5_REP_SUCCEEDED, "succeeded"},
     { SOCKS5_REP_FAIL,      "general SOCKS server failure"},
@@ -431,6 +667,29 @@ char *socks5_auth = NULL;
 #define ENV_CONNECT_DIRECT "CONNECT_DIRECT"
 
 #define ENV_SOCKS5_AUTH "SOCKS5_AUTH"
+#define ENV_SOCKS5_PIPELINE "SOCKS5_PIPELINE"   /* send requests at once */
+#define ENV_CONNECT_BUFFER_SIZE "CONNECT_BUFFER_SIZE" /* relay buffer size */
+#define ENV_CONNECT_SPILL_MEMORY "CONNECT_SPILL_MEMORY" /* for -P in memory */
+#define ENV_CONNECT_SPILL_SIZE "CONNECT_SPILL_SIZE" /* for -P in total */
+#define ENV_CONNECT_RATE "CONNECT_RATE"         /* bytes/sec of session */
+#define ENV_CONNECT_RATE_TOTAL "CONNECT_RATE_TOTAL" /* of all sessions */
+#define ENV_CONNECT_CLASS "CONNECT_CLASS"       /* priority of sessions */
+#define ENV_CONNECT_CONFIG_CACHE "CONNECT_CONFIG_CACHE"
+#define ENV_CONNECT_DNS_CACHE "CONNECT_DNS_CACHE"     /* yes or file */
+#define ENV_CONNECT_DNS_CACHE_TTL "CONNECT_DNS_CACHE_TTL" /* seconds */
+#define ENV_CONNECT_AUTH_CACHE "CONNECT_AUTH_CACHE"   /* no to disable */
+#define ENV_CONNECT_METRICS "CONNECT_METRICS"   /* sink of session metrics */
+#define ENV_CONNECT_TRACE_CAPTURE "CONNECT_TRACE_CAPTURE" /* KB to keep */
+#define ENV_CONNECT_TCP_LOCAL "CONNECT_TCP_LOCAL"   /* TCP options */
+#define ENV_CONNECT_TCP_REMOTE "CONNECT_TCP_REMOTE"
+#define ENV_CONNECT_PROXY_STRATEGY "CONNECT_PROXY_STRATEGY" /* for list */
+#define ENV_CONNECT_SPLICE "CONNECT_SPLICE"     /* use splice() to relay */
+#define ENV_CONNECT_EVLOOP "CONNECT_EVLOOP"     /* event loop backend */
+#define ENV_CONNECT_POOL_SIZE "CONNECT_POOL_SIZE" /* # of warm connections */
+#define ENV_CONNECT_POOL_IDLE "CONNECT_POOL_IDLE" /* max idle of them */
+#define ENV_CONNECT_RESIDENT "CONNECT_RESIDENT" /* socket to hand off */
+#define ENV_CONNECT_AGENT "CONNECT_AGENT"       /* credential agent */
+#define ENV_CONNECT_AGENT_TTL "CONNECT_AGENT_TTL" /* seconds to keep */
 #define ENV_SSH_ASKPASS "SSH_ASKPASS"           /* askpass program */
 
 /* Prefix string of HTTP_PROXY */
@@ -439,8 +698,10 @@ char *socks5_auth = NULL;
 #define PROXY_AUTH_BASIC 1
 #define PROXY_AUTH_DIGEST 2
 int proxy_auth_type = PROXY_AUTH_NONE;
+int auth_cached = 0;                            /* sent without challenge */
 
 /* reason of end repeating */
+#define REASON_UNSUPPORTED      -3      /* relay method can't be used */
 #define REASON_UNK              -2
 #define REASON_ERROR            -1
 #define REASON_CLOSED_BY_LOCAL  0
@@ -450,6 +711,7 @@ int proxy_auth_type = PROXY_AUTH_NONE;
 #define START_ERROR -1
 #define START_OK     0
 #define START_RETRY  1
+#define START_AGAIN  2                          /* in progress */
 
 /* socket related definitions */
 #ifndef _WIN32
@@ -458,12 +720,17 @@ int proxy_auth_type = PROXY_AUTH_NONE;
 #ifndef SOCKET_ERROR
 #define SOCKET_ERROR -1
 #endif
+#ifndef INVALID_SOCKET
+#define INVALID_SOCKET -1
+#endif
 
 #ifdef _WIN32
 #define socket_errno() WSAGetLastError()
+#define socket_wouldblock() (socket_errno() == WSAEWOULDBLOCK)
 #else /* !_WIN32 */
 #define closesocket close
 #define socket_errno() (errno)
+#define socket_wouldblock() (errno == EAGAIN || errno == EWOULDBLOCK)
 #endif /* !_WIN32 */
 
 #ifdef _WIN32
@@ -473,16 +740,28 @@ int proxy_auth_type = PROXY_AUTH_NONE;
 /* packet operation macro */
 #define PUT_BYTE(ptr,data) (*(unsigned char*)ptr = data)
 
-/* debug message output */
+/* debug message output.
+   Message is formatted in buffer and written at once. */
 void
 debug( const char *fmt, ... )
 {
     va_list args;
+    char buf[1024];
+    int len;
     if ( f_debug ) {
+        strcpy( buf, "DEBUG: " );
         va_start( args, fmt );
-        fprintf(stderr, "DEBUG: ");
-        vfprintf( stderr, fmt, args );
+        len = vsnprintf( buf+7, sizeof(buf)-7, fmt, args );
         va_end( args );
+        if ( 0 <= len && len < (int)sizeof(buf)-7 ) {
+            fputs( buf, stderr );
+        } else {
+            /* too long, or old vsnprintf() */
+            va_start( args, fmt );
+            fprintf(stderr, "DEBUG: ");
+            vfprintf( stderr, fmt, args );
+            va_end( args );
+        }
     }
 }
 
@@ -497,6 +776,136 @@ debug_( const char *fmt, ... )                  /* without prefix */
     }
 }
 
+/* Tracing in the relay loop.  TRACE() checks the level before the
+   arguments are evaluated, so a disabled trace costs one comparison
+   and no call.  ARGS is the parenthesized argument list of debug().
+   Build with -DNO_TRACE to remove them entirely. */
+#ifdef NO_TRACE
+#define TRACE_ON(level)         0
+#else
+#define TRACE_ON(level)         ((level) <= f_debug)
+#endif /* NO_TRACE */
+#define TRACE(level, args)      do { if ( TRACE_ON(level) ) debug args; } while (0)
+
+/* dump LEN bytes of BUF to stderr as lines of "offset hex |ascii|".
+   Lines are collected in buffer and written in large chunks. */
+void
+hexdump( const char *prefix, const char *buf, int len )
+{
+    static const char hex[] = "0123456789abcdef";
+    char out[4096];
+    int off, i, n, pos = 0;
+    unsigned char c;
+
+    for ( off = 0; off < len; off += 16 ) {
+        if ( (int)sizeof(out) - 128 < pos ) {
+            fwrite( out, 1, pos, stderr );
+            pos = 0;
+        }
+        n = (len - off < 16)? len - off: 16;
+        pos += snprintf( out+pos, 32, "%.8s %06x ", prefix, off );
+        for ( i = 0; i < 16; i++ ) {
+            if ( i < n ) {
+                c = buf[off+i];
+                out[pos++] = hex[c >> 4];
+                out[pos++] = hex[c & 15];
+            } else {
+                out[pos++] = ' ';
+                out[pos++] = ' ';
+            }
+            out[pos++] = ' ';
+        }
+        out[pos++] = '|';
+        for ( i = 0; i < n; i++ ) {
+            c = buf[off+i];
+            out[pos++] = (isprint(c))? c: '.';
+        }
+        out[pos++] = '|';
+        out[pos++] = '\n';
+    }
+    if ( 0 < pos )
+        fwrite( out, 1, pos, stderr );
+}
+
+/* Capture of the last bytes passed in each direction.  It is cheap
+   enough to keep enabled in production: error() and fatal() dump it,
+   so the traffic which led to a failure can be seen without running
+   with -d.  The size is given by CONNECT_TRACE_CAPTURE in KB. */
+typedef struct {
+    char *buf;
+    int size;                                   /* 0: disabled */
+    int pos;                                    /* next byte to write */
+    double total;                               /* bytes captured */
+} TRACE_CAPTURE;
+
+#define TRACE_UP        0                       /* local => remote */
+#define TRACE_DOWN      1                       /* remote => local */
+TRACE_CAPTURE trace_capture[2];
+
+#define CAPTURE(dir, buf, len)                                          \
+    do { if ( trace_capture[dir].size )                                 \
+            trace_capture_put( &trace_capture[dir], buf, len ); } while (0)
+
+void
+trace_capture_init( int kb )
+{
+    int i;
+
+    for ( i = 0; i < 2 && 0 < kb; i++ ) {
+        trace_capture[i].buf = malloc( kb * 1024 );
+        if ( trace_capture[i].buf != NULL )
+            trace_capture[i].size = kb * 1024;
+    }
+}
+
+void
+trace_capture_put( TRACE_CAPTURE *cap, const char *buf, int len )
+{
+    int n;
+
+    cap->total += len;
+    if ( cap->size <= len ) {
+        buf += len - cap->size;                 /* keep last part */
+        len = cap->size;
+    }
+    n = cap->size - cap->pos;
+    if ( len < n )
+        n = len;
+    memcpy( cap->buf + cap->pos, buf, n );
+    memcpy( cap->buf, buf + n, len - n );
+    cap->pos = (cap->pos + len) % cap->size;
+}
+
+/* dump captured bytes in order and forget them */
+void
+trace_capture_dump( void )
+{
+    static const char *prefix[] = { ">>>", "<<<" };
+    TRACE_CAPTURE *cap;
+    char *tmp;
+    int i, len;
+
+    for ( i = 0; i < 2; i++ ) {
+        cap = &trace_capture[i];
+        if ( cap->total == 0 )
+            continue;
+        len = (cap->total < cap->size)? (int)cap->total: cap->size;
+        fprintf( stderr, "CAPTURE: last %d of %.0f bytes %s\n", len,
+                 cap->total, (i == TRACE_UP)? "sent": "received" );
+        if ( cap->total < cap->size ) {
+            hexdump( prefix[i], cap->buf, len );    /* not wrapped */
+        } else if ( (tmp = malloc( len )) != NULL ) {
+            /* oldest byte is at pos */
+            memcpy( tmp, cap->buf + cap->pos, len - cap->pos );
+            memcpy( tmp + len - cap->pos, cap->buf, cap->pos );
+            hexdump( prefix[i], tmp, len );
+            free( tmp );
+        }
+        cap->total = 0;
+        cap->pos = 0;
+    }
+}
+
 /* error message output */
 void
 error( const char *fmt, ... )
@@ -506,6 +915,7 @@ error( const char *fmt, ... )
     fprintf(stderr, "ERROR: ");
     vfprintf( stderr, fmt, args );
     va_end( args );
+    trace_capture_dump();
 }
 
 void
@@ -516,6 +926,7 @@ fatal( const char *fmt, ... )
     fprintf(stderr, "FATAL: ");
     vfprintf( stderr, fmt, args );
     va_end( args );
+    trace_capture_dump();
     exit (EXIT_FAILURE);
 }
 
@@ -686,16 +1097,67 @@ PARAMETER_ITEM parameter_table[] = {
     { ENV_HTTP_DIRECT, NULL },
     { ENV_CONNECT_DIRECT, NULL },
     { ENV_SOCKS5_AUTH, NULL },
+    { ENV_SOCKS5_PIPELINE, NULL },
+    { ENV_CONNECT_BUFFER_SIZE, NULL },
+    { ENV_CONNECT_SPILL_MEMORY, NULL },
+    { ENV_CONNECT_SPILL_SIZE, NULL },
+    { ENV_CONNECT_RATE, NULL },
+    { ENV_CONNECT_RATE_TOTAL, NULL },
+    { ENV_CONNECT_CLASS, NULL },
+    { ENV_CONNECT_CONFIG_CACHE, NULL },
+    { ENV_CONNECT_DNS_CACHE, NULL },
+    { ENV_CONNECT_DNS_CACHE_TTL, NULL },
+    { ENV_CONNECT_AUTH_CACHE, NULL },
+    { ENV_CONNECT_METRICS, NULL },
+    { ENV_CONNECT_TRACE_CAPTURE, NULL },
+    { ENV_CONNECT_TCP_LOCAL, NULL },
+    { ENV_CONNECT_TCP_REMOTE, NULL },
+    { ENV_CONNECT_PROXY_STRATEGY, NULL },
+    { ENV_CONNECT_SPLICE, NULL },
+    { ENV_CONNECT_EVLOOP, NULL },
+    { ENV_CONNECT_POOL_SIZE, NULL },
+    { ENV_CONNECT_AGENT, NULL },
+    { ENV_CONNECT_AGENT_TTL, NULL },
+    { ENV_CONNECT_POOL_IDLE, NULL },
     { NULL, NULL }
 };
 
+/* hash of string, for tables keyed by name */
+unsigned int
+str_hash( const char *str )
+{
+    unsigned int h = 5381;
+    while ( *str )
+        h = h * 33 + (unsigned char)*str++;
+    return h;
+}
+
+/* parameter_table indexed by name, built at first lookup */
+#define PARAMETER_HASH_SIZE 64                  /* > 2 * # of parameters */
+PARAMETER_ITEM *parameter_hash[PARAMETER_HASH_SIZE];
+
 PARAMETER_ITEM*
 find_parameter_item(const char* name)
 {
+    static int initialized = 0;
+    PARAMETER_ITEM *item;
+    unsigned int h;
     int i;
-    for( i = 0; parameter_table[i].name != NULL; i++ ){
-        if ( strcmp(name, parameter_table[i].name) == 0 )
-            return &parameter_table[i];
+
+    if ( !initialized ) {
+        for( i = 0; parameter_table[i].name != NULL; i++ ){
+            h = str_hash( parameter_table[i].name ) % PARAMETER_HASH_SIZE;
+            while ( parameter_hash[h] != NULL )
+                h = (h + 1) % PARAMETER_HASH_SIZE;
+            parameter_hash[h] = &parameter_table[i];
+        }
+        initialized = 1;
+    }
+    h = str_hash( name ) % PARAMETER_HASH_SIZE;
+    while ( (item = parameter_hash[h]) != NULL ) {
+        if ( strcmp(name, item->name) == 0 )
+            return item;
+        h = (h + 1) % PARAMETER_HASH_SIZE;
     }
     return NULL;
 }
@@ -751,22 +1213,47 @@ read_parameter_file_1(const char* name)
     }
 }
 
+#if !defined(_WIN32) || defined(cygwin)
+/* path of file NAME in home directory, caller must free */
+char *
+home_path(const char *name)
+{
+    char *path;
+    struct passwd *pw;
+
+    pw = getpwuid(getuid());
+    if ( pw == NULL )
+        fatal("getpwuid() failed for uid: %d\n", getuid());
+    path = xmalloc(strlen(pw->pw_dir) + strlen(name) + 2);
+    strcpy(path, pw->pw_dir);
+    strcat(path, "/");
+    strcat(path, name);
+    return path;
+}
+
+/* make directories leading to PATH with mode 0700 */
+void
+make_parent_dirs( char *path )
+{
+    char *p;
+    for ( p = strchr( path+1, '/' ); p != NULL; p = strchr( p+1, '/' ) ) {
+        *p = '\0';
+        mkdir( path, 0700 );                    /* may exist */
+        *p = '/';
+    }
+}
+#endif /* _WIN32 */
+
 void
 read_parameter_file(void)
 {
 #if !defined(_WIN32) || defined(cygwin)
     char *name;
-    struct passwd *pw;
 #endif
 
     read_parameter_file_1(PARAMETER_FILE);
 #if !defined(_WIN32) || defined(cygwin)
-    pw = getpwuid(getuid());
-    if ( pw == NULL )
-        fatal("getpwuid() failed for uid: %d\n", getuid());
-    name = xmalloc(strlen(pw->pw_dir) + strlen(PARAMETER_DOTFILE) + 2);
-    strcpy(name, pw->pw_dir);
-    strcat(name, "/" PARAMETER_DOTFILE);
+    name = home_path(PARAMETER_DOTFILE);
     read_parameter_file_1(name);
     free(name);
 #endif /* _WIN32 */
@@ -784,9 +1271,27 @@ getparam(const char* name)
     return value;
 }
 
+/* get boolean parameter NAME.  "yes", "on", "true" or "1" is true,
+   "no", "off", "false" or "0" is false.  DEF for others or not set. */
+int
+getparam_bool(const char* name, int def)
+{
+    char *value = getparam(name);
+    if ( value == NULL )
+        return def;
+    switch ( tolower(*value) ) {
+    case 'y': case 't': case '1':
+        return 1;
+    case 'n': case 'f': case '0':
+        return 0;
+    case 'o':
+        return tolower(value[1]) == 'n';
+    }
+    return def;
+}
+
 
 /** DIRECT connection **/
-#define MAX_DIRECT_ADDR_LIST 256
 
 struct ADDRPAIR {
     struct in_addr addr;
@@ -795,8 +1300,161 @@ struct ADDRPAIR {
     int negative;
 };
 
-struct ADDRPAIR direct_addr_list[MAX_DIRECT_ADDR_LIST];
+struct ADDRPAIR *direct_addr_list = NULL;
 int n_direct_addr_list = 0;
+int max_direct_addr_list = 0;
+
+/* Index of direct entries.
+   Address entries are put into a binary radix tree keyed by bits of
+   the address from MSB, and name entries into a trie keyed by labels
+   from the top level domain.  Each node keeps the smallest index of
+   entries ending there, and lookup takes the smallest one along the
+   path, so the first matching entry in the list wins as linear scan
+   did.  Addresses with non-contiguous mask (ex. 255.0.255.0) can't be
+   in the tree, they are still scanned linearly. */
+typedef struct addr_node {
+    struct addr_node *child[2];
+    int entry;                                  /* index or -1 */
+} ADDR_NODE;
+
+typedef struct name_node {
+    struct name_node *parent;
+    char *label;
+    int entry;                                  /* index or -1 */
+    struct name_node *hnext;                    /* chain of name_hash */
+} NAME_NODE;
+
+ADDR_NODE *addr_tree = NULL;
+int n_odd_mask_entries = 0;                     /* need linear scan */
+NAME_NODE **name_hash = NULL;                   /* (parent,label) => node */
+int name_hash_size = 0;
+int n_name_nodes = 0;
+
+static int
+direct_entry_new( void )
+{
+    if ( max_direct_addr_list <= n_direct_addr_list ) {
+        max_direct_addr_list = max_direct_addr_list? max_direct_addr_list*2: 64;
+        direct_addr_list = realloc( direct_addr_list,
+                                    max_direct_addr_list * sizeof(struct ADDRPAIR));
+        if ( direct_addr_list == NULL )
+            fatal("Cannot allocate memory for direct address table.\n");
+    }
+    memset( &direct_addr_list[n_direct_addr_list], 0, sizeof(struct ADDRPAIR));
+    return n_direct_addr_list++;
+}
+
+static ADDR_NODE *
+addr_node_new( void )
+{
+    ADDR_NODE *node = xmalloc( sizeof(ADDR_NODE) );
+    node->child[0] = node->child[1] = NULL;
+    node->entry = -1;
+    return node;
+}
+
+/* length of prefix of MASK, or -1 if not contiguous */
+static int
+mask_prefix_len( struct in_addr *mask )
+{
+    u_long m = ntohl( mask->s_addr ), inv = ~m & 0xFFFFFFFFUL;
+    int n = 0;
+    if ( (inv & (inv + 1)) != 0 )
+        return -1;                              /* has hole */
+    while ( m & 0x80000000UL ) {
+        n++;
+        m = (m << 1) & 0xFFFFFFFFUL;
+    }
+    return n;
+}
+
+static unsigned int
+name_hash_key( NAME_NODE *parent, const char *label, int len )
+{
+    unsigned int h = (unsigned int)((unsigned long)parent >> 4);
+    while ( 0 < len-- )
+        h = h * 33 + (unsigned char)*label++;
+    return h;
+}
+
+/* find child of PARENT labeled LABEL (LEN bytes), create if ADD */
+static NAME_NODE *
+name_node_child( NAME_NODE *parent, const char *label, int len, int add )
+{
+    NAME_NODE *node, **old;
+    int i, old_size;
+
+    if ( name_hash_size == 0 ) {
+        if ( !add )
+            return NULL;
+        name_hash_size = 256;
+        name_hash = xmalloc( name_hash_size * sizeof(NAME_NODE*) );
+        memset( name_hash, 0, name_hash_size * sizeof(NAME_NODE*) );
+    }
+    for ( node = name_hash[name_hash_key(parent, label, len) % name_hash_size];
+          node != NULL; node = node->hnext ) {
+        if ( node->parent == parent && strncmp( node->label, label, len ) == 0
+             && node->label[len] == '\0' )
+            return node;
+    }
+    if ( !add )
+        return NULL;
+    if ( name_hash_size < n_name_nodes ) {
+        /* grow and rehash */
+        old = name_hash;
+        old_size = name_hash_size;
+        name_hash_size *= 2;
+        name_hash = xmalloc( name_hash_size * sizeof(NAME_NODE*) );
+        memset( name_hash, 0, name_hash_size * sizeof(NAME_NODE*) );
+        for ( i = 0; i < old_size; i++ ) {
+            while ( (node = old[i]) != NULL ) {
+                unsigned int h = name_hash_key( node->parent, node->label,
+                                                strlen(node->label) );
+                old[i] = node->hnext;
+                node->hnext = name_hash[h % name_hash_size];
+                name_hash[h % name_hash_size] = node;
+            }
+        }
+        free( old );
+    }
+    node = xmalloc( sizeof(NAME_NODE) );
+    node->parent = parent;
+    node->label = xmalloc( len + 1 );
+    memcpy( node->label, label, len );
+    node->label[len] = '\0';
+    node->entry = -1;
+    i = name_hash_key( parent, label, len ) % name_hash_size;
+    node->hnext = name_hash[i];
+    name_hash[i] = node;
+    n_name_nodes++;
+    return node;
+}
+
+/* walk labels of NAME from the last one, calling name_node_child().
+   Returns smallest entry along the path, or the last node if ADD. */
+static int
+name_trie_walk( const char *name, int add, NAME_NODE **last )
+{
+    NAME_NODE *node = NULL;
+    const char *end = name + strlen(name), *beg;
+    int best = -1;
+
+    while ( 1 ) {
+        for ( beg = end; name < beg && beg[-1] != '.'; beg-- )
+            ;
+        node = name_node_child( node, beg, end - beg, add );
+        if ( node == NULL )
+            break;
+        if ( 0 <= node->entry && (best < 0 || node->entry < best) )
+            best = node->entry;
+        if ( beg == name )
+            break;
+        end = beg - 1;                          /* skip '.' */
+    }
+    if ( last != NULL )
+        *last = node;
+    return best;
+}
 
 void
 mask_addr (void *addr, void *mask, int addrlen)
@@ -813,23 +1471,38 @@ add_direct_addr (struct in_addr *addr, struct in_addr *mask, int negative)
 {
     struct in_addr iaddr;
     char *s;
-    if ( MAX_DIRECT_ADDR_LIST <= n_direct_addr_list ) {
-        error("direct address table is full!\n");
-        return -1;
-    }
+    ADDR_NODE *node;
+    u_long bits;
+    int i, n, len;
+
     iaddr = *addr;
     mask_addr(&iaddr, mask, sizeof(iaddr));
     s = strdup(inet_ntoa(iaddr));
     debug("adding direct addr entry: %s%s/%s\n",
           negative? "!": "", s, inet_ntoa(*mask));
     free(s);
-    memcpy( &direct_addr_list[n_direct_addr_list].addr,
-            &iaddr, sizeof(iaddr));
-    memcpy( &direct_addr_list[n_direct_addr_list].mask,
-            mask, sizeof(*mask));
-    direct_addr_list[n_direct_addr_list].name = NULL;
-    direct_addr_list[n_direct_addr_list].negative = negative;
-    n_direct_addr_list++;
+    n = direct_entry_new();
+    memcpy( &direct_addr_list[n].addr, &iaddr, sizeof(iaddr));
+    memcpy( &direct_addr_list[n].mask, mask, sizeof(*mask));
+    direct_addr_list[n].name = NULL;
+    direct_addr_list[n].negative = negative;
+
+    if ( (len = mask_prefix_len( mask )) < 0 ) {
+        n_odd_mask_entries++;                   /* scanned linearly */
+        return 0;
+    }
+    if ( addr_tree == NULL )
+        addr_tree = addr_node_new();
+    node = addr_tree;
+    bits = ntohl( iaddr.s_addr );
+    for ( i = 0; i < len; i++ ) {
+        int b = (bits >> (31 - i)) & 1;
+        if ( node->child[b] == NULL )
+            node->child[b] = addr_node_new();
+        node = node->child[b];
+    }
+    if ( node->entry < 0 )
+        node->entry = n;                        /* first one wins */
     return 0;
 }
 
@@ -838,18 +1511,22 @@ add_direct_addr (struct in_addr *addr, struct in_addr *mask, int negative)
 int
 add_direct_host( const char *name, int negative)
 {
-    if ( MAX_DIRECT_ADDR_LIST <= n_direct_addr_list ) {
-        error("direct address table is full!\n");
-        return -1;
-    }
+    NAME_NODE *node;
+    int n;
+
     if (*name == '*')
         name++;
     if (*name == '.')
         name++;
     debug("adding direct name entry: %s%s\n", negative? "!": "", name);
-    direct_addr_list[n_direct_addr_list].name = downcase(strdup(name));
-    direct_addr_list[n_direct_addr_list].negative = negative;
-    n_direct_addr_list++;
+    n = direct_entry_new();
+    direct_addr_list[n].name = downcase(strdup(name));
+    direct_addr_list[n].negative = negative;
+    if ( *name == '\0' )
+        return 0;                               /* never matches */
+    name_trie_walk( direct_addr_list[n].name, 1, &node );
+    if ( node->entry < 0 )
+        node->entry = n;                        /* first one wins */
     return 0;
 }
 
@@ -926,13 +1603,53 @@ parse_addr_pair (const char *str, struct in_addr *addr, struct in_addr *mask)
     return 0;
 }
 
-void
-initialize_direct_addr (void)
+/* read list of direct entries from file NAME.
+   Entries are separated by comma, space or newline, and '#' starts
+   a comment.  Returns comma separated list which caller must free. */
+char *
+read_direct_list_file (const char *name)
 {
-    int negative;
-    int n_entries;
-    char *env = NULL, *beg, *next, *envkey = NULL;
-    struct in_addr addr, mask;
+    FILE *f;
+    char *buf;
+    int c, size = 1024, len = 0, comment = 0;
+
+    if ( (f = fopen( name, "r" )) == NULL ) {
+        error("cannot open direct list file: %s\n", name);
+        return NULL;
+    }
+    buf = xmalloc( size );
+    while ( (c = getc(f)) != EOF ) {
+        if ( c == '#' )
+            comment = 1;
+        if ( c == '\n' )
+            comment = 0;
+        if ( comment )
+            continue;
+        if ( c == ',' || isspace(c) ) {
+            if ( len == 0 || buf[len-1] == ',' )
+                continue;                       /* no empty entry */
+            c = ',';
+        }
+        if ( size <= len + 1 ) {
+            size *= 2;
+            buf = realloc( buf, size );
+            if ( buf == NULL )
+                fatal("Cannot allocate memory for direct list.\n");
+        }
+        buf[len++] = c;
+    }
+    fclose( f );
+    if ( 0 < len && buf[len-1] == ',' )
+        len--;
+    buf[len] = '\0';
+    return buf;
+}
+
+/* parameter value of direct list for current relay method */
+char *
+direct_list_param (void)
+{
+    char *env = NULL, *envkey = NULL;
 
     if ( relay_method == METHOD_SOCKS ){
         if ( socks_version == 5 )
@@ -948,18 +1665,31 @@ initialize_direct_addr (void)
 
     if ( env == NULL )
         env = getparam(ENV_CONNECT_DIRECT);
+    return env;
+}
+
+void
+initialize_direct_addr (const char *env)
+{
+    int negative;
+    char *list, *beg, *next;
+    struct in_addr addr, mask;
 
     if ( env == NULL )
         return;                 /* no entry */
     debug("making direct addr list from: '%s'\n", env);
-    env = strdup( env );        /* reallocate to modify */
-    beg = next = env;
-    n_entries = 0;
-    do {
-        if ( MAX_DIRECT_ADDR_LIST <= n_entries ) {
-            error("too many entries in %s", envkey);
-            break;              /* from do loop */
+    if ( *env == '@' ) {
+        /* given by file */
+        list = read_direct_list_file( env+1 );
+        if ( list == NULL || *list == '\0' ) {
+            free( list );
+            return;
         }
+    } else {
+        list = strdup( env );   /* reallocate to modify */
+    }
+    beg = next = list;
+    do {
         next = strchr( beg, ',');
         if ( next != NULL )
             *next++ = '\0';
@@ -979,7 +1709,7 @@ initialize_direct_addr (void)
             beg = next;
     } while ( next != NULL );
 
-    free( env );
+    free( list );
     return;
 }
 
@@ -992,67 +1722,50 @@ cmp_addr (void *addr1, void *addr2, int addrlen)
 int
 is_direct_address (const struct in_addr addr)
 {
-    int i, neg;
+    int i, b, best = -1;
     struct in_addr iaddr;
+    ADDR_NODE *node;
+    u_long bits;
 
     /* Note: assume IPV4 address !! */
-    for (i=0; i<n_direct_addr_list; i++ ) {
-        if (direct_addr_list[i].name != NULL)
-            continue;                           /* it's name entry */
-        neg = direct_addr_list[i].negative;
+    bits = ntohl( addr.s_addr );
+    for ( node = addr_tree, i = 0; node != NULL; i++ ) {
+        if ( 0 <= node->entry && (best < 0 || node->entry < best) )
+            best = node->entry;
+        if ( 32 <= i )
+            break;
+        b = (bits >> (31 - i)) & 1;
+        node = node->child[b];
+    }
+    /* entries with odd mask can't be in tree */
+    for ( i = 0; 0 < n_odd_mask_entries && i < n_direct_addr_list &&
+              (best < 0 || i < best); i++ ) {
+        if (direct_addr_list[i].name != NULL ||
+            0 <= mask_prefix_len( &direct_addr_list[i].mask ))
+            continue;                           /* it's in index */
         iaddr = addr;
         mask_addr( &iaddr, &direct_addr_list[i].mask,
                    sizeof(struct in_addr));
         if (cmp_addr(&iaddr, &direct_addr_list[i].addr,
                      sizeof(struct in_addr)) == 0) {
-            char *a, *m;
-            a = strdup(inet_ntoa(direct_addr_list[i].addr));
-            m = strdup(inet_ntoa(direct_addr_list[i].mask));
-            debug("match with: %s/%s%s\n", a, m, neg? " (negative)": "");
-            free(a);
-            free(m);
-            return !neg? 1: 0;
+            best = i;
+            break;
         }
     }
+    if ( 0 <= best ) {
+        char *a, *m;
+        int neg = direct_addr_list[best].negative;
+        a = strdup(inet_ntoa(direct_addr_list[best].addr));
+        m = strdup(inet_ntoa(direct_addr_list[best].mask));
+        debug("match with: %s/%s%s\n", a, m, neg? " (negative)": "");
+        free(a);
+        free(m);
+        return !neg? 1: 0;
+    }
     debug("not matched, addr to be relayed: %s\n", inet_ntoa(addr));
     return 0;                   /* not direct */
 }
 
-
-/* check s1 is ends with s2.
-   return 1 if exact match or domain part match.
-   return 0 if s1 is shorter than s2 or partial match.
-   For example, 
-    ends_with("bar.com", "bar.com")        => 1 (exact match)
-    ends_with("foo.bar.com", "bar.com")    => 1 (domain match)
-    ends_with("foo.beebar.com", "bar.com") => 0 (partial match)
-    ends_with("bar", "bar.com")            => 0 (shorter)
- */
-domain_match(const char *s1, const char *s2)
-{
-    int len1, len2;
-    const char *tail1, *tail2;
-    len1 = strlen(s1);
-    len2 = strlen(s2);
-    if (len1 < len2 || len1 == 0 || len2 == 0)
-        return 0;                               /* not match */
-    tail1 = s1 + len1;
-    tail2 = s2 + len2;
-    while (0 < len1 && 0 < len2) {
-        if (*--tail1 != *--tail2)
-            break;                              /* not match */
-        len1--, len2--;
-    }
-    if (len2 != 0)
-        return 0;                               /* not match */
-    /* Now exact match, domain match or partial match.
-       Return true if exact or domain match.
-       Or continue checking. */
-    if (tail1 == s1 || tail1[-1] == '.')
-        return 1;                               /* match! */
-    return 0;                                   /* not match */
-}
-
 /* Check given NAME is ends with one of 
    registered direct name entry.
    Return 1 if matched, or 0.
@@ -1060,32 +1773,19 @@ domain_match(const char *s1, const char *s2)
 int
 is_direct_name (const char *name)
 {
-    int len, i;
-    const char *tail;
+    int i, neg;
+    char *lname;
+
     debug("checking %s is for direct?\n", name);
-    name = downcase(strdup(name));
-    len = strlen(name);
-    if (len < 1)
-        return 0;                               /* false */
-    tail = &name[len];
-    for (i=0; i<n_direct_addr_list; i++ ) {
-        int dlen, neg;
-        const char *dname;
-        const char *n, *d;
-        dname = direct_addr_list[i].name;
-        if (dname == NULL)
-            continue;                           /* it's addr/mask entry */
-        neg = direct_addr_list[i].negative;
-        if (domain_match(name, dname)) {
-            debug("match with: %s%s\n", dname, neg? " (negative)": "");
-            if (neg) {
-                return 0;       /* not direct */
-            } else {
-                return 1;       /* direct*/
-            }
-        }
-    }
-    return 0;                                   /* not matched */
+    lname = downcase(strdup(name));
+    i = (*lname == '\0')? -1: name_trie_walk( lname, 0, NULL );
+    free( lname );
+    if ( i < 0 )
+        return 0;                               /* not matched */
+    neg = direct_addr_list[i].negative;
+    debug("match with: %s%s\n", direct_addr_list[i].name,
+          neg? " (negative)": "");
+    return neg? 0: 1;
 }
 
 /* check to connect to HOST directyly?
@@ -1113,69 +1813,383 @@ check_direct(const char *host)
 }
 
 
-/** TTY operation **/
+/** CONFIG CACHE **/
 
-int intr_flag = 0;
+/* Snapshot of parameters read from PARAMETER_FILE and
+   PARAMETER_DOTFILE, together with the parsed direct list, is kept in
+   ~/.cache/connect/config.  It is used instead of parsing while both
+   files (and the file of direct list given by '@') have the same
+   mtime, size and inode as recorded.  Set CONNECT_CONFIG_CACHE to "no"
+   to disable.  Passwords are not copied into another file, so nothing
+   is cached while the files set any of them.  Layout of the file:
 
-#ifndef _WIN32
-void
-intr_handler(int sig)
+     CONFIG_CACHE_HEADER
+     DIRECT_RECORD[n_direct]
+     strings: (name \0 value \0) * n_params, direct key \0, names \0 ...
+*/
+#ifdef WITH_CONFIG_CACHE
+#define CONFIG_CACHE_MAGIC      0x434e4346      /* "CNCF" */
+#define CONFIG_CACHE_FILE       ".cache/connect/config"
+
+typedef struct {
+    long mtime, size, ino;                      /* size is -1 if missing */
+} FILE_STAMP;
+
+typedef struct {
+    int magic;
+    int header_size;                            /* to detect layout change */
+    FILE_STAMP files[2];                        /* global and user file */
+    FILE_STAMP list;                            /* file of direct list */
+    int n_params;
+    int n_direct;
+    int strings_size;
+} CONFIG_CACHE_HEADER;
+
+typedef struct {
+    struct in_addr addr;
+    struct in_addr mask;
+    int negative;
+    int name;                                   /* offset in strings or -1 */
+} DIRECT_RECORD;
+
+char *config_cache = NULL;                      /* loaded image */
+int config_cache_len = 0;
+int f_params_cached = 0;                        /* parameters from cache */
+int f_direct_cached = 0;                        /* direct list from cache */
+
+static void
+file_stamp( const char *name, FILE_STAMP *stamp )
 {
-    intr_flag = 1;
+    struct stat st;
+    memset( stamp, 0, sizeof(*stamp) );
+    if ( name == NULL || stat( name, &st ) < 0 ) {
+        stamp->size = -1;
+        return;
+    }
+    stamp->mtime = st.st_mtime;
+    stamp->size = st.st_size;
+    stamp->ino = st.st_ino;
 }
 
-void
-tty_change_echo(int fd, int enable)
+/* stamps of parameter files */
+static void
+config_file_stamps( FILE_STAMP *files )
 {
-    static struct termios ntio, otio;           /* new/old termios */
-    static sigset_t nset, oset;                 /* new/old sigset */
-    static struct sigaction nsa, osa;           /* new/old sigaction */
-    static int disabled = 0;
+    char *name = home_path( PARAMETER_DOTFILE );
+    file_stamp( PARAMETER_FILE, &files[0] );
+    file_stamp( name, &files[1] );
+    free( name );
+}
 
-    if ( disabled && enable ) {
-        /* enable echo */
-        tcsetattr(fd, TCSANOW, &otio);
-        disabled = 0;
-        /* resotore sigaction */
-        sigprocmask(SIG_SETMASK, &oset, NULL);
-        sigaction(SIGINT, &osa, NULL);
-        if ( intr_flag != 0 ) {
-            /* re-generate signal  */
-            kill(getpid(), SIGINT);
-            sigemptyset(&nset);
-            sigsuspend(&nset);
-            intr_flag = 0;
-        }
-    } else if (!disabled && !enable) {
-        /* set SIGINTR handler and break syscall on singal */
-        sigemptyset(&nset);
-        sigaddset(&nset, SIGTSTP);
-        sigprocmask(SIG_BLOCK, &nset, &oset);
-        intr_flag = 0;
-        memset(&nsa, 0, sizeof(nsa));
-        nsa.sa_handler = intr_handler;
-        sigaction(SIGINT, &nsa, &osa);
-        /* disable echo */
-        if (tcgetattr(fd, &otio) == 0 && (otio.c_lflag & ECHO)) {
-            disabled = 1;
-            ntio = otio;
-            ntio.c_lflag &= ~(ECHO | ECHOE | ECHOK | ECHONL);
-            (void) tcsetattr(fd, TCSANOW, &ntio);
-        }
-    }
+/* file of direct LIST if given by '@' */
+static const char *
+direct_list_file( const char *list )
+{
+    return (list != NULL && *list == '@')? list+1: NULL;
+}
 
-    return;
+static int
+config_cache_enabled( void )
+{
+    char *value = getenv( ENV_CONNECT_CONFIG_CACHE );
+    if ( value != NULL && (*value == 'n' || *value == 'N' || *value == '0') )
+        return 0;
+    return 1;
 }
 
-#define TTY_NAME "/dev/tty"
+/* is parameter NAME a password? */
 int
-tty_readpass( const char *prompt, char *buf, size_t size )
+config_cache_secret( const char *name )
 {
-    int tty, ret = 0;
+    return (strcmp( name, ENV_SOCKS5_PASSWD ) == 0 ||
+            strcmp( name, ENV_SOCKS5_PASSWORD ) == 0 ||
+            strcmp( name, ENV_HTTP_PROXY_PASSWORD ) == 0 ||
+            strcmp( name, ENV_CONNECT_PASSWORD ) == 0);
+}
 
-    tty = open(TTY_NAME, O_RDWR);
-    if ( tty < 0 ) {
-        error("Unable to open %s\n", TTY_NAME);
+/* load cache and set parameters from it.
+   Returns 0 if parameters are set, -1 if files must be read. */
+int
+config_cache_load( void )
+{
+    CONFIG_CACHE_HEADER *hdr;
+    FILE_STAMP files[2];
+    PARAMETER_ITEM *item;
+    char *path, *str, *end;
+    struct stat st;
+    int fd, i;
+
+    if ( config_cache != NULL )
+        return 0;                               /* already loaded */
+    if ( !config_cache_enabled() )
+        return -1;
+    path = home_path( CONFIG_CACHE_FILE );
+    fd = open( path, O_RDONLY );
+    free( path );
+    if ( fd < 0 )
+        return -1;
+    if ( fstat( fd, &st ) < 0 || st.st_size < (off_t)sizeof(CONFIG_CACHE_HEADER) ) {
+        close( fd );
+        return -1;
+    }
+    config_cache_len = st.st_size;
+    config_cache = xmalloc( config_cache_len );
+    if ( read( fd, config_cache, config_cache_len ) != config_cache_len )
+        goto invalid;
+    close( fd );
+    fd = -1;
+
+    hdr = (CONFIG_CACHE_HEADER*)config_cache;
+    config_file_stamps( files );
+    if ( hdr->magic != CONFIG_CACHE_MAGIC ||
+         hdr->header_size != sizeof(CONFIG_CACHE_HEADER) ||
+         hdr->n_params < 0 || hdr->n_direct < 0 || hdr->strings_size <= 0 ||
+         config_cache_len != (int)(sizeof(*hdr) +
+                                   hdr->n_direct * sizeof(DIRECT_RECORD)) +
+         hdr->strings_size ||
+         config_cache[config_cache_len-1] != '\0' )
+        goto invalid;
+    if ( memcmp( files, hdr->files, sizeof(files) ) != 0 ) {
+        debug("config cache is out of date.\n");
+        goto invalid;
+    }
+    /* set parameters, values are kept in cache image */
+    str = config_cache + config_cache_len - hdr->strings_size;
+    end = config_cache + config_cache_len;
+    for ( i = 0; i < hdr->n_params; i++ ) {
+        char *name = str;
+        str += strlen( str ) + 1;
+        if ( end <= str )
+            goto invalid;
+        if ( config_cache_secret( name ) ) {
+            debug("config cache has password, removing it.\n");
+            path = home_path( CONFIG_CACHE_FILE );
+            unlink( path );                     /* saved by old version */
+            free( path );
+            goto invalid;
+        }
+        if ( (item = find_parameter_item( name )) != NULL )
+            item->value = str;
+        str += strlen( str ) + 1;
+    }
+    debug("parameters are loaded from cache.\n");
+    f_params_cached = 1;
+    return 0;
+
+invalid:
+    if ( 0 <= fd )
+        close( fd );
+    for ( i = 0; parameter_table[i].name != NULL; i++ )
+        parameter_table[i].value = NULL;        /* may point cache */
+    free( config_cache );
+    config_cache = NULL;
+    return -1;
+}
+
+/* add direct entries from cache if they are made from LIST.
+   Returns 0 if done, -1 if LIST must be parsed. */
+int
+config_cache_load_direct( const char *list )
+{
+    CONFIG_CACHE_HEADER *hdr = (CONFIG_CACHE_HEADER*)config_cache;
+    DIRECT_RECORD *rec;
+    FILE_STAMP stamp;
+    char *strings, *key;
+    int i;
+
+    if ( config_cache == NULL || list == NULL )
+        return -1;
+    rec = (DIRECT_RECORD*)(hdr + 1);
+    strings = (char*)(rec + hdr->n_direct);
+    /* key follows parameters */
+    key = strings;
+    for ( i = 0; i < hdr->n_params * 2; i++ )
+        key += strlen( key ) + 1;
+    if ( config_cache + config_cache_len <= key || strcmp( key, list ) != 0 )
+        return -1;
+    file_stamp( direct_list_file( list ), &stamp );
+    if ( memcmp( &stamp, &hdr->list, sizeof(stamp) ) != 0 )
+        return -1;
+    for ( i = 0; i < hdr->n_direct; i++ ) {
+        if ( rec[i].name < 0 ) {
+            add_direct_addr( &rec[i].addr, &rec[i].mask, rec[i].negative );
+        } else if ( rec[i].name < hdr->strings_size ) {
+            add_direct_host( strings + rec[i].name, rec[i].negative );
+        }
+    }
+    debug("direct list is loaded from cache.\n");
+    f_direct_cached = 1;
+    return 0;
+}
+
+/* write cache if parameters or direct list made from LIST were
+   parsed from files. */
+void
+config_cache_save( const char *list )
+{
+    CONFIG_CACHE_HEADER hdr;
+    DIRECT_RECORD *rec;
+    char *strings, *path, *tmp;
+    int i, len, size, fd, ok;
+    time_t now = time(NULL);
+
+    if ( (f_params_cached && (list == NULL || f_direct_cached)) ||
+         !config_cache_enabled() || !getparam_bool(ENV_CONNECT_CONFIG_CACHE, 1) )
+        return;
+    memset( &hdr, 0, sizeof(hdr) );
+    hdr.magic = CONFIG_CACHE_MAGIC;
+    hdr.header_size = sizeof(hdr);
+    config_file_stamps( hdr.files );
+    file_stamp( direct_list_file( list ), &hdr.list );
+    /* file modified just now may be modified again within same second
+       without changing mtime, don't trust it */
+    for ( i = 0; i < 2; i++ )
+        if ( 0 <= hdr.files[i].size && now <= hdr.files[i].mtime + 1 )
+            return;
+    if ( 0 <= hdr.list.size && now <= hdr.list.mtime + 1 )
+        return;
+    if ( hdr.files[0].size < 0 && hdr.files[1].size < 0 &&
+         hdr.list.size < 0 )
+        return;                                 /* nothing worth caching */
+    for ( i = 0; parameter_table[i].name != NULL; i++ ) {
+        if ( parameter_table[i].value != NULL &&
+             config_cache_secret( parameter_table[i].name ) ) {
+            debug("config cache is not saved, %s is set.\n",
+                  parameter_table[i].name);
+            return;
+        }
+    }
+
+    /* strings */
+    size = 1024;
+    strings = xmalloc( size );
+#define ADD_STRING(s) do {                                      \
+        int l_ = strlen(s) + 1;                                 \
+        while ( size < len + l_ )                               \
+            strings = realloc( strings, size *= 2 );            \
+        if ( strings == NULL )                                  \
+            fatal("Cannot allocate memory for config cache.\n"); \
+        memcpy( strings + len, (s), l_ );                       \
+        len += l_;                                              \
+    } while (0)
+    len = 0;
+    for ( i = 0; parameter_table[i].name != NULL; i++ ) {
+        if ( parameter_table[i].value == NULL )
+            continue;
+        ADD_STRING( parameter_table[i].name );
+        ADD_STRING( parameter_table[i].value );
+        hdr.n_params++;
+    }
+    ADD_STRING( (list != NULL)? list: "" );
+    hdr.n_direct = n_direct_addr_list;
+    rec = xmalloc( sizeof(DIRECT_RECORD) * (n_direct_addr_list + 1) );
+    for ( i = 0; i < n_direct_addr_list; i++ ) {
+        rec[i].addr = direct_addr_list[i].addr;
+        rec[i].mask = direct_addr_list[i].mask;
+        rec[i].negative = direct_addr_list[i].negative;
+        rec[i].name = -1;
+        if ( direct_addr_list[i].name != NULL ) {
+            rec[i].name = len;
+            ADD_STRING( direct_addr_list[i].name );
+        }
+    }
+#undef ADD_STRING
+    hdr.strings_size = len;
+
+    /* write to temporary file and rename it for other processes */
+    path = home_path( CONFIG_CACHE_FILE );
+    make_parent_dirs( path );
+    tmp = xmalloc( strlen(path) + 16 );
+    sprintf( tmp, "%s.%d", path, (int)getpid() );
+    fd = open( tmp, O_WRONLY|O_CREAT|O_TRUNC, 0600 );
+    ok = (0 <= fd &&
+          write( fd, &hdr, sizeof(hdr) ) == (int)sizeof(hdr) &&
+          write( fd, rec, sizeof(DIRECT_RECORD) * hdr.n_direct )
+          == (int)(sizeof(DIRECT_RECORD) * hdr.n_direct) &&
+          write( fd, strings, len ) == len);
+    if ( 0 <= fd && close( fd ) < 0 )
+        ok = 0;
+    if ( ok && rename( tmp, path ) == 0 ) {
+        debug("config cache is saved: %s\n", path);
+    } else {
+        debug("cannot save config cache, errno=%d\n", errno);
+        unlink( tmp );
+    }
+    free( tmp );
+    free( path );
+    free( rec );
+    free( strings );
+}
+#else /* !WITH_CONFIG_CACHE */
+#define config_cache_load()             (-1)
+#define config_cache_load_direct(list)  (-1)
+#define config_cache_save(list)
+#endif /* !WITH_CONFIG_CACHE */
+
+
+/** TTY operation **/
+
+int intr_flag = 0;
+
+#ifndef _WIN32
+void
+intr_handler(int sig)
+{
+    intr_flag = 1;
+}
+
+void
+tty_change_echo(int fd, int enable)
+{
+    static struct termios ntio, otio;           /* new/old termios */
+    static sigset_t nset, oset;                 /* new/old sigset */
+    static struct sigaction nsa, osa;           /* new/old sigaction */
+    static int disabled = 0;
+
+    if ( disabled && enable ) {
+        /* enable echo */
+        tcsetattr(fd, TCSANOW, &otio);
+        disabled = 0;
+        /* resotore sigaction */
+        sigprocmask(SIG_SETMASK, &oset, NULL);
+        sigaction(SIGINT, &osa, NULL);
+        if ( intr_flag != 0 ) {
+            /* re-generate signal  */
+            kill(getpid(), SIGINT);
+            sigemptyset(&nset);
+            sigsuspend(&nset);
+            intr_flag = 0;
+        }
+    } else if (!disabled && !enable) {
+        /* set SIGINTR handler and break syscall on singal */
+        sigemptyset(&nset);
+        sigaddset(&nset, SIGTSTP);
+        sigprocmask(SIG_BLOCK, &nset, &oset);
+        intr_flag = 0;
+        memset(&nsa, 0, sizeof(nsa));
+        nsa.sa_handler = intr_handler;
+        sigaction(SIGINT, &nsa, &osa);
+        /* disable echo */
+        if (tcgetattr(fd, &otio) == 0 && (otio.c_lflag & ECHO)) {
+            disabled = 1;
+            ntio = otio;
+            ntio.c_lflag &= ~(ECHO | ECHOE | ECHOK | ECHONL);
+            (void) tcsetattr(fd, TCSANOW, &ntio);
+        }
+    }
+
+    return;
+}
+
+#define TTY_NAME "/dev/tty"
+int
+tty_readpass( const char *prompt, char *buf, size_t size )
+{
+    int tty, ret = 0;
+
+    tty = open(TTY_NAME, O_RDWR);
+    if ( tty < 0 ) {
+        error("Unable to open %s\n", TTY_NAME);
         return -1;                              /* can't open tty */
     }
     if ( size <= 0 )
@@ -1323,6 +2337,78 @@ determine_relay_password ()
 /*** network operations ***/
 
 
+/* parse relay server SPEC like "[http://][user@]host[:port][/]".
+   PORT is default port number of method, USER is NULL if not given. */
+void
+parse_relay_spec( char *spec, u_short port,
+                  char **host, u_short *pport, char **user )
+{
+    char *buf, *sep;
+
+    if (expect( spec, HTTP_PROXY_PREFIX)) {
+        /* URL format like: "http://server:port/" */
+        /* extract server:port part */
+        buf = strdup( spec + strlen(HTTP_PROXY_PREFIX));
+        buf[strcspn(buf, "/")] = '\0';
+    } else {
+        /* assume spec is aready "server:port" format */
+        buf = strdup( spec );
+    }
+    spec = buf;
+
+    /* check username in spec */
+    *user = NULL;
+    sep = strchr( spec, '@' );
+    if ( sep != NULL ) {
+        *sep = '\0';
+        *user = strdup( spec );
+        spec = sep +1;
+    }
+
+    /* split out hostname and port number from spec */
+    sep = strchr(spec,':');
+    *pport = port;                              /* default */
+    if ( sep != NULL ) {
+        /* hostname and port */
+        *pport = atoi(sep+1);
+        *sep = '\0';
+    }
+    *host = strdup( spec );
+    free(buf);
+}
+
+/* add relay server SPEC to the list of relay servers */
+void
+add_proxy_server( char *spec, u_short port )
+{
+    PROXY_SERVER *proxy;
+
+    proxy_list = realloc( proxy_list, sizeof(PROXY_SERVER) * (n_proxy_list+1) );
+    if ( proxy_list == NULL )
+        fatal("Cannot allocate memory for relay servers.\n");
+    proxy = &proxy_list[n_proxy_list++];
+    memset( proxy, 0, sizeof(*proxy) );
+    parse_relay_spec( spec, port, &proxy->host, &proxy->port, &proxy->user );
+}
+
+/* add relay server SPEC of METHOD to be passed through before the
+   last one given */
+void
+add_relay_hop( int method, char *spec )
+{
+    RELAY *hop;
+
+    relay_chain = realloc( relay_chain, sizeof(RELAY) * (n_relay_chain+1) );
+    if ( relay_chain == NULL )
+        fatal("Cannot allocate memory for relay servers.\n");
+    hop = &relay_chain[n_relay_chain++];
+    hop->method = method;
+    hop->auth_type = PROXY_AUTH_NONE;
+    parse_relay_spec( spec, (method == METHOD_SOCKS)? 1080:
+                      (method == METHOD_HTTP)? 80: 23,
+                      &hop->host, &hop->port, &hop->user );
+}
+
 /* set_relay()
    Determine relay informations:
    method, host, port, and username.
@@ -1333,16 +2419,23 @@ determine_relay_password ()
    use 1080 for METHOD_SOCKS method.
    Username is also able to given by 3rd. format.
    2nd argument SPEC can be NULL. if NULL, use environment variable.
+   SPEC can be a list of them separated by comma or space, then the
+   first one is set and others are kept in proxy_list.
  */
 int
 set_relay( int method, char *spec )
 {
-    char *buf, *sep, *resolve;
+    char *buf, *resolve, *list;
+    int i;
 
     relay_method = method;
 
-    read_parameter_file();
-    initialize_direct_addr();
+    if ( config_cache_load() < 0 )
+        read_parameter_file();
+    list = direct_list_param();
+    if ( config_cache_load_direct( list ) < 0 )
+        initialize_direct_addr( list );
+    config_cache_save( list );
     if (n_direct_addr_list == 0) {
         debug ("No direct address are specified.\n");
     } else {
@@ -1406,39 +2499,31 @@ set_relay( int method, char *spec )
         relay_port = 23;                        /* set default first */
     }
 
-    if (expect( spec, HTTP_PROXY_PREFIX)) {
-        /* URL format like: "http://server:port/" */
-        /* extract server:port part */
-        buf = strdup( spec + strlen(HTTP_PROXY_PREFIX));
-        buf[strcspn(buf, "/")] = '\0';
-    } else {
-        /* assume spec is aready "server:port" format */
-        buf = strdup( spec );
-    }
-    spec = buf;
-
-    /* check username in spec */
-    sep = strchr( spec, '@' );
-    if ( sep != NULL ) {
-        *sep = '\0';
-        relay_user = strdup( spec );
-        spec = sep +1;
+    /* spec may be a list of servers separated by comma or space */
+    buf = strdup( spec );
+    for ( spec = strtok( buf, ", \t" ); spec != NULL;
+          spec = strtok( NULL, ", \t" ) )
+        add_proxy_server( spec, relay_port );
+    free( buf );
+    if ( n_proxy_list == 0 )
+        fatal("No relay server is given.\n");
+    for ( i = 0; i < n_proxy_list; i++ ) {
+        if ( proxy_list[i].user != NULL )
+            continue;
+        if ( relay_user == NULL )
+            relay_user = determine_relay_user();
+        proxy_list[i].user = relay_user;
     }
-    if (relay_user == NULL)
-        relay_user = determine_relay_user();
-
-    /* split out hostname and port number from spec */
-    sep = strchr(spec,':');
-    if ( sep == NULL ) {
-        /* hostname only, port is already set as default */
-        relay_host = strdup( spec );
-    } else {
-        /* hostname and port */
-        relay_port = atoi(sep+1);
-        *sep = '\0';
-        relay_host = strdup( spec );
+    for ( i = 0; i < n_relay_chain; i++ ) {
+        if ( relay_chain[i].user != NULL )
+            continue;
+        if ( relay_user == NULL )
+            relay_user = determine_relay_user();
+        relay_chain[i].user = relay_user;
     }
-    free(buf);
+    relay_host = proxy_list[0].host;
+    relay_port = proxy_list[0].port;
+    relay_user = proxy_list[0].user;
     return 0;
 }
 
@@ -1465,6 +2550,215 @@ resolve_port( const char *service )
     return (u_short)port;
 }
 
+/* parse size string like "65536", "64k" or "4m".
+   Returns size in bytes or -1 for invalid format or overflow. */
+long
+parse_size( const char *str )
+{
+    char *end;
+    long size, unit = 1;
+
+    errno = 0;
+    size = strtol( str, &end, 10 );
+    if ( end == str || size < 0 || errno == ERANGE )
+        return -1;
+    switch ( *end ) {
+    case 'k': case 'K':
+        unit = 1024;
+        end++;
+        break;
+    case 'm': case 'M':
+        unit = 1024*1024;
+        end++;
+        break;
+    }
+    if ( *end != '\0' || LONG_MAX / unit < size )
+        return -1;
+    return size * unit;
+}
+
+/* TCP options of relayed sockets, for the local and the remote side
+   each (option 'O', parameters CONNECT_TCP_LOCAL and
+   CONNECT_TCP_REMOTE).  Value is a comma separated list of:
+     interactive         nodelay,quickack,keepalive=60:10:6,notsent_lowat=16k
+     bulk                sndbuf=4m,rcvbuf=4m,notsent_lowat=128k
+     nodelay[=0|1]       TCP_NODELAY
+     quickack[=0|1]      TCP_QUICKACK, kept on after each read
+     sndbuf=SIZE         SO_SNDBUF
+     rcvbuf=SIZE         SO_RCVBUF
+     keepalive[=IDLE[:INTVL[:CNT]]]  SO_KEEPALIVE and its intervals,
+                         "keepalive=0" turns it off
+     notsent_lowat=SIZE  TCP_NOTSENT_LOWAT
+   Later items override earlier ones, so a preset can be adjusted like
+   "bulk,sndbuf=16m".  Options not given are left as system default. */
+typedef struct {
+    int nodelay;                                /* -1: unchanged */
+    int quickack;                               /* -1: unchanged */
+    long sndbuf, rcvbuf;                        /* 0: unchanged */
+    int keepalive;                              /* -1: unchanged */
+    int keepidle, keepintvl, keepcnt;           /* 0: unchanged */
+    long notsent_lowat;                         /* 0: unchanged */
+} TCP_TUNING;
+
+#define TCP_TUNING_DEFAULT      { -1, -1, 0, 0, -1, 0, 0, 0, 0 }
+TCP_TUNING tcp_local = TCP_TUNING_DEFAULT;
+TCP_TUNING tcp_remote = TCP_TUNING_DEFAULT;
+
+#define MAX_TCP_OPTION_ARGS     16
+char *tcp_option_args[MAX_TCP_OPTION_ARGS];     /* option 'O' */
+int n_tcp_option_args = 0;
+
+/* parse flag value of "name" or "name=0|1" */
+static int
+parse_tcp_flag( const char *value )
+{
+    if ( value == NULL )
+        return 1;
+    if ( strcmp( value, "0" ) == 0 )
+        return 0;
+    if ( strcmp( value, "1" ) == 0 )
+        return 1;
+    return -1;
+}
+
+/* parse one item of TCP option list into T.
+   Returns 0 for success or -1 for invalid item. */
+static int
+parse_tcp_item( TCP_TUNING *t, char *name )
+{
+    char *value = strchr( name, '=' );
+    long size;
+
+    if ( value != NULL )
+        *value++ = '\0';
+    if ( strcmp( name, "interactive" ) == 0 && value == NULL ) {
+        t->nodelay = 1;
+        t->quickack = 1;
+        t->keepalive = 1;
+        t->keepidle = 60;
+        t->keepintvl = 10;
+        t->keepcnt = 6;
+        t->notsent_lowat = 16*1024;
+    } else if ( strcmp( name, "bulk" ) == 0 && value == NULL ) {
+        t->sndbuf = 4*1024*1024;
+        t->rcvbuf = 4*1024*1024;
+        t->notsent_lowat = 128*1024;
+    } else if ( strcmp( name, "nodelay" ) == 0 ) {
+        if ( (t->nodelay = parse_tcp_flag( value )) < 0 )
+            return -1;
+    } else if ( strcmp( name, "quickack" ) == 0 ) {
+        if ( (t->quickack = parse_tcp_flag( value )) < 0 )
+            return -1;
+    } else if ( strcmp( name, "keepalive" ) == 0 ) {
+        if ( value == NULL || strcmp( value, "1" ) == 0 ) {
+            t->keepalive = 1;
+        } else if ( strcmp( value, "0" ) == 0 ) {
+            t->keepalive = 0;
+        } else {
+            t->keepintvl = t->keepcnt = 0;
+            if ( sscanf( value, "%d:%d:%d", &t->keepidle,
+                         &t->keepintvl, &t->keepcnt ) < 1 ||
+                 t->keepidle <= 0 || t->keepintvl < 0 || t->keepcnt < 0 )
+                return -1;
+            t->keepalive = 1;
+        }
+    } else if ( value == NULL || (size = parse_size( value )) <= 0 ) {
+        return -1;                              /* sizes need value */
+    } else if ( strcmp( name, "sndbuf" ) == 0 ) {
+        t->sndbuf = size;
+    } else if ( strcmp( name, "rcvbuf" ) == 0 ) {
+        t->rcvbuf = size;
+    } else if ( strcmp( name, "notsent_lowat" ) == 0 ) {
+        t->notsent_lowat = size;
+    } else {
+        return -1;
+    }
+    return 0;
+}
+
+/* parse comma separated TCP option list SPEC into T.
+   Returns 0 for success or -1 with error message. */
+int
+parse_tcp_tuning( TCP_TUNING *t, const char *spec )
+{
+    char buf[64], *end;
+    const char *ptr = spec;
+    int len;
+
+    while ( *ptr ) {
+        end = strchr( ptr, ',' );
+        len = (end == NULL)? (int)strlen( ptr ): (int)(end - ptr);
+        if ( 0 < len ) {
+            if ( (int)sizeof(buf) <= len )
+                len = sizeof(buf) - 1;
+            memcpy( buf, ptr, len );
+            buf[len] = '\0';
+            if ( parse_tcp_item( t, buf ) < 0 ) {
+                error("invalid TCP option: %.*s\n", len, ptr);
+                return -1;
+            }
+        }
+        ptr += len;
+        if ( *ptr == ',' )
+            ptr++;
+    }
+    return 0;
+}
+
+/* apply tuning T to socket S, failures are only reported */
+void
+apply_tcp_tuning( SOCKET s, TCP_TUNING *t )
+{
+    int val;
+
+#define SET_TCP_OPTION(level, name, value)                              \
+    do { val = (value);                                                 \
+        if ( setsockopt( s, level, name, (void*)&val, sizeof(val) ) < 0 ) \
+            debug("setsockopt(%s) failed, errno=%d\n", #name,          \
+                  socket_errno()); } while (0)
+
+    if ( 0 <= t->nodelay )
+        SET_TCP_OPTION( IPPROTO_TCP, TCP_NODELAY, t->nodelay );
+#ifdef TCP_QUICKACK
+    if ( 0 <= t->quickack )
+        SET_TCP_OPTION( IPPROTO_TCP, TCP_QUICKACK, t->quickack );
+#endif /* TCP_QUICKACK */
+    if ( 0 < t->sndbuf )
+        SET_TCP_OPTION( SOL_SOCKET, SO_SNDBUF, t->sndbuf );
+    if ( 0 < t->rcvbuf )
+        SET_TCP_OPTION( SOL_SOCKET, SO_RCVBUF, t->rcvbuf );
+    if ( 0 <= t->keepalive )
+        SET_TCP_OPTION( SOL_SOCKET, SO_KEEPALIVE, t->keepalive );
+#ifdef TCP_KEEPIDLE
+    if ( 0 < t->keepalive && 0 < t->keepidle )
+        SET_TCP_OPTION( IPPROTO_TCP, TCP_KEEPIDLE, t->keepidle );
+#endif /* TCP_KEEPIDLE */
+#ifdef TCP_KEEPINTVL
+    if ( 0 < t->keepalive && 0 < t->keepintvl )
+        SET_TCP_OPTION( IPPROTO_TCP, TCP_KEEPINTVL, t->keepintvl );
+#endif /* TCP_KEEPINTVL */
+#ifdef TCP_KEEPCNT
+    if ( 0 < t->keepalive && 0 < t->keepcnt )
+        SET_TCP_OPTION( IPPROTO_TCP, TCP_KEEPCNT, t->keepcnt );
+#endif /* TCP_KEEPCNT */
+#ifdef TCP_NOTSENT_LOWAT
+    if ( 0 < t->notsent_lowat )
+        SET_TCP_OPTION( IPPROTO_TCP, TCP_NOTSENT_LOWAT, t->notsent_lowat );
+#endif /* TCP_NOTSENT_LOWAT */
+#undef SET_TCP_OPTION
+}
+
+/* TCP_QUICKACK is cleared by the kernel, re-arm after reading */
+#ifdef TCP_QUICKACK
+#define tcp_quickack(s, t)                                              \
+    do { if ( 0 < (t)->quickack ) {                                     \
+            int on_ = 1;                                                \
+            setsockopt( s, IPPROTO_TCP, TCP_QUICKACK,                   \
+                        (void*)&on_, sizeof(on_) ); } } while (0)
+#else
+#define tcp_quickack(s, t)      do { } while (0)
+#endif /* TCP_QUICKACK */
+
 void
 make_revstr(void)
 {
@@ -1485,9 +2779,10 @@ make_revstr(void)
 int
 getarg( int argc, char **argv )
 {
-    int err = 0;
+    int err = 0, i;
     char *ptr, *server = (char*)NULL;
     int method = METHOD_DIRECT;
+    long bufsize = 0;
 
     progname = *argv;
     argc--, argv++;
@@ -1515,6 +2810,8 @@ getarg( int argc, char **argv )
             case 'S':                           /* specify SOCKS server */
                 if ( 1 < argc ) {
                     argv++, argc--;
+                    if ( server != NULL )       /* previous one is a hop */
+                        add_relay_hop( method, server );
                     method = METHOD_SOCKS;
                     server = *argv;
                 } else {
@@ -1526,6 +2823,8 @@ getarg( int argc, char **argv )
             case 'H':                           /* specify http-proxy server */
                 if ( 1 < argc ) {
                     argv++, argc--;
+                    if ( server != NULL )       /* previous one is a hop */
+                        add_relay_hop( method, server );
                     method = METHOD_HTTP;
                     server = *argv;
                 } else {
@@ -1536,6 +2835,8 @@ getarg( int argc, char **argv )
             case 'T':                           /* specify telnet proxy server */
                 if ( 1 < argc ) {
                     argv++, argc--;
+                    if ( server != NULL )       /* previous one is a hop */
+                        add_relay_hop( method, server );
                     method = METHOD_TELNET;
                     server = *argv;
                 } else {
@@ -1569,6 +2870,52 @@ getarg( int argc, char **argv )
                 break;
 
 #ifndef _WIN32
+            case 'D':                           /* serve many clients */
+                if ( 1 < argc ) {
+                    argv++, argc--;
+                    local_type = LOCAL_SOCKET;
+                    local_port = resolve_port(*argv);
+                    f_daemon = 1;
+                } else {
+                    error("option '-%c' needs argument.\n", *ptr);
+                    err++;
+                }
+                break;
+
+            case 'F':                           /* SOCKS5/HTTP server */
+                if ( 1 < argc ) {
+                    argv++, argc--;
+                    local_type = LOCAL_SOCKET;
+                    local_port = resolve_port(*argv);
+                    f_daemon = 1;
+                    f_frontend = 1;
+                } else {
+                    error("option '-%c' needs argument.\n", *ptr);
+                    err++;
+                }
+                break;
+
+            case 'A':                           /* credential agent */
+                if ( 1 < argc ) {
+                    argv++, argc--;
+                    agent_path = *argv;
+                } else {
+                    error("option '-%c' needs argument.\n", *ptr);
+                    err++;
+                }
+                break;
+
+            case 'U':                           /* resident for launchers */
+                if ( 1 < argc ) {
+                    argv++, argc--;
+                    resident_path = *argv;
+                    f_daemon = 1;
+                } else {
+                    error("option '-%c' needs argument.\n", *ptr);
+                    err++;
+                }
+                break;
+
             case 'w':
                 if ( 1 < argc ) {
                     argv++, argc--;
@@ -1608,14 +2955,38 @@ getarg( int argc, char **argv )
                 }
                 break;
 
-            case 'V':                           /* print version */
-                fprintf(stderr, "%s\nVersion %s\n", progdesc, revstr);
-                exit(0);
-
-            case 'd':                           /* debug mode */
-                f_debug++;
-                break;
-
+            case 'B':                           /* relay buffer size */
+                if ( 1 < argc ) {
+                    argv++, argc--;
+                    bufsize = parse_size( *argv );
+                    if ( bufsize < 0 ) {
+                        error("invalid buffer size: %s\n", *argv);
+                        err++;
+                    }
+                } else {
+                    error("option '-%c' needs argument.\n", *ptr);
+                    err++;
+                }
+                break;
+
+            case 'O':                           /* TCP options */
+                if ( 1 < argc && n_tcp_option_args < MAX_TCP_OPTION_ARGS ) {
+                    argv++, argc--;
+                    tcp_option_args[n_tcp_option_args++] = *argv;
+                } else {
+                    error("option '-%c' needs argument.\n", *ptr);
+                    err++;
+                }
+                break;
+
+            case 'V':                           /* print version */
+                fprintf(stderr, "%s\nVersion %s\n", progdesc, revstr);
+                exit(0);
+
+            case 'd':                           /* debug mode */
+                f_debug++;
+                break;
+
             default:
                 error("unknown option '-%c'\n", *ptr);
                 err++;
@@ -1631,7 +3002,67 @@ getarg( int argc, char **argv )
 
     set_relay( method, server );
 
-    /* check destination HOST (MUST) */
+    /* TCP options, command line overrides parameters */
+    if ( (ptr = getparam(ENV_CONNECT_TCP_LOCAL)) != NULL &&
+         parse_tcp_tuning( &tcp_local, ptr ) < 0 )
+        err++;
+    if ( (ptr = getparam(ENV_CONNECT_TCP_REMOTE)) != NULL &&
+         parse_tcp_tuning( &tcp_remote, ptr ) < 0 )
+        err++;
+    for ( i = 0; i < n_tcp_option_args; i++ ) {
+        ptr = tcp_option_args[i];
+        if ( strncmp( ptr, "local:", 6 ) == 0 ) {
+            err += parse_tcp_tuning( &tcp_local, ptr+6 ) < 0;
+        } else if ( strncmp( ptr, "remote:", 7 ) == 0 ) {
+            err += parse_tcp_tuning( &tcp_remote, ptr+7 ) < 0;
+        } else if ( parse_tcp_tuning( &tcp_local, ptr ) < 0 ) {
+            err++;
+        } else {
+            parse_tcp_tuning( &tcp_remote, ptr );
+        }
+    }
+    if ( 0 < err )
+        goto quit;
+
+    /* decide relay buffer size */
+    if ( bufsize == 0 && (ptr = getparam(ENV_CONNECT_BUFFER_SIZE)) ) {
+        bufsize = parse_size( ptr );
+        if ( bufsize < 0 ) {
+            error("invalid %s: %s\n", ENV_CONNECT_BUFFER_SIZE, ptr);
+            err++;
+            goto quit;
+        }
+    }
+    if ( bufsize == 0 )
+        bufsize = RELAY_BUFSIZ_DEFAULT;
+    if ( bufsize < RELAY_BUFSIZ_MIN || RELAY_BUFSIZ_MAX < bufsize ) {
+        error("relay buffer size must be %d to %d bytes.\n",
+              RELAY_BUFSIZ_MIN, RELAY_BUFSIZ_MAX);
+        err++;
+        goto quit;
+    }
+    relay_bufsize = bufsize;                    /* in range of int */
+
+    /* decide spill buffer size for holding session */
+    if ( (ptr = getparam(ENV_CONNECT_SPILL_MEMORY)) != NULL &&
+         (spill_memory = parse_size( ptr )) < 0 ) {
+        error("invalid %s: %s\n", ENV_CONNECT_SPILL_MEMORY, ptr);
+        err++;
+        goto quit;
+    }
+    if ( (ptr = getparam(ENV_CONNECT_SPILL_SIZE)) != NULL &&
+         (spill_max = parse_size( ptr )) < 0 ) {
+        error("invalid %s: %s\n", ENV_CONNECT_SPILL_SIZE, ptr);
+        err++;
+        goto quit;
+    }
+
+    /* check destination HOST (MUST), resident and front-end get it
+       from clients */
+    if ( argc == 0 && (resident_path != NULL || f_frontend) )
+        goto check_relay;
+    if ( argc == 0 && agent_path != NULL )
+        goto quit;                              /* no relaying */
     if ( argc == 0  ) {
         fprintf(stderr, "%s\nVersion %s\n", progdesc, revstr);
         fprintf(stderr, usage, progname);
@@ -1664,6 +3095,7 @@ getarg( int argc, char **argv )
         err++;
         goto quit;
     }
+check_relay:
     if ( (relay_method != METHOD_DIRECT) && (relay_port <= 0) ) {
         error("Invalid relay port: %d\n", dest_port);
         err++;
@@ -1679,19 +3111,34 @@ quit:
         debug("relay_port=%d\n", relay_port);
         debug("relay_user=%s\n", relay_user);
     }
+    for ( i = 0; i < n_relay_chain; i++ )
+        debug("hop %d: %s %s@%s:%d\n", i+1,
+              method_names[relay_chain[i].method], relay_chain[i].user,
+              relay_chain[i].host, relay_chain[i].port);
     if ( relay_method == METHOD_SOCKS ) {
         debug("socks_version=%d\n", socks_version);
         debug("socks_resolve=%s (%d)\n",
               resolve_names[socks_resolve], socks_resolve);
     }
+    debug("relay_bufsize=%d\n", relay_bufsize);
     debug("local_type=%s\n", local_type_names[local_type]);
     if ( local_type == LOCAL_SOCKET ) {
         debug("local_port=%d\n", local_port);
         if (f_hold_session)
             debug ("  with holding remote session.\n");
+        if (f_daemon)
+            debug ("  as daemon serving many clients.\n");
+        if (f_frontend)
+            debug ("  as SOCKS5 and HTTP proxy server.\n");
+    }
+    if ( resident_path != NULL )
+        debug("resident at %s\n", resident_path);
+    if ( agent_path != NULL )
+        debug("credential agent at %s\n", agent_path);
+    if ( dest_host != NULL ) {
+        debug("dest_host=%s\n", dest_host);
+        debug("dest_port=%d\n", dest_port);
     }
-    debug("dest_host=%s\n", dest_host);
-    debug("dest_port=%d\n", dest_port);
     if ( 0 < err ) {
         fprintf(stderr, usage, progname);
         exit(1);
@@ -1699,97 +3146,520 @@ quit:
     return 0;
 }
 
-#ifndef _WIN32
-/* Time-out feature is not allowed for Win32 native compilers. */
-/* MSVC and Borland C cannot but Cygwin and UNIXes can. */
+#if !defined(_WIN32) && !defined(__CYGWIN32__)
+void
+switch_ns (struct sockaddr_in *ns)
+{
+    res_init();
+    memcpy (&_res.nsaddr_list[0], ns, sizeof(*ns));
+    _res.nscount = 1;
+    debug("Using nameserver at %s\n", inet_ntoa(ns->sin_addr));
+}
+#endif /* !_WIN32 && !__CYGWIN32__ */
+
+/* TODO: fallback if askpass execution failed.
+ */
+
+/** METRICS **/
+
+/* Timing and counters of a connection, written as one line of JSON
+   per session to CONNECT_METRICS.  Phases are marked in order while
+   making the connection, the time since the previous mark is added
+   to the named phase. */
+#define MAX_METRICS_PHASES      8
+
+typedef struct {
+    long start;                                 /* beginning of connect */
+    long mark;                                  /* end of last phase */
+    int method;                                 /* relay method used */
+    char dest_host[256];                        /* destination of session */
+    u_short dest_port;
+    int n_phases;
+    struct {
+        const char *name;
+        long ms;
+    } phases[MAX_METRICS_PHASES];
+    double bytes_up;                            /* local => remote */
+    double bytes_down;                          /* remote => local */
+    long stall_up, stall_down;                  /* ms with full buffer */
+    long stall_up_since, stall_down_since;      /* 0 if not stalled */
+} METRICS;
+
+METRICS conn_metrics;                           /* connection being made */
+volatile int f_metrics_dump = 0;                /* SIGUSR1 received */
+int metrics_fd = -2;                            /* sink, -2: not opened */
+int metrics_is_socket = 0;
+
+/* milli-seconds clock for deadlines */
+long
+now_msec( void )
+{
+#ifdef _WIN32
+    return (long)GetTickCount();
+#else
+    struct timeval tv;
+    gettimeofday( &tv, NULL );
+    return tv.tv_sec * 1000L + tv.tv_usec / 1000;
+#endif /* !_WIN32 */
+}
 
-/* timeout signal hander */
 void
-sig_timeout(void)
+metrics_begin( METRICS *m )
 {
-    signal( SIGALRM, SIG_IGN );
-    alarm( 0 );
-    error( "timed out\n" );
-    exit(1);
+    memset( m, 0, sizeof(*m) );
+    m->start = m->mark = now_msec();
+    snprintf( m->dest_host, sizeof(m->dest_host), "%s",
+              (dest_host != NULL)? dest_host: "" );
+    m->dest_port = dest_port;
 }
 
-/* set timeout param = seconds, 0 clears */
+/* close phase NAME at now */
 void
-set_timeout(int timeout)
+metrics_phase( METRICS *m, const char *name )
 {
-    /* This feature is allowed for UNIX or cygwin environments, currently */
-    if ( timeout == 0 ) {
-        debug( "clearing timeout\n" );
-        signal( SIGALRM, SIG_IGN );
-        alarm( 0 );
-    } else {
-        debug( "setting timeout: %d seconds\n", timeout );
-        signal(SIGALRM, (void *)sig_timeout);
-        alarm( timeout );
+    long now = now_msec();
+    int i;
+
+    for ( i = 0; i < m->n_phases; i++ )
+        if ( strcmp( m->phases[i].name, name ) == 0 )
+            break;                              /* retried phase */
+    if ( i == m->n_phases ) {
+        if ( MAX_METRICS_PHASES <= i )
+            return;
+        m->phases[i].name = name;
+        m->phases[i].ms = 0;
+        m->n_phases++;
     }
+    m->phases[i].ms += now - m->mark;
+    m->mark = now;
 }
-#endif
 
-#if !defined(_WIN32) && !defined(__CYGWIN32__)
+/* account time stalled with a full buffer.
+   Clock is read only when the state changes. */
 void
-switch_ns (struct sockaddr_in *ns)
+metrics_stall( long *since, long *total, int full )
 {
-    res_init();
-    memcpy (&_res.nsaddr_list[0], ns, sizeof(*ns));
-    _res.nscount = 1;
-    debug("Using nameserver at %s\n", inet_ntoa(ns->sin_addr));
+    if ( full && *since == 0 ) {
+        *since = now_msec();
+    } else if ( !full && *since != 0 ) {
+        *total += now_msec() - *since;
+        *since = 0;
+    }
 }
-#endif /* !_WIN32 && !__CYGWIN32__ */
 
-/* TODO: IPv6
-   TODO: fallback if askpass execution failed.
- */
+#ifndef _WIN32
+void
+sig_metrics( int sig )
+{
+    f_metrics_dump = 1;
+    signal( SIGUSR1, sig_metrics );             /* for SysV signal() */
+}
+#endif /* !_WIN32 */
 
+/* open the sink named by CONNECT_METRICS.
+   Returns descriptor or -1 if not available. */
 int
-local_resolve (const char *host, struct sockaddr_in *addr)
+metrics_open( void )
 {
-    struct hostent *ent;
-    if ( strspn(host, dotdigits) == strlen(host) ) {
-        /* given by IPv4 address */
-        addr->sin_family = AF_INET;
-        addr->sin_addr.s_addr = inet_addr(host);
+    const char *name = getparam( ENV_CONNECT_METRICS );
+    int fd;
+
+    if ( name == NULL || *name == '\0' )
+        return -1;
+    if ( strcmp( name, "-" ) == 0 )
+        return 2;                               /* stderr */
+#ifndef _WIN32
+    if ( strncmp( name, "unix:", 5 ) == 0 ) {
+        struct sockaddr_un sun;
+        name += 5;
+        if ( sizeof(sun.sun_path) <= strlen(name) ) {
+            error("too long socket path for metrics: %s\n", name);
+            return -1;
+        }
+        memset( &sun, 0, sizeof(sun) );
+        sun.sun_family = AF_UNIX;
+        strcpy( sun.sun_path, name );
+        fd = socket( AF_UNIX, SOCK_STREAM, 0 );
+        if ( fd < 0 )
+            return -1;
+        if ( connect( fd, (struct sockaddr *)&sun, sizeof(sun) ) < 0 ) {
+            debug("cannot connect to metrics socket %s, errno=%d\n",
+                  name, errno);
+            close( fd );
+            return -1;
+        }
+        fcntl( fd, F_SETFL, fcntl( fd, F_GETFL ) | O_NONBLOCK );
+        fcntl( fd, F_SETFD, FD_CLOEXEC );       /* never stall relay */
+        metrics_is_socket = 1;
+        return fd;
+    }
+#endif /* !_WIN32 */
+    fd = open( name, O_WRONLY|O_APPEND|O_CREAT, 0600 );
+    if ( fd < 0 )
+        error("cannot open metrics file %s, errno=%d\n", name, errno);
+    return fd;
+}
+
+/* append "host:port" of host as JSON string */
+static int
+metrics_put_addr( char *buf, int size, const char *key,
+                  const char *host, u_short port )
+{
+    int len = snprintf( buf, size, ",\"%s\":\"", key );
+    int n;
+    for ( n = 0; host != NULL && *host && n < 256; host++, n++ ) {
+        if ( *host == '"' || *host == '\\' )
+            buf[len++] = '\\';
+        if ( (unsigned char)*host < ' ' )
+            continue;                           /* never in host name */
+        buf[len++] = *host;
+    }
+    return len + snprintf( buf+len, size-len, ":%d\"", port );
+}
+
+/* write one line of metrics M of session ID.  ACTIVE is true when
+   dumping alive session, then REASON is not meaningful. */
+void
+metrics_emit( METRICS *m, int id, SOCKET remote, int reason, int active )
+{
+    static const char *reason_names[] = {
+        "unsupported", "unknown", "error", "local", "remote" };
+    char buf[2048];
+    long now = now_msec();
+    int i, len, fd, ret;
+
+    if ( metrics_fd == -2 )
+        metrics_fd = metrics_open();
+    fd = metrics_fd;
+    if ( fd < 0 ) {
+        if ( !active )
+            return;
+        fd = 2;                                 /* dump is requested */
+    }
+    len = snprintf( buf, sizeof(buf),
+                    "{\"session\":%d,\"pid\":%d,\"time\":%ld,"
+                    "\"state\":\"%s\",\"method\":\"%s\"",
+                    id, (int)getpid(), (long)time(NULL),
+                    active? "active": "closed", method_names[m->method] );
+    if ( m->method != METHOD_DIRECT )
+        len += metrics_put_addr( buf+len, sizeof(buf)-len, "relay",
+                                 relay_host, relay_port );
+    len += metrics_put_addr( buf+len, sizeof(buf)-len, "dest",
+                             m->dest_host, m->dest_port );
+    len += snprintf( buf+len, sizeof(buf)-len, ",\"phases\":{" );
+    for ( i = 0; i < m->n_phases; i++ )
+        len += snprintf( buf+len, sizeof(buf)-len, "%s\"%s\":%ld",
+                         (i? ",": ""), m->phases[i].name, m->phases[i].ms );
+    len += snprintf( buf+len, sizeof(buf)-len,
+                     "},\"bytes_up\":%.0f,\"bytes_down\":%.0f,"
+                     "\"stall_up_ms\":%ld,\"stall_down_ms\":%ld,"
+                     "\"duration_ms\":%ld",
+                     m->bytes_up, m->bytes_down,
+                     m->stall_up + (m->stall_up_since?
+                                    now - m->stall_up_since: 0),
+                     m->stall_down + (m->stall_down_since?
+                                      now - m->stall_down_since: 0),
+                     now - m->start );
+#ifdef TCP_INFO
+    if ( remote != SOCKET_ERROR ) {
+        struct tcp_info ti;
+        socklen_t tlen = sizeof(ti);
+        if ( getsockopt( remote, IPPROTO_TCP, TCP_INFO, &ti, &tlen ) == 0 )
+            len += snprintf( buf+len, sizeof(buf)-len,
+                             ",\"rtt_us\":%u,\"rttvar_us\":%u",
+                             ti.tcpi_rtt, ti.tcpi_rttvar );
+    }
+#endif /* TCP_INFO */
+    if ( !active )
+        len += snprintf( buf+len, sizeof(buf)-len, ",\"close\":\"%s\"",
+                         reason_names[reason - REASON_UNSUPPORTED] );
+    if ( sizeof(buf) - 2 < (size_t)len )
+        len = sizeof(buf) - 2;                  /* truncated */
+    buf[len++] = '}';
+    buf[len++] = '\n';
+#ifdef MSG_NOSIGNAL
+    if ( fd == metrics_fd && metrics_is_socket )
+        ret = send( fd, buf, len, MSG_NOSIGNAL );
+    else
+#endif /* MSG_NOSIGNAL */
+    ret = write( fd, buf, len );
+    if ( ret < 0 && fd == metrics_fd && errno != EAGAIN ) {
+        debug("writing metrics failed, errno=%d\n", errno);
+        if ( fd != 2 )
+            close( fd );
+        metrics_fd = -2;                        /* reopen next time */
+        metrics_is_socket = 0;
+    }
+}
+
+
+/** DNS CACHE **/
+
+/* Resolved addresses are kept in a small file mapped into memory and
+   shared by all invocations, so a relay host is not resolved again
+   and again while its records live.  The file is a fixed table of
+   DNS_CACHE_SLOTS entries hashed by host name, each entry expires in
+   CONNECT_DNS_CACHE_TTL (default DNS_CACHE_DEFAULT_TTL) seconds.  The
+   resolver does not tell TTL of the answer, and asking DNS for it
+   would cost the round trips the cache is to save.  Readers and
+   writers lock the file with fcntl().  It is enabled by the parameter
+   CONNECT_DNS_CACHE. */
+#define MAX_CONNECT_ADDRS       16
+
+typedef struct {
+    int len;
+    union {
+        struct sockaddr sa;
+        struct sockaddr_in in;
+#ifdef AF_INET6
+        struct sockaddr_in6 in6;
+#endif /* AF_INET6 */
+    } u;
+} CONNECT_ADDR;
+
+#ifdef WITH_DNS_CACHE
+#define DNS_CACHE_MAGIC         0x434e4443      /* "CNDC" */
+#define DNS_CACHE_SLOTS         256
+#define DNS_CACHE_PROBE         8               /* max probe length */
+#define DNS_CACHE_ADDRS         8               /* addresses per entry */
+#define DNS_CACHE_DEFAULT_TTL   60              /* seconds */
+#define DNS_CACHE_FILE          ".cache/connect/dns"
+
+typedef struct {
+    char name[256];                             /* lower case host name */
+    long expire;                                /* time() to expire */
+    int n_addrs;
+    CONNECT_ADDR addrs[DNS_CACHE_ADDRS];        /* port is 0 */
+} DNS_CACHE_ENTRY;
+
+typedef struct {
+    int magic;
+    int entry_size;                             /* to detect layout change */
+    DNS_CACHE_ENTRY slots[DNS_CACHE_SLOTS];
+} DNS_CACHE;
+
+DNS_CACHE *dns_cache = NULL;
+int dns_cache_fd = -1;
+int dns_cache_ttl = DNS_CACHE_DEFAULT_TTL;
+
+/* lock whole cache file, TYPE is F_RDLCK, F_WRLCK or F_UNLCK */
+static int
+dns_cache_lock( int type )
+{
+    struct flock fl;
+    memset( &fl, 0, sizeof(fl) );
+    fl.l_type = type;
+    fl.l_whence = SEEK_SET;
+    return fcntl( dns_cache_fd, F_SETLKW, &fl );
+}
+
+/* open and map cache file if enabled. Returns 0 if available. */
+int
+dns_cache_open( void )
+{
+    static int tried = 0;
+    struct stat st;
+    char *param, *path;
+    void *map;
+
+    if ( tried )
+        return (dns_cache != NULL)? 0: -1;
+    tried = 1;
+    param = getparam(ENV_CONNECT_DNS_CACHE);
+    if ( param != NULL && strchr( param, '/' ) != NULL ) {
+        path = strdup( param );                 /* given file name */
+    } else if ( getparam_bool(ENV_CONNECT_DNS_CACHE, 0) ) {
+        path = home_path( DNS_CACHE_FILE );     /* default location */
     } else {
-        debug("resolving host by name: %s\n", host);
-        ent = gethostbyname (host);
-        if ( ent ) {
-            memcpy (&addr->sin_addr, ent->h_addr, ent->h_length);
-            addr->sin_family = ent->h_addrtype;
-            debug("resolved: %s (%s)\n",
-                  host, inet_ntoa(addr->sin_addr));
-        } else {
-            debug("failed to resolve locally.\n");
-            return -1;                          /* failed */
+        return -1;                              /* disabled */
+    }
+    if ( (param = getparam(ENV_CONNECT_DNS_CACHE_TTL)) != NULL &&
+         (dns_cache_ttl = atoi( param )) <= 0 )
+        fatal("invalid %s: %s\n", ENV_CONNECT_DNS_CACHE_TTL, param);
+    make_parent_dirs( path );
+    dns_cache_fd = open( path, O_RDWR|O_CREAT, 0600 );
+    if ( dns_cache_fd < 0 ) {
+        debug("cannot open DNS cache %s, errno=%d\n", path, errno);
+        free( path );
+        return -1;
+    }
+    fcntl( dns_cache_fd, F_SETFD, FD_CLOEXEC );
+    if ( fstat( dns_cache_fd, &st ) < 0 ||
+         (st.st_size < (off_t)sizeof(DNS_CACHE) &&
+          ftruncate( dns_cache_fd, sizeof(DNS_CACHE) ) < 0) ||
+         (map = mmap( NULL, sizeof(DNS_CACHE), PROT_READ|PROT_WRITE,
+                      MAP_SHARED, dns_cache_fd, 0 )) == MAP_FAILED ) {
+        debug("cannot map DNS cache %s, errno=%d\n", path, errno);
+        close( dns_cache_fd );
+        dns_cache_fd = -1;
+        free( path );
+        return -1;
+    }
+    dns_cache = map;
+    debug("using DNS cache: %s\n", path);
+    free( path );
+    dns_cache_lock( F_WRLCK );
+    if ( dns_cache->magic != DNS_CACHE_MAGIC ||
+         dns_cache->entry_size != sizeof(DNS_CACHE_ENTRY) ) {
+        /* new or incompatible, start over */
+        memset( dns_cache, 0, sizeof(DNS_CACHE) );
+        dns_cache->magic = DNS_CACHE_MAGIC;
+        dns_cache->entry_size = sizeof(DNS_CACHE_ENTRY);
+    }
+    dns_cache_lock( F_UNLCK );
+    return 0;
+}
+
+/* find live entry of NAME and copy addresses into ADDRS.
+   Returns number of addresses or -1 if not cached. */
+int
+dns_cache_get( const char *name, CONNECT_ADDR *addrs, int max )
+{
+    DNS_CACHE_ENTRY *e;
+    unsigned int h;
+    int i, n = -1;
+
+    if ( dns_cache_open() < 0 || 255 < strlen(name) )
+        return -1;
+    h = str_hash( name );
+    dns_cache_lock( F_RDLCK );
+    for ( i = 0; i < DNS_CACHE_PROBE; i++ ) {
+        e = &dns_cache->slots[(h + i) % DNS_CACHE_SLOTS];
+        if ( strncmp( e->name, name, sizeof(e->name) ) != 0 )
+            continue;
+        if ( e->expire <= time(NULL) || e->n_addrs <= 0 ||
+             DNS_CACHE_ADDRS < e->n_addrs )
+            break;                              /* expired */
+        n = (e->n_addrs < max)? e->n_addrs: max;
+        memcpy( addrs, e->addrs, sizeof(CONNECT_ADDR) * n );
+        break;
+    }
+    dns_cache_lock( F_UNLCK );
+    if ( 0 <= n )
+        debug("DNS cache hit: %s\n", name);
+    return n;
+}
+
+/* store ADDRS of NAME valid for TTL seconds */
+void
+dns_cache_put( const char *name, CONNECT_ADDR *addrs, int n, long ttl )
+{
+    DNS_CACHE_ENTRY *e, *victim = NULL;
+    unsigned int h;
+    int i;
+
+    if ( dns_cache == NULL || ttl <= 0 || n <= 0 || 255 < strlen(name) )
+        return;
+    h = str_hash( name );
+    dns_cache_lock( F_WRLCK );
+    for ( i = 0; i < DNS_CACHE_PROBE; i++ ) {
+        e = &dns_cache->slots[(h + i) % DNS_CACHE_SLOTS];
+        if ( strncmp( e->name, name, sizeof(e->name) ) == 0 ) {
+            victim = e;                         /* update */
+            break;
         }
+        /* otherwise replace one expiring first */
+        if ( victim == NULL || e->expire < victim->expire )
+            victim = e;
     }
-    return 0;                                   /* good */
+    memset( victim, 0, sizeof(*victim) );
+    strcpy( victim->name, name );
+    victim->n_addrs = (n < DNS_CACHE_ADDRS)? n: DNS_CACHE_ADDRS;
+    memcpy( victim->addrs, addrs, sizeof(CONNECT_ADDR) * victim->n_addrs );
+    victim->expire = time(NULL) + ttl;
+    dns_cache_lock( F_UNLCK );
+    debug("DNS cache store: %s (ttl %ld)\n", name, ttl);
 }
 
+#endif /* WITH_DNS_CACHE */
+
+/* resolve HOST into ADDRS (port is 0) in the order of resolver,
+   using the DNS cache.  Returns number of addresses or -1. */
 int
-open_connection( const char *host, u_short port )
+resolve_host( const char *host, CONNECT_ADDR *addrs, int max )
 {
-    SOCKET s;
-    struct sockaddr_in saddr;
+    int n = 0;
+#ifdef WITH_GETADDRINFO
+    struct addrinfo hints, *res, *ai;
+    int err;
+#ifdef WITH_DNS_CACHE
+    char name[256];
+    int i;
 
-    /* resolve address of proxy or direct target */
-    if (local_resolve (host, &saddr) < 0) {
-        error("can't resolve hostname: %s\n", host);
-        return SOCKET_ERROR;
+    for ( i = 0; host[i] && i < (int)sizeof(name)-1; i++ )
+        name[i] = tolower( host[i] );
+    name[i] = '\0';
+    if ( (n = dns_cache_get( name, addrs, max )) > 0 )
+        return n;
+    n = 0;
+#endif /* WITH_DNS_CACHE */
+    memset( &hints, 0, sizeof(hints) );
+    hints.ai_family = AF_UNSPEC;
+    hints.ai_socktype = SOCK_STREAM;
+    debug("resolving host by name: %s\n", host);
+    if ( (err = getaddrinfo( host, NULL, &hints, &res )) != 0 ) {
+        debug("failed to resolve locally: %s\n", gai_strerror(err));
+        return -1;
+    }
+    for ( ai = res; ai != NULL && n < max; ai = ai->ai_next ) {
+        if ( ai->ai_addrlen > sizeof(addrs->u) )
+            continue;                           /* unknown family */
+        addrs[n].len = ai->ai_addrlen;
+        memcpy( &addrs[n].u, ai->ai_addr, ai->ai_addrlen );
+        n++;
     }
-    saddr.sin_port = htons(port);
+    freeaddrinfo( res );
+#ifdef WITH_DNS_CACHE
+    /* literal address is not worth caching */
+    if ( dns_cache_open() == 0 && strspn(host, dotdigits) != strlen(host) &&
+         strchr(host, ':') == NULL )
+        dns_cache_put( name, addrs, n, dns_cache_ttl );
+#endif /* WITH_DNS_CACHE */
+#else /* !WITH_GETADDRINFO */
+    struct hostent *ent;
+    char **p;
 
-    debug("connecting to %s:%u\n", inet_ntoa(saddr.sin_addr), port);
-    s = socket( AF_INET, SOCK_STREAM, 0 );
-    if ( connect( s, (struct sockaddr *)&saddr, sizeof(saddr))
-         == SOCKET_ERROR) {
-        debug( "connect() failed.\n");
-        return SOCKET_ERROR;
+    debug("resolving host by name: %s\n", host);
+    if ( (ent = gethostbyname( host )) == NULL ) {
+        debug("failed to resolve locally.\n");
+        return -1;                              /* failed */
     }
-    return s;
+    for ( p = ent->h_addr_list; *p != NULL && n < max; p++ ) {
+        memset( &addrs[n], 0, sizeof(CONNECT_ADDR) );
+        addrs[n].u.in.sin_family = AF_INET;
+        memcpy( &addrs[n].u.in.sin_addr, *p, sizeof(addrs[n].u.in.sin_addr) );
+        addrs[n].len = sizeof(addrs[n].u.in);
+        n++;
+    }
+#endif /* !WITH_GETADDRINFO */
+    return n;
+}
+
+int
+local_resolve (const char *host, struct sockaddr_in *addr)
+{
+    CONNECT_ADDR addrs[MAX_CONNECT_ADDRS];
+    int i, n;
+
+    if ( strspn(host, dotdigits) == strlen(host) ) {
+        /* given by IPv4 address */
+        addr->sin_family = AF_INET;
+        addr->sin_addr.s_addr = inet_addr(host);
+        return 0;
+    }
+    n = resolve_host( host, addrs, MAX_CONNECT_ADDRS );
+    for ( i = 0; i < n; i++ ) {
+        if ( addrs[i].u.sa.sa_family == AF_INET )
+            break;                              /* for SOCKS request */
+    }
+    if ( n <= i ) {
+        debug("failed to resolve locally.\n");
+        return -1;                              /* failed */
+    }
+    addr->sin_family = AF_INET;
+    addr->sin_addr = addrs[i].u.in.sin_addr;
+    debug("resolved: %s (%s)\n", host, inet_ntoa(addr->sin_addr));
+    return 0;                                   /* good */
 }
 
 void
@@ -1837,103 +3707,26 @@ report_bytes( char *prefix, char *buf, int len )
 {
     if ( ! f_debug )
         return;
-    debug( "%s", prefix );
-    while ( 0 < len ) {
-        fprintf( stderr, " %02x", *(unsigned char *)buf);
-        buf++;
-        len--;
-    }
-    fprintf(stderr, "\n");
-    return;
-}
-
-int
-atomic_out( SOCKET s, char *buf, int size )
-{
-    int ret, len;
-
-    assert( buf != NULL );
-    assert( 0<=size );
-    /* do atomic out */
-    ret = 0;
-    while ( 0 < size ) {
-        len = send( s, buf+ret, size, 0 );
-        if ( len == -1 )
-            fatal("atomic_out() failed to send(), %d\n", socket_errno());
-        ret += len;
-        size -= len;
-    }
-    if (!f_report) {
-        debug("atomic_out()  [some bytes]\n");
-        debug(">>> xx xx xx xx ...\n");
-    } else {
-        debug("atomic_out()  [%d bytes]\n", ret);
-        report_bytes(">>>", buf, ret);
-    }
-    return ret;
+    debug( "%s %d bytes\n", prefix, len );
+    hexdump( prefix, buf, len );
 }
 
-int
-atomic_in( SOCKET s, char *buf, int size )
-{
-    int ret, len;
-
-    assert( buf != NULL );
-    assert( 0<=size );
+/* Buffered reader for response of relay server.
+   Response is received in chunks instead of one-by-one, and bytes
+   over-read after the response are kept in line_reader for the next
+   hop or the relay session, see dial_finish() and line_reader_drain(). */
+typedef struct {
+    SOCKET sock;                                /* socket being read */
+    int ptr;                                    /* next char in buf */
+    int len;                                    /* end of valid data */
+    char buf[4096];
+} LINE_READER;
 
-    /* do atomic in */
-    ret = 0;
-    while ( 0 < size ) {
-        len = recv( s, buf+ret, size, 0 );
-        if ( len == -1 ) {
-            fatal("atomic_in() failed to recv(), %d\n", socket_errno());
-        } else if ( len == 0 ) {
-            fatal( "Connection closed by peer.\n");
-        }
-        ret += len;
-        size -= len;
-    }
-    if (!f_report) {
-        debug("atomic_in()  [some bytes]\n");
-        debug("<<< xx xx xx xx ...\n");
-    } else {
-        debug("atomic_in() [%d bytes]\n", ret);
-        report_bytes("<<<", buf, ret);
-    }
-    return ret;
-}
+LINE_READER line_reader = { INVALID_SOCKET, 0, 0 };
 
-int
-line_input( SOCKET s, char *buf, int size )
-{
-    char *dst = buf;
-    if ( size == 0 )
-        return 0;                               /* no error */
-    size--;
-    while ( 0 < size ) {
-        switch ( recv( s, dst, 1, 0) ) {        /* recv one-by-one */
-        case SOCKET_ERROR:
-            error("recv() error\n");
-            return -1;                          /* error */
-        case 0:
-            size = 0;                           /* end of stream */
-            break;
-        default:
-            /* continue reading until last 1 char is EOL? */
-            if ( *dst == '\n' ) {
-                /* finished */
-                size = 0;
-            } else {
-                /* more... */
-                size--;
-            }
-            dst++;
-        }
-    }
-    *dst = '\0';
-    report_text( "<<<", buf);
-    return 0;
-}
+/* bytes read ahead from S but not yet consumed */
+#define line_reader_pending(s) \
+    ((line_reader.sock == (s))? line_reader.len - line_reader.ptr: 0)
 
 /* cut_token()
    Span token in given string STR until char in DELIM is appeared.
@@ -1965,63 +3758,299 @@ lookup(int num, LOOKUP_ITEM *items)
     return "(unknown)";
 }
 
-/* readpass()
-   password input routine
-   Use ssh-askpass (same mechanism to OpenSSH)
-*/
+/* key of current relay server in allocated buffer */
 char *
-readpass( const char* prompt, ...)
+relay_key( void )
 {
-    static char buf[1000];                      /* XXX, don't be fix length */
-    va_list args;
-    va_start(args, prompt);
-    vsnprintf(buf, sizeof(buf), prompt, args);
-    va_end(args);
+    const char *user = (relay_user != NULL)? relay_user: "";
+    int size = strlen( user ) + strlen( relay_host ) + 8;
+    char *key = xmalloc( size );
 
-    if ( getparam(ENV_SSH_ASKPASS)
-#if !defined(_WIN32) && !defined(__CYGWIN32__)
-         && getenv("DISPLAY")
-#endif /* not _WIN32 && not __CYGWIN32__ */
-        ) {
-        /* use ssh-askpass to get password */
-        FILE *fp;
-        char *askpass = getparam(ENV_SSH_ASKPASS), *cmd;
-	int cmd_size = strlen(askpass) +1 +1 +strlen(buf) +1 +1;
-        cmd = xmalloc(cmd_size);
-        snprintf(cmd, cmd_size, "%s \"%s\"", askpass, buf);
-        fp = popen(cmd, "r");
-        free(cmd);
-        if ( fp == NULL )
-            return NULL;                        /* fail */
-        buf[0] = '\0';
-        if (fgets(buf, sizeof(buf), fp) == NULL)
-            return NULL;                        /* fail */
-        fclose(fp);
-    } else {
-        tty_readpass( buf, buf, sizeof(buf));
-    }
-    buf[strcspn(buf, "\r\n")] = '\0';
-    return buf;
+    snprintf( key, size, "%s@%s:%d", user, relay_host, relay_port );
+    return key;
 }
 
-static int
-socks5_do_auth_userpass( int s )
-{
-    unsigned char buf[1024], *ptr;
-    char *pass = NULL;
-    int len;
+/** CREDENTIAL AGENT **/
+
+/* With option 'A', the program runs as an agent keeping passwords of
+   relay servers, listening on a Unix domain socket of given path.  If
+   CONNECT_AGENT is set to the path, a password is asked to the agent
+   before prompting, and a prompted one is given to it, so the user is
+   asked once in CONNECT_AGENT_TTL seconds.  The agent answers only to
+   processes of the same user, and keeps passwords in locked memory
+   which is not swapped out nor dumped; the agent does not start if
+   the memory cannot be locked.  Requests are read into the locked
+   memory too.  It is kept small to fit the default RLIMIT_MEMLOCK
+   (64k on older systems).
+
+   A request is one line on a connection:
+     "GET KEY"            => "OK PASSWORD" or "NO"
+     "PUT KEY PASSWORD"   => "OK"
+     "DEL KEY"            => "OK"
+   where KEY is "user@host:port" of the relay server. */
+#define AGENT_TTL_DEFAULT       3600            /* seconds */
+#define AGENT_MAX_ENTRIES       32
+#define AGENT_LINE_MAX          1024
+#define AGENT_TIMEOUT           2               /* seconds to wait reply */
 
-    /* do User/Password authentication. */
-    /* This feature requires username and password from
+typedef struct {
+    char key[AGENT_LINE_MAX/2];
+    char pass[AGENT_LINE_MAX/2];
+    time_t expire;                              /* 0 if unused */
+} AGENT_ENTRY;
+
+typedef struct {
+    AGENT_ENTRY entries[AGENT_MAX_ENTRIES];
+    char line[AGENT_LINE_MAX];                  /* request being served */
+} AGENT_MEMORY;
+
+#ifndef _WIN32
+/* send request REQ to the agent and read reply line into REPLY.
+   Returns 0 on success, -1 if no agent. */
+int
+agent_request( const char *req, char *reply, int size )
+{
+    char *path = getparam( ENV_CONNECT_AGENT );
+    struct sockaddr_un name;
+    struct timeval tv;
+    int s, n, len = 0;
+
+    if ( path == NULL || sizeof(name.sun_path) <= strlen( path ) )
+        return -1;
+    memset( &name, 0, sizeof(name) );
+    name.sun_family = AF_UNIX;
+    strcpy( name.sun_path, path );
+    if ( (s = socket( AF_UNIX, SOCK_STREAM, 0 )) < 0 )
+        return -1;
+    tv.tv_sec = AGENT_TIMEOUT;                  /* never stuck by agent */
+    tv.tv_usec = 0;
+    setsockopt( s, SOL_SOCKET, SO_RCVTIMEO, (void *)&tv, sizeof(tv) );
+    if ( connect( s, (struct sockaddr *)&name, sizeof(name) ) < 0 ||
+         send( s, req, strlen( req ), 0 ) != (int)strlen( req ) ) {
+        debug("no credential agent at %s\n", path);
+        close( s );
+        return -1;
+    }
+    while ( len < size - 1 &&
+            (n = recv( s, reply + len, size - 1 - len, 0 )) > 0 ) {
+        len += n;
+        if ( memchr( reply, '\n', len ) != NULL )
+            break;
+    }
+    close( s );
+    reply[len] = '\0';
+    reply[strcspn( reply, "\r\n" )] = '\0';
+    return 0;
+}
+
+/* send request CMD with key of current relay server and ARG if any.
+   Returns same as agent_request(). */
+int
+agent_call( const char *cmd, const char *arg, char *reply, int size )
+{
+    char req[AGENT_LINE_MAX], *key = relay_key();
+    int ret = -1;
+
+    if ( snprintf( req, sizeof(req), "%s %s%s%s\n", cmd, key,
+                   (arg != NULL)? " ": "", (arg != NULL)? arg: "" )
+         < (int)sizeof(req) )
+        ret = agent_request( req, reply, size );
+    else
+        debug("too long request for credential agent: %s\n", key);
+    memset( req, 0, sizeof(req) );              /* may have password */
+    free( key );
+    return ret;
+}
+
+/* get password of current relay server from the agent, in allocated
+   buffer, or NULL if not kept. */
+char *
+agent_get( void )
+{
+    char reply[AGENT_LINE_MAX], *pass = NULL;
+
+    if ( agent_call( "GET", NULL, reply, sizeof(reply) ) == 0 &&
+         strncmp( reply, "OK ", 3 ) == 0 ) {
+        pass = strdup( reply + 3 );
+        debug("password is given by credential agent.\n");
+    }
+    memset( reply, 0, sizeof(reply) );
+    return pass;
+}
+
+/* give password PASS of current relay server to the agent */
+void
+agent_put( const char *pass )
+{
+    char reply[16];
+    agent_call( "PUT", pass, reply, sizeof(reply) );
+}
+
+/* tell the agent that password of current relay server was wrong */
+void
+agent_forget( void )
+{
+    char reply[16];
+    agent_call( "DEL", NULL, reply, sizeof(reply) );
+}
+#else /* _WIN32 */
+#define agent_get()             NULL            /* not supported */
+#define agent_put(pass)
+#define agent_forget()
+#endif /* _WIN32 */
+
+/* readpass()
+   password input routine
+   Use ssh-askpass (same mechanism to OpenSSH)
+*/
+char *
+readpass( const char* prompt, ...)
+{
+    static char buf[1000];                      /* XXX, don't be fix length */
+    va_list args;
+    va_start(args, prompt);
+    vsnprintf(buf, sizeof(buf), prompt, args);
+    va_end(args);
+
+    if ( getparam(ENV_SSH_ASKPASS)
+#if !defined(_WIN32) && !defined(__CYGWIN32__)
+         && getenv("DISPLAY")
+#endif /* not _WIN32 && not __CYGWIN32__ */
+        ) {
+        /* use ssh-askpass to get password */
+        FILE *fp;
+        char *askpass = getparam(ENV_SSH_ASKPASS), *cmd;
+	int cmd_size = strlen(askpass) +1 +1 +strlen(buf) +1 +1;
+        cmd = xmalloc(cmd_size);
+        snprintf(cmd, cmd_size, "%s \"%s\"", askpass, buf);
+        fp = popen(cmd, "r");
+        free(cmd);
+        if ( fp == NULL )
+            return NULL;                        /* fail */
+        buf[0] = '\0';
+        if (fgets(buf, sizeof(buf), fp) == NULL)
+            return NULL;                        /* fail */
+        fclose(fp);
+    } else {
+        tty_readpass( buf, buf, sizeof(buf));
+    }
+    buf[strcspn(buf, "\r\n")] = '\0';
+    return buf;
+}
+
+/* Passwords kept to authenticate following connections, for each
+   relay server by key "user@host:port", as the relay server changes
+   by hops and by failover among proxies. */
+#define MAX_KEPT_PASSWORDS      16
+
+typedef struct {
+    char *key;
+    char *pass;
+} KEPT_PASSWORD;
+
+KEPT_PASSWORD kept_passwords[MAX_KEPT_PASSWORDS];
+int n_kept_passwords = 0;
+
+/* kept password entry of current relay server, or NULL */
+KEPT_PASSWORD *
+kept_password( void )
+{
+    char *key = relay_key();
+    int i;
+
+    for ( i = 0; i < n_kept_passwords; i++ )
+        if ( strcmp( kept_passwords[i].key, key ) == 0 )
+            break;
+    free( key );
+    return (i < n_kept_passwords)? &kept_passwords[i]: NULL;
+}
+
+/* keep copy of password PASS of current relay server */
+void
+keep_password( const char *pass )
+{
+    KEPT_PASSWORD *k = kept_password();
+
+    if ( k == NULL ) {
+        if ( MAX_KEPT_PASSWORDS <= n_kept_passwords ) {
+            debug("too many passwords to keep.\n");
+            return;
+        }
+        k = &kept_passwords[n_kept_passwords++];
+        k->key = relay_key();
+    } else {
+        memset( k->pass, 0, strlen( k->pass ) );
+        free( k->pass );
+    }
+    k->pass = strdup( pass );
+}
+
+/* get_relay_password()
+   Returns password for relay server in allocated buffer which caller
+   should erase and free.  It is taken from parameter or asked with
+   PROMPT (formatted with user and host), asking the credential agent
+   before prompting.  The source is erased, but in
+   daemon mode a copy is kept to authenticate following connections,
+   and so is one sent without challenge, which may be asked again.
+*/
+char *
+get_relay_password( const char *prompt )
+{
+    KEPT_PASSWORD *k = kept_password();
+    char *pass, *copy;
+
+    if ( k != NULL )
+        return strdup( k->pass );
+    if ( (pass = determine_relay_password()) == NULL &&
+         (copy = agent_get()) != NULL ) {
+        if ( f_daemon || auth_cached )
+            keep_password( copy );
+        return copy;
+    }
+    if ( pass == NULL ) {
+        if ( (pass = readpass(prompt, relay_user, relay_host)) == NULL )
+            return NULL;
+        agent_put( pass );                      /* not to ask again */
+    }
+    copy = strdup( pass );
+    if ( f_daemon || auth_cached )
+        keep_password( pass );
+    memset( pass, 0, strlen(pass) );            /* erase source */
+    return copy;
+}
+
+/* password of current relay server was rejected, don't use it again */
+void
+forget_relay_password( void )
+{
+    KEPT_PASSWORD *k = kept_password();
+
+    agent_forget();
+    if ( k != NULL ) {
+        memset( k->pass, 0, strlen( k->pass ) );
+        free( k->pass );
+        free( k->key );
+        *k = kept_passwords[--n_kept_passwords];
+    }
+}
+
+/* make User/Password sub-negotiation message into BUF.
+   Returns length of message. */
+static int
+socks5_make_userpass( unsigned char *buf )
+{
+    unsigned char *ptr;
+    char *pass = NULL;
+    int len;
+
+    /* This feature requires username and password from
        command line argument or environment variable,
        or terminal. */
     if (relay_user == NULL)
         fatal("cannot determine user name.\n");
 
     /* get password from environment variable if exists. */
-    if ((pass=determine_relay_password()) == NULL &&
-        (pass=readpass("Enter SOCKS5 password for %s@%s: ",
-                       relay_user, relay_host)) == NULL)
+    if ((pass=get_relay_password("Enter SOCKS5 password for %s@%s: ")) == NULL)
         fatal("Cannot get password for user: %s\n", relay_user);
 
     /* make authentication packet */
@@ -2036,18 +4065,8 @@ socks5_do_auth_userpass( int s )
     strcpy( ptr, pass );
     ptr += len;
     memset (pass, 0, strlen(pass));             /* erase password */
-
-    /* send it and get answer */
-    f_report = 0;
-    atomic_out( s, buf, ptr-buf );
-    f_report = 1;
-    atomic_in( s, buf, 2 );
-
-    /* check status */
-    if ( buf[1] == 0 )
-        return 0;                               /* success */
-    else
-        return -1;                              /* fail */
+    free (pass);
+    return ptr - buf;
 }
 
 static const char *
@@ -2121,73 +4140,61 @@ socks5_auth_parse(char *start, unsigned char *auth_list, int max_auth){
     return i;
 }
 
-/* begin SOCKS5 relaying
-   And no authentication is supported.
- */
-int
-begin_socks5_relay( SOCKET s )
+/* make method selection message into BUF.
+   Offered methods are stored in AUTH_LIST and its number in N_AUTH.
+   Returns length of message. */
+static int
+socks5_make_greeting( unsigned char *buf,
+                      unsigned char *auth_list, int *n_auth )
 {
-    unsigned char buf[256], *ptr, *env = socks5_auth;
-    unsigned char n_auth = 0; unsigned char auth_list[10], auth_method;
-    int len, auth_result, i;
-
-    debug( "begin_socks_relay()\n");
+    unsigned char *ptr, *env = socks5_auth;
+    int i;
 
-    /* request authentication */
     ptr = buf;
     PUT_BYTE( ptr++, 5);                        /* SOCKS version (5) */
 
+    *n_auth = 0;
     if ( env == NULL )
         env = getparam(ENV_SOCKS5_AUTH);
     if ( env == NULL ) {
         /* add no-auth authentication */
-        auth_list[n_auth++] = SOCKS5_AUTH_NOAUTH;
+        auth_list[(*n_auth)++] = SOCKS5_AUTH_NOAUTH;
         /* add user/pass authentication */
-        auth_list[n_auth++] = SOCKS5_AUTH_USERPASS;
+        auth_list[(*n_auth)++] = SOCKS5_AUTH_USERPASS;
     } else {
-        n_auth = socks5_auth_parse(env, auth_list, 10);
+        *n_auth = socks5_auth_parse(env, auth_list, 10);
     }
-    PUT_BYTE( ptr++, n_auth);                   /* num auth */
-    for (i=0; i<n_auth; i++) {
+    PUT_BYTE( ptr++, *n_auth);                  /* num auth */
+    for (i=0; i<*n_auth; i++) {
         debug("available auth method[%d] = %s (0x%02x)\n",
               i, socks5_getauthname(auth_list[i]), auth_list[i]);
         PUT_BYTE( ptr++, auth_list[i]);         /* authentications */
     }
-    atomic_out( s, buf, ptr-buf );              /* send requst */
-    atomic_in( s, buf, 2 );                     /* recv response */
+    return ptr - buf;
+}
+
+/* check response of method selection in BUF.
+   Returns selected method or -1 if not acceptable. */
+static int
+socks5_check_method( unsigned char *buf )
+{
     if ( (buf[0] != 5) ||                       /* ver5 response */
          (buf[1] == 0xFF) ) {                   /* check auth method */
         error("No auth method accepted.\n");
         return -1;
     }
-    auth_method = buf[1];
-
-    debug("auth method: %s\n", socks5_getauthname(auth_method));
-
-    switch ( auth_method ) {
-    case SOCKS5_AUTH_REJECT:
-        error("No acceptable authentication method\n");
-        return -1;                              /* fail */
-
-    case SOCKS5_AUTH_NOAUTH:
-        /* nothing to do */
-        auth_result = 0;
-        break;
+    debug("auth method: %s\n", socks5_getauthname(buf[1]));
+    return buf[1];
+}
 
-    case SOCKS5_AUTH_USERPASS:
-        auth_result = socks5_do_auth_userpass(s);
-        break;
+/* make CONNECT request for destination into BUF.
+   Returns length of message. */
+static int
+socks5_make_connect( unsigned char *buf )
+{
+    unsigned char *ptr;
+    int len;
 
-    default:
-        error("Unsupported authentication method: %s\n",
-              socks5_getauthname( auth_method ));
-        return -1;                              /* fail */
-    }
-    if ( auth_result != 0 ) {
-        error("Authentication failed.\n");
-        return -1;
-    }
-    /* request to connect */
     ptr = buf;
     PUT_BYTE( ptr++, 5);                        /* SOCKS version (5) */
     PUT_BYTE( ptr++, 1);                        /* CMD: CONNECT */
@@ -2207,121 +4214,7 @@ begin_socks5_relay( SOCKET s )
     }
     PUT_BYTE( ptr++, dest_port>>8);     /* DST.PORT */
     PUT_BYTE( ptr++, dest_port&0xFF);
-    atomic_out( s, buf, ptr-buf);               /* send request */
-    atomic_in( s, buf, 4 );                     /* recv response */
-    if ( (buf[1] != SOCKS5_REP_SUCCEEDED) ) {   /* check reply code */
-        error("Got error response from SOCKS server: %d (%s).\n",
-              buf[1], lookup(buf[1], socks5_rep_names));
-        return -1;
-    }
-    ptr = buf + 4;
-    switch ( buf[3] ) {                         /* case by ATYP */
-    case 1:                                     /* IP v4 ADDR*/
-        atomic_in( s, ptr, 4+2 );               /* recv IPv4 addr and port */
-        break;
-    case 3:                                     /* DOMAINNAME */
-        atomic_in( s, ptr, 1 );                 /* recv name and port */
-        atomic_in( s, ptr+1, *(unsigned char*)ptr + 2);
-        break;
-    case 4:                                     /* IP v6 ADDR */
-        atomic_in( s, ptr, 16+2 );              /* recv IPv6 addr and port */
-        break;
-    }
-
-    /* Conguraturation, connected via SOCKS5 server! */
-    return 0;
-}
-
-/* begin SOCKS protocol 4 relaying
-   And no authentication is supported.
-
-   There's SOCKS protocol version 4 and 4a. Protocol version
-   4a has capability to resolve hostname by SOCKS server, so
-   we don't need resolving IP address of destination host on
-   local machine.
-
-   Environment variable SOCKS_RESOLVE directs how to resolve
-   IP addess. There's 3 keywords allowed; "local", "remote"
-   and "both" (case insensitive). Keyword "local" means taht
-   target host name is resolved by localhost resolver
-   (usualy with gethostbyname()), "remote" means by remote
-   SOCKS server, "both" means to try resolving by localhost
-   then remote.
-
-   SOCKS4 protocol and authentication of SOCKS5 protocol
-   requires user name on connect request.
-   User name is determined by following method.
-
-   1. If server spec has user@hostname:port format then
-      user part is used for this SOCKS server.
-
-   2. Get user name from environment variable LOGNAME, USER
-      (in this order).
-
-*/
-int
-begin_socks4_relay( SOCKET s )
-{
-    unsigned char buf[256], *ptr;
-
-    debug( "begin_socks_relay()\n");
-
-    /* make connect request packet
-       protocol v4:
-         VN:1, CD:1, PORT:2, ADDR:4, USER:n, NULL:1
-       protocol v4a:
-         VN:1, CD:1, PORT:2, DUMMY:4, USER:n, NULL:1, HOSTNAME:n, NULL:1
-    */
-    ptr = buf;
-    PUT_BYTE( ptr++, 4);                        /* protocol version (4) */
-    PUT_BYTE( ptr++, 1);                        /* CONNECT command */
-    PUT_BYTE( ptr++, dest_port>>8);     /* destination Port */
-    PUT_BYTE( ptr++, dest_port&0xFF);
-    /* destination IP */
-    memcpy(ptr, &dest_addr.sin_addr, sizeof(dest_addr.sin_addr));
-    ptr += sizeof(dest_addr.sin_addr);
-    if ( dest_addr.sin_addr.s_addr == 0 )
-        *(ptr-1) = 1;                           /* fake, protocol 4a */
-    /* username */
-    if (relay_user == NULL)
-        fatal( "Cannot determine user name.\n");
-    strcpy( ptr, relay_user );
-    ptr += strlen( relay_user ) +1;
-    /* destination host name (for protocol 4a) */
-    if ( (socks_version == 4) && (dest_addr.sin_addr.s_addr == 0)) {
-        strcpy( ptr, dest_host );
-        ptr += strlen( dest_host ) +1;
-    }
-    /* send command and get response
-       response is: VN:1, CD:1, PORT:2, ADDR:4 */
-    atomic_out( s, buf, ptr-buf);               /* send request */
-    atomic_in( s, buf, 8 );                     /* recv response */
-    if ( (buf[1] != SOCKS4_REP_SUCCEEDED) ) {   /* check reply code */
-        error("Got error response: %d: '%s'.\n",
-              buf[1], lookup(buf[1], socks4_rep_names));
-        return -1;                              /* failed */
-    }
-
-    /* Conguraturation, connected via SOCKS4 server! */
-    return 0;
-}
-
-int
-sendf(SOCKET s, const char *fmt,...)
-{
-    static char buf[10240];                     /* xxx, enough? */
-
-    va_list args;
-    va_start( args, fmt );
-    vsnprintf( buf, sizeof(buf), fmt, args );
-    va_end( args );
-
-    report_text(">>>", buf);
-    if ( send(s, buf, strlen(buf), 0) == SOCKET_ERROR ) {
-        debug("failed to send http request. errno=%d\n", socket_errno());
-        return -1;
-    }
-    return 0;
+    return ptr - buf;
 }
 
 const char *base64_table =
@@ -2363,494 +4256,4931 @@ make_base64_string(const char *str)
 }
 
 
+#ifdef _WIN32
+/* ddatalen()
+   Returns 1 if data is available, otherwise return 0
+ */
 int
-basic_auth (SOCKET s)
+stdindatalen (void)
 {
-    char *userpass;
-    char *cred;
-    const char *user = relay_user;
-    char *pass = NULL;
-    int len, ret;
-
-    /* Get username/password for authentication */
-    if (user == NULL)
-        fatal("Cannot decide username for proxy authentication.");
-    if ((pass = determine_relay_password ()) == NULL &&
-        (pass = readpass("Enter proxy authentication password for %s@%s: ",
-                         relay_user, relay_host)) == NULL)
-        fatal("Cannot decide password for proxy authentication.");
-
-    len = strlen(user)+strlen(pass)+1;
-    userpass = xmalloc(len+1);
-    snprintf(userpass, len+1, "%s:%s", user, pass);
-    memset (pass, 0, strlen(pass));
-    cred = make_base64_string(userpass);
-    memset (userpass, 0, len);
-
-    f_report = 0;                               /* don't report for security */
-    ret = sendf(s, "Proxy-Authorization: Basic %s\r\n", cred);
-    f_report = 1;
-    report_text(">>>", "Proxy-Authorization: Basic xxxxx\r\n");
-
-    memset(cred, 0, strlen(cred));
-    free(cred);
-
-    return ret;
+    DWORD len = 0;
+    struct stat st;
+    fstat( 0, &st );
+    if ( st.st_mode & _S_IFIFO ) {
+        /* in case of PIPE */
+        if ( !PeekNamedPipe( GetStdHandle(STD_INPUT_HANDLE),
+                             NULL, 0, NULL, &len, NULL) ) {
+            if ( GetLastError() == ERROR_BROKEN_PIPE ) {
+                /* PIPE source is closed */
+                /* read() will detects EOF */
+                len = 1;
+            } else {
+                fatal("PeekNamedPipe() failed, errno=%d\n",
+                      GetLastError());
+            }
+        }
+    } else if ( st.st_mode & _S_IFREG ) {
+        /* in case of regular file (redirected) */
+        len = 1;                        /* always data ready */
+    } else if ( _kbhit() ) {
+        /* in case of console */
+        len = 1;
+    }
+    return len;
+}
+#endif /* _WIN32 */
+
+/** RING BUFFER **/
+
+/* Fixed size ring buffer for relaying.  Data is never moved:
+   reader and writer work on the contiguous region returned by
+   ring_rptr()/ring_wptr() and advance with ring_consume()/ring_commit(). */
+typedef struct {
+    char *buf;
+    int size;                                   /* capacity */
+    int head;                                   /* offset of first byte */
+    int len;                                    /* stored bytes */
+} RING;
+
+void
+ring_init( RING *ring, int size )
+{
+    ring->buf = xmalloc( size );
+    ring->size = size;
+    ring->head = 0;
+    ring->len = 0;
+}
+
+void
+ring_free( RING *ring )
+{
+    free( ring->buf );
+    ring->buf = NULL;
+    ring->size = ring->head = ring->len = 0;
+}
+
+#define ring_space(r)   ((r)->size - (r)->len)
+
+/* contiguous readable region, its length is stored in *LEN */
+char *
+ring_rptr( RING *ring, int *len )
+{
+    int n = ring->size - ring->head;
+    *len = (ring->len < n)? ring->len: n;
+    return ring->buf + ring->head;
+}
+
+void
+ring_consume( RING *ring, int len )
+{
+    assert( 0 <= len && len <= ring->len );
+    ring->len -= len;
+    ring->head = (ring->len == 0)? 0: (ring->head + len) % ring->size;
+}
+
+/* contiguous writable region, its length is stored in *LEN */
+char *
+ring_wptr( RING *ring, int *len )
+{
+    int tail = (ring->head + ring->len) % ring->size;
+    int n = ring->size - tail;
+    *len = (ring_space(ring) < n)? ring_space(ring): n;
+    return ring->buf + tail;
+}
+
+void
+ring_commit( RING *ring, int len )
+{
+    assert( 0 <= len && len <= ring_space(ring) );
+    ring->len += len;
+}
+
+
+/** EVENT LOOP **/
+
+/* Readiness notification for the relay.
+
+   Descriptors are registered once with evloop_add() and stay
+   registered until evloop_del(); nothing is rebuilt per iteration.
+   On Linux the epoll backend is used, otherwise (or when epoll is not
+   available) the portable select() backend.
+
+   The loop is edge-triggered: evloop_wait() sets EV_READ/EV_WRITE in
+   item->ready when the descriptor becomes ready, and the caller keeps
+   doing I/O until it sees EAGAIN, then calls evloop_clear().  This
+   works only for non-blocking descriptors (see set_nonblock()).
+   Blocking descriptors like a tty are registered with EV_LEVEL: only
+   reading is watched, writing is always considered ready, and the
+   caller clears EV_READ after each read.  Descriptors which cannot be
+   polled at all (regular files) are always ready, and they are
+   reported only while the owner wants them (see evloop_want()) not
+   to spin in the loop.
+*/
+#define EV_READ         0x01
+#define EV_WRITE        0x02
+#define EV_LEVEL        0x10                    /* blocking descriptor */
+
+#define EVLOOP_SELECT   0
+#define EVLOOP_EPOLL    1
+char *evloop_names[] = { "select", "epoll" };
+
+typedef struct {
+    SOCKET fd;
+    int events;                                 /* EV_READ, EV_WRITE, EV_LEVEL */
+    int ready;                                  /* known readiness */
+    int always;                                 /* not pollable, always ready */
+    int want;                                   /* wanted if always ready */
+    int index;                                  /* position in evloop table */
+    void *data;                                 /* owner of this item */
+} EV_ITEM;
+
+typedef struct {
+    int backend;                                /* EVLOOP_xxx */
+    int epfd;                                   /* for EVLOOP_EPOLL */
+    EV_ITEM **items;                            /* registered items */
+    int n_items;
+    int max_items;
+    int n_always;                               /* # of always ready items */
+    EV_ITEM **fired;                            /* got ready in last wait */
+    int n_fired;
+} EVLOOP;
+
+int
+set_nonblock( SOCKET fd, int on )
+{
+#ifdef _WIN32
+    u_long arg = on;
+    return ioctlsocket( fd, FIONBIO, &arg );
+#else  /* !_WIN32 */
+    int flags = fcntl( fd, F_GETFL, 0 );
+    if ( flags == -1 )
+        return -1;
+    if ( on )
+        flags |= O_NONBLOCK;
+    else
+        flags &= ~O_NONBLOCK;
+    return fcntl( fd, F_SETFL, flags );
+#endif /* !_WIN32 */
+}
+
+int
+evloop_init( EVLOOP *ev )
+{
+#ifdef WITH_EPOLL
+    char *backend = getparam( ENV_CONNECT_EVLOOP );
+#endif /* WITH_EPOLL */
+
+    memset( ev, 0, sizeof(*ev) );
+    ev->backend = EVLOOP_SELECT;
+    ev->epfd = -1;
+#ifdef WITH_EPOLL
+    if ( backend != NULL && strcmp( backend, "select" ) == 0 ) {
+        /* keep select() as requested */
+    } else if ( 0 <= (ev->epfd = epoll_create( 16 )) ) {
+        fcntl( ev->epfd, F_SETFD, FD_CLOEXEC );
+        ev->backend = EVLOOP_EPOLL;
+    } else {
+        debug("epoll_create() failed, errno=%d, using select()\n", errno);
+    }
+#endif /* WITH_EPOLL */
+    debug("event loop backend: %s\n", evloop_names[ev->backend]);
+    return 0;
+}
+
+void
+evloop_done( EVLOOP *ev )
+{
+#ifdef WITH_EPOLL
+    if ( 0 <= ev->epfd )
+        close( ev->epfd );
+#endif /* WITH_EPOLL */
+    free( ev->items );
+    free( ev->fired );
+    ev->items = ev->fired = NULL;
+    ev->n_items = ev->max_items = ev->n_fired = 0;
+}
+
+#ifdef WITH_EPOLL
+static int
+evloop_epoll_ctl( EVLOOP *ev, int op, EV_ITEM *item )
+{
+    struct epoll_event ee;
+    memset( &ee, 0, sizeof(ee) );
+    ee.data.ptr = item;
+    if ( item->events & EV_LEVEL ) {
+        /* one shot, re-armed by evloop_clear() */
+        if ( item->events & EV_READ )
+            ee.events = EPOLLIN | EPOLLONESHOT;
+    } else {
+        ee.events = EPOLLET;
+        if ( item->events & EV_READ )
+            ee.events |= EPOLLIN | EPOLLRDHUP;
+        if ( item->events & EV_WRITE )
+            ee.events |= EPOLLOUT;
+    }
+    return epoll_ctl( ev->epfd, op, item->fd, &ee );
+}
+#endif /* WITH_EPOLL */
+
+int
+evloop_add( EVLOOP *ev, EV_ITEM *item )
+{
+    item->ready = 0;
+    item->always = 0;
+    item->want = item->events & (EV_READ|EV_WRITE);
+    if ( item->events & EV_LEVEL )
+        item->ready = EV_WRITE;                 /* blocking write */
+    if ( ev->max_items <= ev->n_items ) {
+        ev->max_items = ev->max_items ? ev->max_items * 2 : 8;
+        ev->items = realloc( ev->items, ev->max_items * sizeof(EV_ITEM*) );
+        ev->fired = realloc( ev->fired, ev->max_items * sizeof(EV_ITEM*) );
+        if ( ev->items == NULL || ev->fired == NULL )
+            fatal("Cannot allocate memory for event loop.\n");
+    }
+#ifdef WITH_EPOLL
+    if ( ev->backend == EVLOOP_EPOLL &&
+         evloop_epoll_ctl( ev, EPOLL_CTL_ADD, item ) < 0 ) {
+        if ( errno != EPERM ) {
+            error("epoll_ctl() failed for fd %d, errno=%d\n",
+                  item->fd, errno);
+            return -1;
+        }
+        /* regular file or alike, it never blocks */
+        debug("fd %d is not pollable, assume always ready\n", item->fd);
+        item->always = 1;
+    }
+#endif /* WITH_EPOLL */
+#ifndef _WIN32
+    if ( ev->backend == EVLOOP_SELECT && FD_SETSIZE <= item->fd ) {
+        error("fd %d exceeds FD_SETSIZE\n", item->fd);
+        return -1;
+    }
+#endif /* !_WIN32 */
+    if ( item->always ) {
+        item->ready = EV_READ | EV_WRITE;
+        ev->n_always++;
+    }
+    item->index = ev->n_items;
+    ev->items[ev->n_items++] = item;
+    return 0;
+}
+
+void
+evloop_del( EVLOOP *ev, EV_ITEM *item )
+{
+    int i = item->index;
+    if ( i < 0 || ev->n_items <= i || ev->items[i] != item )
+        return;                                 /* not registered */
+#ifdef WITH_EPOLL
+    if ( ev->backend == EVLOOP_EPOLL && !item->always )
+        epoll_ctl( ev->epfd, EPOLL_CTL_DEL, item->fd, NULL );
+#endif /* WITH_EPOLL */
+    if ( item->always )
+        ev->n_always--;
+    ev->items[i] = ev->items[--ev->n_items];
+    ev->items[i]->index = i;
+    item->index = -1;
+}
+
+/* caller got EAGAIN (or consumed a level-triggered event) */
+void
+evloop_clear( EVLOOP *ev, EV_ITEM *item, int what )
+{
+    if ( item->always )
+        return;                                 /* stay ready */
+    if ( item->events & EV_LEVEL )
+        what &= ~EV_WRITE;                      /* writing never blocks */
+    item->ready &= ~what;
+#ifdef WITH_EPOLL
+    if ( ev->backend == EVLOOP_EPOLL && (item->events & EV_LEVEL) &&
+         (what & EV_READ) )
+        evloop_epoll_ctl( ev, EPOLL_CTL_MOD, item );    /* re-arm */
+#endif /* WITH_EPOLL */
+}
+
+/* owner of ITEM wants to do WHAT now.  Always ready item is fired
+   only while it is wanted, others are not affected. */
+void
+evloop_want( EVLOOP *ev, EV_ITEM *item, int what )
+{
+    item->want = what;
+}
+
+/* wait for readiness.  TIMEOUT is in milli-seconds, -1 means forever.
+   Items which got ready are listed in ev->fired.
+   Returns number of them or -1 on error. */
+int
+evloop_wait( EVLOOP *ev, int timeout )
+{
+    int i, n = 0;
+
+    ev->n_fired = 0;
+    for ( i = 0; 0 < ev->n_always && i < ev->n_items; i++ ) {
+        if ( ev->items[i]->always && ev->items[i]->want ) {
+            timeout = 0;                        /* don't block */
+            ev->fired[ev->n_fired++] = ev->items[i];
+        }
+    }
+#ifdef WITH_EPOLL
+    if ( ev->backend == EVLOOP_EPOLL ) {
+        struct epoll_event ees[64];
+        int nev = ev->max_items - ev->n_fired;
+        if ( nev <= 0 )
+            nev = 1;                            /* nothing registered */
+        nev = epoll_wait( ev->epfd, ees, (nev < 64)? nev: 64, timeout );
+        if ( nev < 0 )
+            return (errno == EINTR)? ev->n_fired: -1;
+        for ( i = 0; i < nev; i++ ) {
+            EV_ITEM *item = ees[i].data.ptr;
+            ev->fired[ev->n_fired++] = item;
+            if ( ees[i].events & (EPOLLIN|EPOLLRDHUP|EPOLLHUP|EPOLLERR) )
+                item->ready |= EV_READ;
+            if ( ees[i].events & (EPOLLOUT|EPOLLHUP|EPOLLERR) )
+                item->ready |= EV_WRITE;
+        }
+        return ev->n_fired;
+    }
+#endif /* WITH_EPOLL */
+    {
+        fd_set ifds, ofds;
+        struct timeval tv, *ptv = NULL;
+        SOCKET maxfd = 0;
+        FD_ZERO( &ifds );
+        FD_ZERO( &ofds );
+        /* poll only for what is not known to be ready */
+        for ( i = 0; i < ev->n_items; i++ ) {
+            EV_ITEM *item = ev->items[i];
+            int watch = 0;
+            if ( item->always )
+                continue;
+            if ( (item->events & EV_READ) && !(item->ready & EV_READ) ) {
+                FD_SET( item->fd, &ifds );
+                watch = 1;
+            }
+            if ( (item->events & EV_WRITE) && !(item->ready & EV_WRITE) ) {
+                FD_SET( item->fd, &ofds );
+                watch = 1;
+            }
+            if ( watch && maxfd < item->fd )
+                maxfd = item->fd;
+        }
+        if ( 0 <= timeout ) {
+            tv.tv_sec = timeout / 1000;
+            tv.tv_usec = (timeout % 1000) * 1000;
+            ptv = &tv;
+        }
+        n = select( maxfd+1, &ifds, &ofds, (fd_set*)NULL, ptv );
+        if ( n < 0 )
+            return (socket_errno() == EINTR)? ev->n_fired: -1;
+        for ( i = 0; 0 < n && i < ev->n_items; i++ ) {
+            EV_ITEM *item = ev->items[i];
+            int fired = 0;
+            if ( item->always )
+                continue;
+            if ( FD_ISSET( item->fd, &ifds ) ) {
+                item->ready |= EV_READ;
+                fired = 1;
+            }
+            if ( FD_ISSET( item->fd, &ofds ) ) {
+                item->ready |= EV_WRITE;
+                fired = 1;
+            }
+            if ( fired )
+                ev->fired[ev->n_fired++] = item;
+        }
+    }
+    return ev->n_fired;
+}
+
+/* decide how to watch local descriptor FD in the relay loop.
+   Sockets and pipes are switched to non-blocking mode and watched
+   edge-triggered, others (tty etc.) are left blocking. */
+int
+relay_fd_events( SOCKET fd, int is_socket, int events )
+{
+#ifndef _WIN32
+    struct stat st;
+    if ( !is_socket &&
+         (fstat( fd, &st ) < 0 ||
+          !(S_ISFIFO(st.st_mode) || S_ISSOCK(st.st_mode))) )
+        return events | EV_LEVEL;
+#endif /* !_WIN32 */
+    set_nonblock( fd, 1 );
+    return events;
+}
+
+/** NEGOTIATION **/
+
+/* Negotiation with relay server.
+
+   Each method is a resumable state machine on non-blocking socket.
+   begin_xxx_relay() queues the first request, then xxx_step() is
+   called whenever bytes arrive, consumes complete replies and queues
+   next request if any.  Nothing waits inside them, so handshakes are
+   driven by an event loop, see attempt_nego().  Requests are sent in
+   one write as far as possible.
+
+   Waiting for each reply is a phase with its own deadline: '-w'
+   seconds, or NEGO_TIMEOUT_DEFAULT.  Prompting for password is done
+   before the phase begins and isn't counted.
+*/
+#define NEGO_TIMEOUT_DEFAULT 60                 /* seconds per phase */
+#define NEGO_LINE_MAX   1024
+
+/* flags of negotiation */
+#define NEGO_AUTH_ONLY  0x01                    /* stop after SOCKS5 auth */
+#define NEGO_CONNECT    0x02                    /* authenticated already */
+
+/* states, each is waiting a reply */
+#define NS_SOCKS5_METHOD 1                      /* method selection */
+#define NS_SOCKS5_AUTH   2                      /* user/pass result */
+#define NS_SOCKS5_REPLY  3                      /* head of CONNECT reply */
+#define NS_SOCKS5_ADDR   4                      /* bound address of it */
+#define NS_SOCKS4_REPLY  5
+#define NS_HTTP_STATUS   6                      /* status line */
+#define NS_HTTP_HEADER   7                      /* header lines */
+#define NS_HTTP_BODY     8                      /* body of 401/407 */
+#define NS_HTTP_CHUNK    9                      /* chunk size line */
+#define NS_HTTP_TRAILER  10                     /* after last chunk */
+#define NS_TELNET        11                     /* lines until phrase */
+
+typedef struct {
+    SOCKET s;
+    int method;                                 /* METHOD_xxx */
+    int flags;                                  /* NEGO_xxx */
+    METRICS *m;                                 /* phases, or NULL */
+    int state;                                  /* NS_xxx */
+    const char *phase;                          /* name of the phase */
+    long deadline;                              /* of the phase, msec */
+    int eof;                                    /* closed by server */
+    unsigned char auth_list[10];                /* SOCKS5 methods offered */
+    int n_auth;
+    int pipelined;                              /* SOCKS5 sent at once */
+    int want;                                   /* length of SOCKS5 addr */
+    int status;                                 /* HTTP status code */
+    int keep_alive;                             /* HTTP can send again */
+    int chunked;                                /* HTTP chunked body */
+    long body;                                  /* bytes of it, -1 unknown */
+    int secret;                                 /* out contains password */
+    int out_len, out_sent;
+    char out[8192];                             /* requests to send */
+    LINE_READER in;                             /* replies received */
+    char line[NEGO_LINE_MAX];                   /* last line taken */
+} NEGO;
+
+char *telnet_good_phrase = "connected to";
+char *telnet_bad_phrases[] = {
+    " failed", " refused", " rejected", " closed"
+};
+#define N_TELNET_BAD_PHRASES \
+    (int)(sizeof(telnet_bad_phrases) / sizeof(char*))
+
+/* enter phase NAME waiting a reply in STATE */
+void
+nego_phase( NEGO *ng, int state, const char *name )
+{
+    int timeout = (0 < connect_timeout)? connect_timeout: NEGO_TIMEOUT_DEFAULT;
+    ng->state = state;
+    ng->phase = name;
+    ng->deadline = now_msec() + timeout * 1000L;
+}
+
+/* queue LEN bytes in BUF to send.  SECRET data is not reported nor
+   captured, and erased after sent. */
+int
+nego_send( NEGO *ng, const char *buf, int len, int secret )
+{
+    if ( (int)sizeof(ng->out) < ng->out_len + len ) {
+        error("too long request to relay server.\n");
+        return -1;
+    }
+    memcpy( ng->out + ng->out_len, buf, len );
+    ng->out_len += len;
+    if ( secret ) {
+        ng->secret = 1;
+        return 0;
+    }
+    CAPTURE( TRACE_UP, buf, len );
+    return 0;
+}
+
+/* queue formatted text to send */
+int
+nego_sendf( NEGO *ng, const char *fmt, ... )
+{
+    char buf[2048];
+    va_list args;
+
+    va_start( args, fmt );
+    vsnprintf( buf, sizeof(buf), fmt, args );
+    va_end( args );
+    report_text( ">>>", buf );
+    return nego_send( ng, buf, strlen(buf), 0 );
+}
+
+/* take LEN bytes received, or NULL if not yet. */
+unsigned char *
+nego_take( NEGO *ng, int len )
+{
+    unsigned char *ptr;
+
+    if ( ng->in.len - ng->in.ptr < len )
+        return NULL;
+    ptr = (unsigned char *)ng->in.buf + ng->in.ptr;
+    ng->in.ptr += len;
+    report_bytes( "<<<", (char *)ptr, len );
+    return ptr;
+}
+
+/* take one line received into ng->line, or NULL if not yet.
+   Too long line is split, and the last line may lack EOL at end of
+   stream. */
+char *
+nego_line( NEGO *ng )
+{
+    char *ptr = ng->in.buf + ng->in.ptr, *eol;
+    int len = ng->in.len - ng->in.ptr;
+
+    if ( (eol = memchr( ptr, '\n', len )) != NULL )
+        len = eol - ptr + 1;
+    else if ( !ng->eof && len < NEGO_LINE_MAX-1 )
+        return NULL;                            /* not yet */
+    if ( len == 0 )
+        return NULL;
+    if ( NEGO_LINE_MAX-1 < len )
+        len = NEGO_LINE_MAX-1;
+    memcpy( ng->line, ptr, len );
+    ng->line[len] = '\0';
+    ng->in.ptr += len;
+    report_text( "<<<", ng->line );
+    return ng->line;
+}
+
+/* send queued requests and receive replies as far as possible
+   without blocking, ITEM of NG->s in EV is cleared on EAGAIN.
+   Returns number of bytes moved or -1 on error. */
+int
+nego_io( NEGO *ng, EVLOOP *ev, EV_ITEM *item )
+{
+    int len, moved = 0;
+
+    while ( ng->out_sent < ng->out_len ) {
+        len = send( ng->s, ng->out + ng->out_sent,
+                    ng->out_len - ng->out_sent, 0 );
+        if ( len == SOCKET_ERROR ) {
+            if ( socket_wouldblock() ) {
+                evloop_clear( ev, item, EV_WRITE );
+                break;
+            }
+            error("failed to send to relay server, errno=%d\n",
+                  socket_errno());
+            return -1;
+        }
+        ng->out_sent += len;
+        moved += len;
+    }
+    if ( 0 < ng->out_len && ng->out_sent == ng->out_len ) {
+        if ( ng->secret )
+            memset( ng->out, 0, ng->out_len );  /* erase password */
+        ng->out_len = ng->out_sent = ng->secret = 0;
+    }
+    while ( !ng->eof ) {
+        if ( 0 < ng->in.ptr ) {                 /* make room */
+            memmove( ng->in.buf, ng->in.buf + ng->in.ptr,
+                     ng->in.len - ng->in.ptr );
+            ng->in.len -= ng->in.ptr;
+            ng->in.ptr = 0;
+        }
+        if ( ng->in.len == (int)sizeof(ng->in.buf) )
+            break;                              /* consume first */
+        len = recv( ng->s, ng->in.buf + ng->in.len,
+                    sizeof(ng->in.buf) - ng->in.len, 0 );
+        if ( len == SOCKET_ERROR ) {
+            if ( socket_wouldblock() ) {
+                evloop_clear( ev, item, EV_READ );
+                break;
+            }
+            /* replies received so far are still checked */
+            error("failed to recv from relay server, errno=%d\n",
+                  socket_errno());
+            ng->eof = 1;
+            break;
+        }
+        if ( len == 0 ) {
+            ng->eof = 1;
+            break;
+        }
+        CAPTURE( TRACE_DOWN, ng->in.buf + ng->in.len, len );
+        ng->in.len += len;
+        moved += len;
+    }
+    return moved;
+}
+
+/* queue User/Password sub-negotiation (RFC 1929) */
+int
+socks5_send_userpass( NEGO *ng )
+{
+    unsigned char buf[1024];
+    int len, ret;
+
+    len = socks5_make_userpass( buf );
+    ret = nego_send( ng, (char *)buf, len, 1 );
+    memset( buf, 0, sizeof(buf) );             /* erase password */
+    debug(">>> xx xx xx xx ... (%d bytes, not shown)\n", len);
+    return ret;
+}
+
+/* queue CONNECT request */
+int
+socks5_send_connect( NEGO *ng )
+{
+    unsigned char buf[256];
+    int len;
+
+    len = socks5_make_connect( buf );
+    report_bytes( ">>>", (char *)buf, len );
+    return nego_send( ng, (char *)buf, len, 0 );
+}
+
+/* begin SOCKS5 relaying.
+   Method selection is sent first, then authentication and CONNECT
+   request after each reply.  With SOCKS5_PIPELINE, if only one method
+   is offered and it needs no challenge, all of them are sent at once
+   and replies are checked in order. */
+int
+begin_socks5_relay( NEGO *ng )
+{
+    unsigned char buf[256];
+    int len;
+
+    debug( "begin_socks5_relay()\n");
+    if ( ng->flags & NEGO_CONNECT ) {
+        /* on pooled connection */
+        if ( socks5_send_connect( ng ) < 0 )
+            return START_ERROR;
+        nego_phase( ng, NS_SOCKS5_REPLY, "socks5 connect" );
+        return START_AGAIN;
+    }
+    len = socks5_make_greeting( buf, ng->auth_list, &ng->n_auth );
+    report_bytes( ">>>", (char *)buf, len );
+    if ( nego_send( ng, (char *)buf, len, 0 ) < 0 )
+        return START_ERROR;
+    if ( !(ng->flags & NEGO_AUTH_ONLY) &&
+         getparam_bool( ENV_SOCKS5_PIPELINE, 0 ) && ng->n_auth == 1 &&
+         (ng->auth_list[0] == SOCKS5_AUTH_NOAUTH ||
+          ng->auth_list[0] == SOCKS5_AUTH_USERPASS) ) {
+        debug( "pipelining SOCKS5 requests\n");
+        ng->pipelined = 1;
+        if ( (ng->auth_list[0] == SOCKS5_AUTH_USERPASS &&
+              socks5_send_userpass( ng ) < 0) ||
+             socks5_send_connect( ng ) < 0 )
+            return START_ERROR;
+    }
+    nego_phase( ng, NS_SOCKS5_METHOD, "socks5 method" );
+    return START_AGAIN;
+}
+
+int
+socks5_step( NEGO *ng )
+{
+    unsigned char *ptr;
+    int method;
+
+    for (;;) {
+        switch ( ng->state ) {
+        case NS_SOCKS5_METHOD:
+            if ( (ptr = nego_take( ng, 2 )) == NULL )
+                return START_AGAIN;
+            if ( (method = socks5_check_method( ptr )) < 0 )
+                return START_ERROR;
+            if ( ng->pipelined && method != ng->auth_list[0] ) {
+                error("Method %s is not accepted by server.\n",
+                      socks5_getauthname( ng->auth_list[0] ));
+                return START_ERROR;
+            }
+            if ( method == SOCKS5_AUTH_USERPASS ) {
+                if ( !ng->pipelined && socks5_send_userpass( ng ) < 0 )
+                    return START_ERROR;
+                nego_phase( ng, NS_SOCKS5_AUTH, "socks5 auth" );
+                continue;
+            }
+            if ( method != SOCKS5_AUTH_NOAUTH ) {
+                error("Unsupported authentication method: %s\n",
+                      socks5_getauthname( method ));
+                return START_ERROR;
+            }
+            break;                              /* authenticated */
+
+        case NS_SOCKS5_AUTH:
+            if ( (ptr = nego_take( ng, 2 )) == NULL )
+                return START_AGAIN;
+            if ( ptr[1] != 0 ) {
+                error("Authentication failed.\n");
+                forget_relay_password();
+                return START_ERROR;
+            }
+            break;                              /* authenticated */
+
+        case NS_SOCKS5_REPLY:
+            if ( (ptr = nego_take( ng, 4 )) == NULL )
+                return START_AGAIN;
+            if ( ptr[1] != SOCKS5_REP_SUCCEEDED ) {
+                error("Got error response from SOCKS server: %d (%s).\n",
+                      ptr[1], lookup(ptr[1], socks5_rep_names));
+                return START_ERROR;
+            }
+            switch ( ptr[3] ) {                 /* case by ATYP */
+            case 1: ng->want = 4+2; break;      /* IPv4 addr and port */
+            case 3: ng->want = 0; break;        /* name, length first */
+            case 4: ng->want = 16+2; break;     /* IPv6 addr and port */
+            default: return START_OK;
+            }
+            ng->state = NS_SOCKS5_ADDR;
+            continue;
+
+        case NS_SOCKS5_ADDR:
+            if ( ng->want == 0 ) {
+                if ( (ptr = nego_take( ng, 1 )) == NULL )
+                    return START_AGAIN;
+                ng->want = *ptr + 2;            /* name and port */
+            }
+            if ( nego_take( ng, ng->want ) == NULL )
+                return START_AGAIN;
+            /* Conguraturation, connected via SOCKS5 server! */
+            return START_OK;
+
+        default:
+            return START_ERROR;
+        }
+
+        /* authentication is done */
+        if ( ng->m != NULL )
+            metrics_phase( ng->m, "socks5_auth" );
+        if ( ng->flags & NEGO_AUTH_ONLY )
+            return START_OK;
+        if ( !ng->pipelined && socks5_send_connect( ng ) < 0 )
+            return START_ERROR;
+        nego_phase( ng, NS_SOCKS5_REPLY, "socks5 connect" );
+    }
+}
+
+/* begin SOCKS protocol 4 relaying
+   And no authentication is supported.
+
+   There's SOCKS protocol version 4 and 4a. Protocol version
+   4a has capability to resolve hostname by SOCKS server, so
+   we don't need resolving IP address of destination host on
+   local machine.
+
+   Environment variable SOCKS_RESOLVE directs how to resolve
+   IP addess. There's 3 keywords allowed; "local", "remote"
+   and "both" (case insensitive). Keyword "local" means taht
+   target host name is resolved by localhost resolver
+   (usualy with gethostbyname()), "remote" means by remote
+   SOCKS server, "both" means to try resolving by localhost
+   then remote.
+
+   SOCKS4 protocol and authentication of SOCKS5 protocol
+   requires user name on connect request.
+   User name is determined by following method.
+
+   1. If server spec has user@hostname:port format then
+      user part is used for this SOCKS server.
+
+   2. Get user name from environment variable LOGNAME, USER
+      (in this order).
+
+*/
+int
+begin_socks4_relay( NEGO *ng )
+{
+    unsigned char buf[256], *ptr;
+
+    debug( "begin_socks4_relay()\n");
+
+    /* make connect request packet
+       protocol v4:
+         VN:1, CD:1, PORT:2, ADDR:4, USER:n, NULL:1
+       protocol v4a:
+         VN:1, CD:1, PORT:2, DUMMY:4, USER:n, NULL:1, HOSTNAME:n, NULL:1
+    */
+    ptr = buf;
+    PUT_BYTE( ptr++, 4);                        /* protocol version (4) */
+    PUT_BYTE( ptr++, 1);                        /* CONNECT command */
+    PUT_BYTE( ptr++, dest_port>>8);     /* destination Port */
+    PUT_BYTE( ptr++, dest_port&0xFF);
+    /* destination IP */
+    memcpy(ptr, &dest_addr.sin_addr, sizeof(dest_addr.sin_addr));
+    ptr += sizeof(dest_addr.sin_addr);
+    if ( dest_addr.sin_addr.s_addr == 0 )
+        *(ptr-1) = 1;                           /* fake, protocol 4a */
+    /* username */
+    if (relay_user == NULL)
+        fatal( "Cannot determine user name.\n");
+    strcpy( ptr, relay_user );
+    ptr += strlen( relay_user ) +1;
+    /* destination host name (for protocol 4a) */
+    if ( (socks_version == 4) && (dest_addr.sin_addr.s_addr == 0)) {
+        strcpy( ptr, dest_host );
+        ptr += strlen( dest_host ) +1;
+    }
+    /* send command, response is: VN:1, CD:1, PORT:2, ADDR:4 */
+    report_bytes( ">>>", (char *)buf, ptr-buf );
+    if ( nego_send( ng, (char *)buf, ptr-buf, 0 ) < 0 )
+        return START_ERROR;
+    nego_phase( ng, NS_SOCKS4_REPLY, "socks4 connect" );
+    return START_AGAIN;
+}
+
+int
+socks4_step( NEGO *ng )
+{
+    unsigned char *ptr;
+
+    if ( (ptr = nego_take( ng, 8 )) == NULL )
+        return START_AGAIN;
+    if ( (ptr[1] != SOCKS4_REP_SUCCEEDED) ) {   /* check reply code */
+        error("Got error response: %d: '%s'.\n",
+              ptr[1], lookup(ptr[1], socks4_rep_names));
+        return START_ERROR;
+    }
+    /* Conguraturation, connected via SOCKS4 server! */
+    return START_OK;
+}
+
+/** AUTH CACHE **/
+
+/* Authentication scheme required by each HTTP proxy is kept in
+   ~/.cache/connect/auth as "HOST PORT TIME SCHEME [PARAMS]", so
+   credentials are sent with the first request by later invocations,
+   without a round trip to be challenged.  TIME is when the record was
+   written, and records older than AUTH_CACHE_TTL are ignored and
+   dropped.  PARAMS are the Digest challenge and nonce-count.
+   Passwords are never written.  The file is rewritten under lock of
+   AUTH_CACHE_LOCK, so processes sharing a cached nonce never send the
+   same count nor lose records written by others. */
+#define AUTH_CACHE_FILE         ".cache/connect/auth"
+#define AUTH_CACHE_LOCK         ".cache/connect/auth.lock"
+#define AUTH_CACHE_TTL          (24*60*60)      /* seconds */
+
+#if !defined(_WIN32) || defined(cygwin)
+/* lock the auth cache against other processes.
+   Returns descriptor to give auth_cache_unlock(), or -1. */
+int
+auth_cache_lock( void )
+{
+    char *path = home_path( AUTH_CACHE_LOCK );
+    struct flock fl;
+    int fd;
+
+    if ( !getparam_bool( ENV_CONNECT_AUTH_CACHE, 1 ) ) {
+        free( path );
+        return -1;
+    }
+    make_parent_dirs( path );
+    fd = open( path, O_RDWR|O_CREAT, 0600 );
+    free( path );
+    if ( fd < 0 )
+        return -1;
+    memset( &fl, 0, sizeof(fl) );
+    fl.l_type = F_WRLCK;
+    fl.l_whence = SEEK_SET;
+    if ( fcntl( fd, F_SETLKW, &fl ) < 0 ) {
+        close( fd );
+        return -1;
+    }
+    return fd;
+}
+
+/* release lock taken by auth_cache_lock() */
+void
+auth_cache_unlock( int fd )
+{
+    if ( 0 <= fd )
+        close( fd );                            /* lock goes with it */
+}
+
+/* parse LINE of the auth cache into NAME (1024 bytes) and *PORT.
+   Returns offset of the scheme, or -1 if the record is broken or
+   expired. */
+int
+auth_cache_parse( const char *line, char *name, int *port )
+{
+    long t, now = time( NULL );
+    int n;
+
+    if ( sscanf( line, "%1023s %d %ld %n", name, port, &t, &n ) != 3 ||
+         now < t || AUTH_CACHE_TTL <= now - t )
+        return -1;
+    return n;
+}
+
+/* look up record of relay server HOST:PORT into BUF of SIZE bytes
+   without host, port and time.  Returns 0 if found, -1 if not. */
+int
+auth_cache_get( const char *host, int port, char *buf, int size )
+{
+    char *path = home_path( AUTH_CACHE_FILE );
+    char line[1024], name[1024];
+    FILE *fp;
+    int p, n, ret = -1;
+
+    fp = getparam_bool( ENV_CONNECT_AUTH_CACHE, 1 )? fopen( path, "r" ): NULL;
+    free( path );
+    if ( fp == NULL )
+        return -1;
+    while ( ret < 0 && fgets( line, sizeof(line), fp ) != NULL ) {
+        if ( (n = auth_cache_parse( line, name, &p )) < 0 ||
+             p != port || strcmp( name, host ) != 0 )
+            continue;
+        line[strcspn( line, "\r\n" )] = '\0';
+        snprintf( buf, size, "%s", line + n );
+        ret = 0;
+    }
+    fclose( fp );
+    return ret;
+}
+
+/* write record REC of relay server HOST:PORT, or remove it if REC is
+   NULL.  Records of other servers are kept unless expired.  Caller
+   holds auth_cache_lock(). */
+void
+auth_cache_put( const char *host, int port, const char *rec )
+{
+    char *path = home_path( AUTH_CACHE_FILE );
+    char *tmp, line[1024], name[1024];
+    FILE *in, *out;
+    int p, ok;
+
+    if ( !getparam_bool( ENV_CONNECT_AUTH_CACHE, 1 ) ) {
+        free( path );
+        return;
+    }
+    make_parent_dirs( path );
+    tmp = xmalloc( strlen(path) + 16 );
+    sprintf( tmp, "%s.%d", path, (int)getpid() );
+    out = fopen( tmp, "w" );
+    if ( out == NULL ) {
+        debug("cannot save auth cache, errno=%d\n", errno);
+        free( tmp );
+        free( path );
+        return;
+    }
+    if ( rec != NULL )
+        fprintf( out, "%s %d %ld %s\n", host, port, (long)time( NULL ), rec );
+    if ( (in = fopen( path, "r" )) != NULL ) {
+        while ( fgets( line, sizeof(line), in ) != NULL ) {
+            if ( auth_cache_parse( line, name, &p ) < 0 )
+                continue;                       /* expired */
+            if ( p == port && strcmp( name, host ) == 0 )
+                continue;                       /* replaced */
+            fputs( line, out );
+        }
+        fclose( in );
+    }
+    ok = (fclose( out ) == 0);
+    if ( !ok || rename( tmp, path ) != 0 )
+        unlink( tmp );
+    free( tmp );
+    free( path );
+}
+#else /* _WIN32 */
+#define auth_cache_get(host, port, buf, size)   (-1)    /* not supported */
+#define auth_cache_put(host, port, rec)         /* not supported */
+#define auth_cache_lock()                       (-1)
+#define auth_cache_unlock(fd)
+#endif /* _WIN32 */
+
+/** DIGEST AUTHENTICATION **/
+
+/* Digest scheme for HTTP proxy (RFC 7616) with MD5 or SHA-256, and
+   their -sess variants.  No crypto library is needed, both hashes are
+   here.  After success the challenge is kept in the auth cache with
+   its nonce-count, so later connections answer it with the first
+   request.  If the proxy rejects it (ex. stale nonce), the new
+   challenge in the 407 is answered. */
+#define DIGEST_MD5      0
+#define DIGEST_SHA256   1
+char *digest_alg_names[] = { "MD5", "SHA-256" };
+
+typedef struct {
+    int alg;                                    /* DIGEST_xxx */
+    int sess;                                   /* -sess variant */
+    int userhash;                               /* user name is hashed */
+    char qop[16];                               /* "auth", "auth-int", "" */
+    char realm[256];
+    char nonce[256];
+    char opaque[256];
+    long nc;                                    /* nonce-count used last */
+} DIGEST;
+
+DIGEST digest;
+
+#define ROL32(x, n) ((((x) << (n)) | ((x) >> (32 - (n)))) & 0xFFFFFFFFUL)
+#define ROR32(x, n) ((((x) >> (n)) | ((x) << (32 - (n)))) & 0xFFFFFFFFUL)
+
+/* fill BLOCK with 64 bytes at OFF of message MSG of LEN bytes padded
+   to TOTAL bytes, bit length at the end in big endian if BIG. */
+void
+hash_block( const unsigned char *msg, long len, long total, long off,
+            unsigned char *block, int big )
+{
+    u_long bits = (u_long)len * 8;
+    long p;
+    int i, shift;
+
+    for ( i = 0; i < 64; i++ ) {
+        p = off + i;
+        if ( p < len ) {
+            block[i] = msg[p];
+        } else if ( p == len ) {
+            block[i] = 0x80;
+        } else if ( p < total - 8 ) {
+            block[i] = 0;
+        } else {
+            shift = (int)(p - (total - 8)) * 8;
+            if ( big )
+                shift = 56 - shift;
+            block[i] = (shift < 32)? (bits >> shift) & 0xFF: 0;
+        }
+    }
+}
+
+/* MD5 (RFC 1321) of LEN bytes at MSG into OUT[16] */
+void
+md5( const unsigned char *msg, long len, unsigned char *out )
+{
+    static const u_long k[64] = {
+        0xd76aa478, 0xe8c7b756, 0x242070db, 0xc1bdceee, 0xf57c0faf,
+        0x4787c62a, 0xa8304613, 0xfd469501, 0x698098d8, 0x8b44f7af,
+        0xffff5bb1, 0x895cd7be, 0x6b901122, 0xfd987193, 0xa679438e,
+        0x49b40821, 0xf61e2562, 0xc040b340, 0x265e5a51, 0xe9b6c7aa,
+        0xd62f105d, 0x02441453, 0xd8a1e681, 0xe7d3fbc8, 0x21e1cde6,
+        0xc33707d6, 0xf4d50d87, 0x455a14ed, 0xa9e3e905, 0xfcefa3f8,
+        0x676f02d9, 0x8d2a4c8a, 0xfffa3942, 0x8771f681, 0x6d9d6122,
+        0xfde5380c, 0xa4beea44, 0x4bdecfa9, 0xf6bb4b60, 0xbebfbc70,
+        0x289b7ec6, 0xeaa127fa, 0xd4ef3085, 0x04881d05, 0xd9d4d039,
+        0xe6db99e5, 0x1fa27cf8, 0xc4ac5665, 0xf4292244, 0x432aff97,
+        0xab9423a7, 0xfc93a039, 0x655b59c3, 0x8f0ccc92, 0xffeff47d,
+        0x85845dd1, 0x6fa87e4f, 0xfe2ce6e0, 0xa3014314, 0x4e0811a1,
+        0xf7537e82, 0xbd3af235, 0x2ad7d2bb, 0xeb86d391
+    };
+    static const int r[16] = { 7, 12, 17, 22, 5, 9, 14, 20,
+                               4, 11, 16, 23, 6, 10, 15, 21 };
+    u_long h[4] = { 0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476 };
+    u_long a, b, c, d, f, t, w[16];
+    unsigned char block[64];
+    long off, total = (len + 8) / 64 * 64 + 64;
+    int i, g;
+
+    for ( off = 0; off < total; off += 64 ) {
+        hash_block( msg, len, total, off, block, 0 );
+        for ( i = 0; i < 16; i++ )
+            w[i] = (u_long)block[i*4] | ((u_long)block[i*4+1] << 8) |
+                ((u_long)block[i*4+2] << 16) | ((u_long)block[i*4+3] << 24);
+        a = h[0], b = h[1], c = h[2], d = h[3];
+        for ( i = 0; i < 64; i++ ) {
+            if ( i < 16 ) {
+                f = (b & c) | (~b & d);
+                g = i;
+            } else if ( i < 32 ) {
+                f = (d & b) | (~d & c);
+                g = (5 * i + 1) % 16;
+            } else if ( i < 48 ) {
+                f = b ^ c ^ d;
+                g = (3 * i + 5) % 16;
+            } else {
+                f = c ^ (b | ~d);
+                g = (7 * i) % 16;
+            }
+            f = (a + (f & 0xFFFFFFFFUL) + k[i] + w[g]) & 0xFFFFFFFFUL;
+            t = d;
+            d = c;
+            c = b;
+            b = (b + ROL32( f, r[i/16*4 + i%4] )) & 0xFFFFFFFFUL;
+            a = t;
+        }
+        h[0] = (h[0] + a) & 0xFFFFFFFFUL;
+        h[1] = (h[1] + b) & 0xFFFFFFFFUL;
+        h[2] = (h[2] + c) & 0xFFFFFFFFUL;
+        h[3] = (h[3] + d) & 0xFFFFFFFFUL;
+    }
+    for ( i = 0; i < 16; i++ )
+        out[i] = (h[i/4] >> (i%4 * 8)) & 0xFF;
+}
+
+/* SHA-256 (FIPS 180-4) of LEN bytes at MSG into OUT[32] */
+void
+sha256( const unsigned char *msg, long len, unsigned char *out )
+{
+    static const u_long k[64] = {
+        0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b,
+        0x59f111f1, 0x923f82a4, 0xab1c5ed5, 0xd807aa98, 0x12835b01,
+        0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7,
+        0xc19bf174, 0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc,
+        0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da, 0x983e5152,
+        0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147,
+        0x06ca6351, 0x14292967, 0x27b70a85, 0x2e1b2138, 0x4d2c6dfc,
+        0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+        0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819,
+        0xd6990624, 0xf40e3585, 0x106aa070, 0x19a4c116, 0x1e376c08,
+        0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f,
+        0x682e6ff3, 0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208,
+        0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+    };
+    u_long h[8] = { 0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+                    0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19 };
+    u_long v[8], w[64], s0, s1, t1, t2;
+    unsigned char block[64];
+    long off, total = (len + 8) / 64 * 64 + 64;
+    int i;
+
+    for ( off = 0; off < total; off += 64 ) {
+        hash_block( msg, len, total, off, block, 1 );
+        for ( i = 0; i < 16; i++ )
+            w[i] = ((u_long)block[i*4] << 24) | ((u_long)block[i*4+1] << 16) |
+                ((u_long)block[i*4+2] << 8) | (u_long)block[i*4+3];
+        for ( i = 16; i < 64; i++ ) {
+            s0 = ROR32( w[i-15], 7 ) ^ ROR32( w[i-15], 18 ) ^ (w[i-15] >> 3);
+            s1 = ROR32( w[i-2], 17 ) ^ ROR32( w[i-2], 19 ) ^ (w[i-2] >> 10);
+            w[i] = (w[i-16] + s0 + w[i-7] + s1) & 0xFFFFFFFFUL;
+        }
+        for ( i = 0; i < 8; i++ )
+            v[i] = h[i];
+        for ( i = 0; i < 64; i++ ) {
+            s1 = ROR32( v[4], 6 ) ^ ROR32( v[4], 11 ) ^ ROR32( v[4], 25 );
+            t1 = (v[7] + s1 + ((v[4] & v[5]) ^ (~v[4] & v[6])) + k[i] + w[i])
+                & 0xFFFFFFFFUL;
+            s0 = ROR32( v[0], 2 ) ^ ROR32( v[0], 13 ) ^ ROR32( v[0], 22 );
+            t2 = (s0 + ((v[0] & v[1]) ^ (v[0] & v[2]) ^ (v[1] & v[2])))
+                & 0xFFFFFFFFUL;
+            v[7] = v[6];
+            v[6] = v[5];
+            v[5] = v[4];
+            v[4] = (v[3] + t1) & 0xFFFFFFFFUL;
+            v[3] = v[2];
+            v[2] = v[1];
+            v[1] = v[0];
+            v[0] = (t1 + t2) & 0xFFFFFFFFUL;
+        }
+        for ( i = 0; i < 8; i++ )
+            h[i] = (h[i] + v[i]) & 0xFFFFFFFFUL;
+    }
+    for ( i = 0; i < 32; i++ )
+        out[i] = (h[i/4] >> (24 - i%4 * 8)) & 0xFF;
+}
+
+/* hash STR by algorithm of digest into HEX of 65 bytes */
+void
+digest_hex( const char *str, char *hex )
+{
+    unsigned char out[32];
+    int i, n;
+
+    if ( digest.alg == DIGEST_SHA256 ) {
+        sha256( (const unsigned char *)str, strlen(str), out );
+        n = 32;
+    } else {
+        md5( (const unsigned char *)str, strlen(str), out );
+        n = 16;
+    }
+    for ( i = 0; i < n; i++ )
+        sprintf( hex + i*2, "%02x", out[i] );
+    memset( out, 0, sizeof(out) );
+}
+
+/* parse parameters of Digest challenge STR into D, like
+   'realm="x", nonce="y", algorithm=SHA-256, qop="auth"'.
+   Returns 0, or -1 if it can't be answered. */
+int
+digest_parse( const char *str, DIGEST *d )
+{
+    char key[32], val[256], *dst, *tok;
+    int n;
+
+    memset( d, 0, sizeof(*d) );
+    while ( 1 ) {
+        str += strspn( str, " \t,\r\n" );
+        if ( *str == '\0' )
+            break;
+        n = strcspn( str, "= \t" );
+        snprintf( key, sizeof(key), "%.*s", n, str );
+        str += n;
+        if ( *str != '=' )
+            return -1;
+        dst = val;
+        if ( *++str == '"' ) {                  /* quoted-string */
+            for ( str++; *str && *str != '"'; str++ ) {
+                if ( *str == '\\' && str[1] != '\0' )
+                    str++;
+                if ( dst < val + sizeof(val) - 1 )
+                    *dst++ = *str;
+            }
+            if ( *str == '"' )
+                str++;
+        } else {                                /* token */
+            for ( ; *str && !strchr( ", \t\r\n", *str ); str++ )
+                if ( dst < val + sizeof(val) - 1 )
+                    *dst++ = *str;
+        }
+        *dst = '\0';
+        downcase( key );
+        if ( strcmp( key, "realm" ) == 0 ) {
+            strcpy( d->realm, val );
+        } else if ( strcmp( key, "nonce" ) == 0 ) {
+            strcpy( d->nonce, val );
+        } else if ( strcmp( key, "opaque" ) == 0 ) {
+            strcpy( d->opaque, val );
+        } else if ( strcmp( key, "algorithm" ) == 0 ) {
+            if ( expect( val, "SHA-256" ) ) {
+                d->alg = DIGEST_SHA256;
+                tok = val + 7;
+            } else if ( expect( val, "MD5" ) ) {
+                d->alg = DIGEST_MD5;
+                tok = val + 3;
+            } else {
+                debug("Unsupported digest algorithm: %s\n", val);
+                return -1;
+            }
+            d->sess = expect( tok, "-sess" );
+            if ( *tok != '\0' && !d->sess ) {
+                debug("Unsupported digest algorithm: %s\n", val);
+                return -1;
+            }
+        } else if ( strcmp( key, "qop" ) == 0 ) {
+            downcase( val );
+            for ( tok = strtok( val, ", \t" ); tok != NULL;
+                  tok = strtok( NULL, ", \t" ) )
+                if ( strcmp( tok, "auth" ) == 0 ||
+                     (strcmp( tok, "auth-int" ) == 0 && d->qop[0] == '\0') )
+                    strcpy( d->qop, tok );
+            if ( d->qop[0] == '\0' ) {
+                debug("Unsupported digest qop: %s\n", val);
+                return -1;
+            }
+        } else if ( strcmp( key, "userhash" ) == 0 ) {
+            d->userhash = expect( val, "true" );
+        } else if ( strcmp( key, "nc" ) == 0 ) {
+            d->nc = atol( val );                /* in auth cache only */
+        }
+    }
+    return (d->nonce[0] == '\0')? -1: 0;
+}
+
+/* append ', KEY="VAL"' to BUF of SIZE bytes holding LEN bytes.
+   Returns new length. */
+int
+put_quoted( char *buf, int size, int len, const char *key, const char *val )
+{
+    len += snprintf( buf + len, size - len, ", %s=\"", key );
+    for ( ; *val && len < size - 3; val++ ) {
+        if ( *val == '"' || *val == '\\' )
+            buf[len++] = '\\';
+        buf[len++] = *val;
+    }
+    buf[len++] = '"';
+    buf[len] = '\0';
+    return len;
+}
+
+/* make record of digest for the auth cache into BUF */
+void
+digest_record( char *buf, int size )
+{
+    int len;
+
+    len = snprintf( buf, size, "digest algorithm=%s%s, nc=%ld",
+                    digest_alg_names[digest.alg],
+                    digest.sess? "-sess": "", digest.nc );
+    len = put_quoted( buf, size, len, "realm", digest.realm );
+    len = put_quoted( buf, size, len, "nonce", digest.nonce );
+    if ( digest.opaque[0] != '\0' )
+        len = put_quoted( buf, size, len, "opaque", digest.opaque );
+    if ( digest.qop[0] != '\0' )
+        len = put_quoted( buf, size, len, "qop", digest.qop );
+    if ( digest.userhash )
+        snprintf( buf + len, size - len, ", userhash=true" );
+}
+
+/* share nonce-count of digest with other processes through the auth
+   cache, under lock.  With TAKE, the next count is taken for a request
+   and recorded if the nonce is cached.  Otherwise digest is recorded
+   without lowering the count taken by others. */
+void
+digest_sync( int take )
+{
+    char rec[1024];
+    DIGEST d;
+    int lock = auth_cache_lock(), cached = 0;
+
+    if ( auth_cache_get( relay_host, relay_port, rec, sizeof(rec) ) == 0 &&
+         expect( rec, "digest " ) && digest_parse( rec+7, &d ) == 0 &&
+         strcmp( d.nonce, digest.nonce ) == 0 ) {
+        cached = 1;
+        if ( digest.nc < d.nc )
+            digest.nc = d.nc;                   /* counted by others */
+    }
+    if ( take )
+        digest.nc++;
+    if ( cached || !take ) {
+        digest_record( rec, sizeof(rec) );
+        auth_cache_put( relay_host, relay_port, rec );
+    }
+    auth_cache_unlock( lock );
+}
+
+/* make client nonce of 16 hex digits into HEX */
+void
+make_cnonce( char *hex )
+{
+    unsigned char buf[8];
+    FILE *fp;
+    int i;
+
+    fp = fopen( "/dev/urandom", "rb" );
+    if ( fp == NULL || fread( buf, 1, sizeof(buf), fp ) != sizeof(buf) ) {
+        srand( (unsigned)time( NULL ) ^ (unsigned)now_msec() );
+        for ( i = 0; i < (int)sizeof(buf); i++ )
+            buf[i] = rand() & 0xFF;
+    }
+    if ( fp != NULL )
+        fclose( fp );
+    for ( i = 0; i < (int)sizeof(buf); i++ )
+        sprintf( hex + i*2, "%02x", buf[i] );
+}
+
+/* queue Proxy-Authorization header of Digest scheme answering the
+   challenge in digest with next nonce-count */
+int
+digest_auth( NEGO *ng )
+{
+    char buf[2048], uri[300], ha1[65], ha2[65], resp[65], user[256];
+    char cnonce[17], *pass;
+    int len, ret;
+
+    if (relay_user == NULL)
+        fatal("Cannot decide username for proxy authentication.");
+    if ((pass = get_relay_password("Enter proxy authentication password for %s@%s: ")) == NULL)
+        fatal("Cannot decide password for proxy authentication.");
+
+    snprintf( uri, sizeof(uri), "%s:%d", dest_host, dest_port );
+    make_cnonce( cnonce );
+    digest_sync( 1 );                           /* next nonce-count */
+    snprintf( buf, sizeof(buf), "%s:%s:%s", relay_user, digest.realm, pass );
+    digest_hex( buf, ha1 );
+    memset( buf, 0, sizeof(buf) );
+    memset( pass, 0, strlen(pass) );
+    free( pass );
+    if ( digest.sess ) {
+        snprintf( buf, sizeof(buf), "%s:%s:%s", ha1, digest.nonce, cnonce );
+        digest_hex( buf, ha1 );
+    }
+    if ( strcmp( digest.qop, "auth-int" ) == 0 ) {
+        digest_hex( "", ha2 );                  /* empty entity-body */
+        snprintf( buf, sizeof(buf), "CONNECT:%s:%s", uri, ha2 );
+    } else {
+        snprintf( buf, sizeof(buf), "CONNECT:%s", uri );
+    }
+    digest_hex( buf, ha2 );
+    if ( digest.qop[0] != '\0' )
+        snprintf( buf, sizeof(buf), "%s:%s:%08lx:%s:%s:%s", ha1,
+                  digest.nonce, digest.nc, cnonce, digest.qop, ha2 );
+    else
+        snprintf( buf, sizeof(buf), "%s:%s:%s", ha1, digest.nonce, ha2 );
+    digest_hex( buf, resp );
+    memset( ha1, 0, sizeof(ha1) );
+    if ( digest.userhash ) {
+        snprintf( buf, sizeof(buf), "%s:%s", relay_user, digest.realm );
+        digest_hex( buf, user );
+    } else {
+        snprintf( user, sizeof(user), "%s", relay_user );
+    }
+
+    len = snprintf( buf, sizeof(buf), "Proxy-Authorization: Digest "
+                    "algorithm=%s%s", digest_alg_names[digest.alg],
+                    digest.sess? "-sess": "" );
+    len = put_quoted( buf, sizeof(buf), len, "username", user );
+    len = put_quoted( buf, sizeof(buf), len, "realm", digest.realm );
+    len = put_quoted( buf, sizeof(buf), len, "nonce", digest.nonce );
+    len = put_quoted( buf, sizeof(buf), len, "uri", uri );
+    len = put_quoted( buf, sizeof(buf), len, "response", resp );
+    if ( digest.opaque[0] != '\0' )
+        len = put_quoted( buf, sizeof(buf), len, "opaque", digest.opaque );
+    if ( digest.qop[0] != '\0' ) {
+        len += snprintf( buf + len, sizeof(buf) - len, ", qop=%s, nc=%08lx",
+                         digest.qop, digest.nc );
+        len = put_quoted( buf, sizeof(buf), len, "cnonce", cnonce );
+    }
+    if ( digest.userhash )
+        len += snprintf( buf + len, sizeof(buf) - len, ", userhash=true" );
+    len += snprintf( buf + len, sizeof(buf) - len, "\r\n" );
+    ret = nego_send( ng, buf, len, 1 );
+    report_text( ">>>", "Proxy-Authorization: Digest xxxxx\r\n" );
+    memset( buf, 0, sizeof(buf) );
+    return ret;
+}
+
+/* decide scheme to send credentials with the first request, by cache */
+void
+auth_cache_load( void )
+{
+    char rec[1024];
+
+    if ( proxy_auth_type != PROXY_AUTH_NONE || relay_user == NULL ||
+         auth_cache_get( relay_host, relay_port, rec, sizeof(rec) ) < 0 )
+        return;
+    if ( expect( rec, "basic" ) ) {
+        proxy_auth_type = PROXY_AUTH_BASIC;
+    } else if ( expect( rec, "digest " ) && digest_parse( rec+7, &digest ) == 0 ) {
+        proxy_auth_type = PROXY_AUTH_DIGEST;
+    } else {
+        return;
+    }
+    auth_cached = 1;
+    debug("%s:%d wants %s auth, sending credentials at once.\n",
+          relay_host, relay_port,
+          (proxy_auth_type == PROXY_AUTH_BASIC)? "basic": "digest");
+}
+
+/* queue Proxy-Authorization header of Basic scheme */
+int
+basic_auth( NEGO *ng )
+{
+    char *userpass;
+    char *cred;
+    const char *user = relay_user;
+    char *pass = NULL;
+    int len, ret;
+
+    /* Get username/password for authentication */
+    if (user == NULL)
+        fatal("Cannot decide username for proxy authentication.");
+    if ((pass = get_relay_password("Enter proxy authentication password for %s@%s: ")) == NULL)
+        fatal("Cannot decide password for proxy authentication.");
+
+    len = strlen(user)+strlen(pass)+1;
+    userpass = xmalloc(len+1);
+    snprintf(userpass, len+1, "%s:%s", user, pass);
+    memset (pass, 0, strlen(pass));
+    free (pass);
+    cred = make_base64_string(userpass);
+    memset (userpass, 0, len);
+    free (userpass);
+
+    len = strlen(cred) + 32;
+    userpass = xmalloc(len);
+    snprintf(userpass, len, "Proxy-Authorization: Basic %s\r\n", cred);
+    ret = nego_send(ng, userpass, strlen(userpass), 1);
+    report_text(">>>", "Proxy-Authorization: Basic xxxxx\r\n");
+
+    memset(userpass, 0, len);
+    free(userpass);
+    memset(cred, 0, strlen(cred));
+    free(cred);
+
+    return ret;
+}
+
+/* begin relaying via HTTP proxy
+   Directs CONNECT method to proxy server to connect to
+   destination host (and port). It may not be allowed on your
+   proxy server.
+ */
+int
+begin_http_relay( NEGO *ng )
+{
+    debug("begin_http_relay()\n");
+
+    auth_cache_load();
+    /* HTTP/1.1 to keep connection after 407 */
+    if (nego_sendf(ng, "CONNECT %s:%d HTTP/1.1\r\nHost: %s:%d\r\n",
+                   dest_host, dest_port, dest_host, dest_port) < 0)
+        return START_ERROR;
+    if (proxy_auth_type == PROXY_AUTH_BASIC && basic_auth (ng) < 0)
+        return START_ERROR;
+    if (proxy_auth_type == PROXY_AUTH_DIGEST && digest_auth (ng) < 0)
+        return START_ERROR;
+    if (nego_sendf(ng, "\r\n") < 0)
+        return START_ERROR;
+    nego_phase(ng, NS_HTTP_STATUS, "http connect");
+    return START_AGAIN;
+}
+
+/* skip body of 401/407 response, then send request again with
+   authentication on the same connection.  Closed connection is
+   retried by new one. */
+int
+http_body( NEGO *ng )
+{
+    char *line;
+    long len;
+
+    while ( 1 ) {
+        if ( ng->state == NS_HTTP_BODY ) {
+            len = ng->in.len - ng->in.ptr;
+            if ( ng->body < len )
+                len = ng->body;
+            ng->in.ptr += len;
+            ng->body -= len;
+            if ( 0 < ng->body )
+                return ng->eof? START_RETRY: START_AGAIN;
+            if ( !ng->chunked )
+                break;
+            ng->state = NS_HTTP_CHUNK;
+        }
+        if ( (line = nego_line( ng )) == NULL )
+            return ng->eof? START_RETRY: START_AGAIN;
+        if ( ng->state == NS_HTTP_CHUNK ) {
+            if ( strcmp( line, "\r\n" ) == 0 )
+                continue;                       /* end of chunk data */
+            ng->body = strtol( line, NULL, 16 );
+            ng->state = (ng->body == 0)? NS_HTTP_TRAILER: NS_HTTP_BODY;
+        } else if ( strcmp( line, "\r\n" ) == 0 ) {
+            break;                              /* end of trailer */
+        }
+    }
+    debug("sending request again on the same connection.\n");
+    return begin_http_relay( ng );
+}
+
+/* end of response header of HTTP proxy */
+int
+http_done( NEGO *ng )
+{
+    switch ( ng->status ) {
+    case 200:
+        /* Conguraturation, connected via http proxy server! */
+        debug("connected, start user session.\n");
+        if ( proxy_auth_type == PROXY_AUTH_DIGEST ) {
+            digest_sync( 0 );                   /* with nonce-count */
+            auth_cached = 1;
+        } else if ( proxy_auth_type == PROXY_AUTH_BASIC && !auth_cached ) {
+            int lock = auth_cache_lock();
+            auth_cache_put( relay_host, relay_port, "basic" );
+            auth_cache_unlock( lock );
+            auth_cached = 1;
+        }
+        return START_OK;
+    case 302:                                   /* redirect */
+        return START_RETRY;
+    default:                                    /* 401 or 407 */
+        if ( proxy_auth_type == PROXY_AUTH_NONE ) {
+            debug("Can't find %s in response header.\n",
+                  (ng->status == 401)? "WWW-Authenticate": "Proxy-Authenticate");
+            return START_ERROR;
+        }
+        if ( !ng->keep_alive || (!ng->chunked && ng->body < 0) )
+            return START_RETRY;                 /* with authentication */
+        nego_phase( ng, ng->chunked? NS_HTTP_CHUNK: NS_HTTP_BODY,
+                    "http body" );
+        return http_body( ng );
+    }
+}
+
+int
+http_step( NEGO *ng )
+{
+    char *buf, *auth_what, raw[NEGO_LINE_MAX];
+    DIGEST d;
+
+    if ( NS_HTTP_BODY <= ng->state )
+        return http_body( ng );
+    while ( (buf = nego_line( ng )) != NULL ) {
+        if ( ng->state == NS_HTTP_STATUS ) {
+            /* check status */
+            if (!strchr(buf, ' ')) {
+                error ("Unexpected http response: '%s'.\n", buf);
+                return START_ERROR;
+            }
+            ng->status = atoi(strchr(buf,' '));
+            ng->keep_alive = !expect(buf, "HTTP/1.0");
+            ng->chunked = 0;
+            ng->body = -1;
+            switch ( ng->status ) {
+            case 200:
+            case 302:
+                break;
+            /* We handle both 401 and 407 codes here: 401 is
+             * WWW-Authenticate, which not strictly the correct response,
+             * but some proxies do send this (e.g. Symantec's Raptor
+             * firewall) */
+            case 401:                           /* WWW-Auth required */
+            case 407:                           /* Proxy-Auth required */
+                /* If proxy_auth_type is set and get this result code,
+                   authentication was failed, unless credentials were
+                   sent by cache without challenge. */
+                if (proxy_auth_type != PROXY_AUTH_NONE) {
+                    if (!auth_cached) {
+                        error("Authentication failed.\n");
+                        forget_relay_password();
+                        return START_ERROR;
+                    }
+                    debug("cached authentication is rejected.\n");
+                    auth_cached = 0;
+                    proxy_auth_type = PROXY_AUTH_NONE;  /* learn again */
+                }
+                break;
+            default:
+                /* Not allowed */
+                debug("http proxy is not allowed.\n");
+                return START_ERROR;
+            }
+            nego_phase( ng, NS_HTTP_HEADER, "http header" );
+            continue;
+        }
+        if ( strcmp(buf, "\r\n") == 0 )
+            return http_done( ng );             /* end of header */
+        strcpy(raw, buf);                       /* digest is case-sensitive */
+        downcase(buf);
+        auth_what = (ng->status == 401) ? "WWW-Authenticate:" : "Proxy-Authenticate:";
+        if ( ng->status == 302 && expect(buf, "Location: ") ) {
+            char *host, *port;
+            if ( (host = cut_token(buf, "//")) != NULL ) {
+                cut_token(host, "/");
+                port = cut_token(host, ":");
+                relay_host = strdup(host);
+                if ( port != NULL )
+                    relay_port = atoi(port);
+            }
+        } else if ( expect(buf, "content-length:") ) {
+            ng->body = atol(buf + 15);
+        } else if ( expect(buf, "transfer-encoding:") ) {
+            ng->chunked = (strstr(buf, "chunked") != NULL);
+        } else if ( expect(buf, "connection:") ||
+                    expect(buf, "proxy-connection:") ) {
+            if ( strstr(buf, "close") != NULL )
+                ng->keep_alive = 0;
+            else if ( strstr(buf, "keep-alive") != NULL )
+                ng->keep_alive = 1;
+        } else if ( ng->status != 200 && ng->status != 302 &&
+                    expect(buf, auth_what) ) {
+            /** NOTE: We support BASIC and DIGEST schemes, realm is
+                used only by DIGEST. */
+            char *scheme, *realm;
+            scheme = cut_token(buf, " ");
+            realm = cut_token(scheme, " ");
+            if ( scheme == NULL || realm == NULL ) {
+                debug("Invalid format of %s field.\n", auth_what);
+                return START_ERROR;             /* fail */
+            }
+            /* check supported auth type, stronger one is used */
+            if (expect(scheme, "digest")) {
+                if (digest_parse(raw + (realm - buf), &d) == 0 &&
+                    (proxy_auth_type != PROXY_AUTH_DIGEST || digest.alg < d.alg)) {
+                    digest = d;
+                    proxy_auth_type = PROXY_AUTH_DIGEST;
+                }
+            } else if (expect(scheme, "basic")) {
+                if (proxy_auth_type == PROXY_AUTH_NONE)
+                    proxy_auth_type = PROXY_AUTH_BASIC;
+            } else {
+                debug("Unsupported authentication type: %s\n", scheme);
+            }
+        }
+    }
+    /* closed without end of header is enough to retry */
+    if ( ng->eof && ng->state == NS_HTTP_HEADER && ng->status != 200 )
+        return http_done( ng );
+    return START_AGAIN;
+}
+
+/* begin relaying via TELNET proxy.
+   Sends string specified by telnet_command (-c option) with
+   replacing host name and port number to the socket.  */
+int
+begin_telnet_relay( NEGO *ng )
+{
+    char *cmd;
+    char sep = ' ';
+    int i, ret;
+
+    debug("begin_telnet_relay()\n");
+
+    /* report phrase */
+    debug("good phrase: '%s'\n", telnet_good_phrase);
+    debug("bad phrases");
+    sep = ':';
+    for (i=0; i < N_TELNET_BAD_PHRASES; i++) {
+	debug_("%c '%s'", sep, telnet_bad_phrases[i]);
+	sep = ',';
+    }
+    debug_("\n");
+
+    /* make request string with replacing %h by destination hostname
+       and %p by port number, etc. */
+    cmd = expand_host_and_port(telnet_command, dest_host, dest_port);
+
+    /* Sorry, we send request string now without waiting a prompt. */
+    ret = nego_sendf(ng, "%s\r\n", cmd);
+    free(cmd);
+    if (ret < 0)
+        return START_ERROR;
+    nego_phase(ng, NS_TELNET, "telnet");
+    return START_AGAIN;
+}
+
+/* Process answer from proxy until good or bad phrase is detected.  We
+   assume that the good phrase should be appeared only in the final
+   line of proxy responses. Bad keywods in the line causes operation
+   fail. First checks a good phrase, then checks bad phrases.
+   If no match, continue reading line from proxy. */
+int
+telnet_step( NEGO *ng )
+{
+    char *buf;
+    int i;
+
+    while ( (buf = nego_line( ng )) != NULL ) {
+	downcase(buf);
+	/* first, check good phrase */
+        if (strstr(buf, telnet_good_phrase)) {
+	    debug("good phrase is detected: '%s'\n", telnet_good_phrase);
+            return START_OK;
+        }
+	/* then, check bad phrase */
+	for (i=0; i < N_TELNET_BAD_PHRASES; i++) {
+	    if (strstr(buf, telnet_bad_phrases[i]) != NULL) {
+		debug("bad phrase is detected: '%s'\n", telnet_bad_phrases[i]);
+		return START_ERROR;
+	    }
+        }
+    }
+    return START_AGAIN;
+}
+
+/* queue first request of NG->method.  Returns START_xxx */
+int
+nego_start( NEGO *ng )
+{
+    switch ( ng->method ) {
+    case METHOD_SOCKS:
+        if ( socks_version == 5 )
+            return begin_socks5_relay( ng );
+        return begin_socks4_relay( ng );
+    case METHOD_HTTP:
+        return begin_http_relay( ng );
+    case METHOD_TELNET:
+        return begin_telnet_relay( ng );
+    }
+    return START_OK;                            /* nothing to do */
+}
+
+/* consume replies received.  Returns START_xxx */
+int
+nego_step( NEGO *ng )
+{
+    switch ( ng->method ) {
+    case METHOD_SOCKS:
+        if ( socks_version == 5 )
+            return socks5_step( ng );
+        return socks4_step( ng );
+    case METHOD_HTTP:
+        return http_step( ng );
+    case METHOD_TELNET:
+        return telnet_step( ng );
+    }
+    return START_ERROR;
+}
+
+/* move bytes read ahead in negotiation from S into RING.
+   Returns number of bytes moved. */
+int
+line_reader_drain( SOCKET s, RING *ring )
+{
+    int n, len, ret = 0;
+    char *ptr;
+
+    if ( line_reader.sock != s )
+        return 0;
+    while ( line_reader.ptr < line_reader.len ) {
+        ptr = ring_wptr( ring, &len );
+        if ( len == 0 )
+            break;                              /* no more room */
+        n = line_reader.len - line_reader.ptr;
+        if ( len < n )
+            n = len;
+        memcpy( ptr, line_reader.buf + line_reader.ptr, n );
+        ring_commit( ring, n );
+        line_reader.ptr += n;
+        ret += n;
+    }
+    if ( 0 < ret )
+        debug("%d bytes read ahead are passed to relay.\n", ret);
+    return ret;
+}
+
+
+/** BANDWIDTH SHAPING **/
+
+/* Sending of each session is limited by token buckets, one for each
+   direction (parameter CONNECT_RATE).  In daemon mode, total of all
+   sessions can be limited too (CONNECT_RATE_TOTAL), and it is shared
+   among sessions by deficit round robin: sessions of higher class are
+   served first, and ones of the same class get SHAPER_QUANTUM bytes
+   in turn.  Class is decided by destination with CONNECT_CLASS.
+   Receiving is never limited by itself, but a full relay buffer stops
+   reading, which slows down the sender. */
+#define SHAPE_UP        0                       /* local => remote */
+#define SHAPE_DOWN      1                       /* remote => local */
+
+#define SHAPER_TICK     10                      /* msec to wait tokens */
+#define SHAPER_QUANTUM  4096                    /* bytes per turn */
+#define SHAPER_DEPTH_MIN 4096                   /* min bucket depth */
+
+#define CLASS_INTERACTIVE 0
+#define CLASS_NORMAL    1
+#define CLASS_BULK      2
+#define N_CLASSES       3
+char *class_names[] = { "interactive", "normal", "bulk" };
+
+#define CLASS_DEFAULT   "interactive:22,23"     /* ssh and telnet */
+#define MAX_CLASS_RULES 32
+
+typedef struct {
+    long rate;                                  /* bytes/sec, 0 unlimited */
+    long depth;                                 /* max tokens */
+    double tokens;
+    long last;                                  /* msec of last refill */
+} BUCKET;
+
+typedef struct {
+    int class;                                  /* CLASS_xxx */
+    int lo, hi;                                 /* port range */
+    char *host;                                 /* or host name */
+} CLASS_RULE;
+
+int f_shaping = 0;                              /* any limit is set */
+long rate_session[2] = { 0, 0 };                /* CONNECT_RATE */
+long rate_total[2] = { 0, 0 };                  /* CONNECT_RATE_TOTAL */
+BUCKET bucket_total[2];
+CLASS_RULE class_rules[MAX_CLASS_RULES];
+int n_class_rules = 0;
+
+void
+bucket_init( BUCKET *b, long rate )
+{
+    b->rate = rate;
+    b->depth = (SHAPER_DEPTH_MIN < rate/4)? rate/4: SHAPER_DEPTH_MIN;
+    b->tokens = b->depth;                       /* allow first burst */
+    b->last = now_msec();
+}
+
+/* bytes which can be sent now, or -1 for unlimited */
+long
+bucket_avail( BUCKET *b )
+{
+    long now;
+
+    if ( b->rate == 0 )
+        return -1;
+    now = now_msec();
+    if ( b->last < now ) {
+        b->tokens += (double)(now - b->last) * b->rate / 1000;
+        if ( b->depth < b->tokens )
+            b->tokens = b->depth;
+        b->last = now;
+    }
+    return (long)b->tokens;
+}
+
+void
+bucket_take( BUCKET *b, long len )
+{
+    if ( b->rate != 0 )
+        b->tokens -= len;
+}
+
+/* smaller limit of A and B, where -1 is unlimited */
+long
+limit_min( long a, long b )
+{
+    if ( a < 0 )
+        return b;
+    if ( b < 0 || a < b )
+        return a;
+    return b;
+}
+
+/* parse rate "UP[:DOWN]" into RATE.  Returns -1 on error. */
+int
+parse_rate( const char *str, long *rate )
+{
+    char *buf = strdup( str ), *down;
+    int ret = 0;
+
+    if ( (down = strchr( buf, ':' )) != NULL )
+        *down++ = '\0';
+    if ( (rate[SHAPE_UP] = parse_size( buf )) < 0 ||
+         (rate[SHAPE_DOWN] = (down == NULL)? rate[SHAPE_UP]:
+          parse_size( down )) < 0 )
+        ret = -1;
+    free( buf );
+    return ret;
+}
+
+/* parse class rules like "interactive:22,23 bulk:873,.mirror.org".
+   Items are port number or range, or host name where leading dot
+   matches any host in the domain.  First match is used.
+   Returns -1 on error. */
+int
+parse_class_rules( const char *str )
+{
+    char *buf = strdup( str ), *rule, *item, *next, *ports;
+    CLASS_RULE *r;
+    int class;
+
+    downcase( buf );
+    n_class_rules = 0;
+    for ( rule = strtok( buf, " \t;" ); rule != NULL;
+          rule = strtok( NULL, " \t;" ) ) {
+        if ( (item = strchr( rule, ':' )) == NULL )
+            goto invalid;
+        *item++ = '\0';
+        for ( class = 0; class < N_CLASSES; class++ )
+            if ( strcmp( rule, class_names[class] ) == 0 )
+                break;
+        if ( class == N_CLASSES )
+            goto invalid;
+        for ( ; item != NULL && *item; item = next ) {
+            if ( (next = strchr( item, ',' )) != NULL )
+                *next++ = '\0';
+            if ( MAX_CLASS_RULES <= n_class_rules ) {
+                error("too many class rules.\n");
+                free( buf );
+                return -1;
+            }
+            r = &class_rules[n_class_rules++];
+            r->class = class;
+            r->host = NULL;
+            if ( !isdigit( (unsigned char)*item ) ) {
+                r->host = strdup( item );
+                continue;
+            }
+            r->lo = r->hi = strtol( item, &ports, 10 );
+            if ( *ports == '-' )
+                r->hi = strtol( ports+1, &ports, 10 );
+            if ( *ports != '\0' )
+                goto invalid;
+        }
+    }
+    free( buf );
+    return 0;
+
+invalid:
+    error("invalid class rule: %s\n", rule);
+    free( buf );
+    return -1;
+}
+
+/* decide class of session to HOST and PORT */
+int
+shaper_class( const char *host, u_short port )
+{
+    CLASS_RULE *r;
+    char name[256];
+    int i, len, hlen;
+
+    snprintf( name, sizeof(name), "%s", host );
+    downcase( name );
+    hlen = strlen( name );
+    for ( i = 0; i < n_class_rules; i++ ) {
+        r = &class_rules[i];
+        if ( r->host == NULL ) {
+            if ( r->lo <= port && port <= r->hi )
+                return r->class;
+            continue;
+        }
+        len = strlen( r->host );
+        if ( strcmp( name, r->host ) == 0 ||
+             (r->host[0] == '.' && len < hlen &&
+              strcmp( name + hlen - len, r->host ) == 0) )
+            return r->class;
+    }
+    return CLASS_NORMAL;
+}
+
+/* read parameters of shaping */
+void
+shaper_init( void )
+{
+    char *param;
+
+    if ( (param = getparam( ENV_CONNECT_RATE )) != NULL &&
+         parse_rate( param, rate_session ) < 0 )
+        fatal("invalid %s: %s\n", ENV_CONNECT_RATE, param);
+    if ( (param = getparam( ENV_CONNECT_RATE_TOTAL )) != NULL &&
+         parse_rate( param, rate_total ) < 0 )
+        fatal("invalid %s: %s\n", ENV_CONNECT_RATE_TOTAL, param);
+    if ( (param = getparam( ENV_CONNECT_CLASS )) == NULL )
+        param = CLASS_DEFAULT;
+    if ( parse_class_rules( param ) < 0 )
+        exit(1);
+    if ( !f_daemon )
+        rate_total[SHAPE_UP] = rate_total[SHAPE_DOWN] = 0;
+    bucket_init( &bucket_total[SHAPE_UP], rate_total[SHAPE_UP] );
+    bucket_init( &bucket_total[SHAPE_DOWN], rate_total[SHAPE_DOWN] );
+    f_shaping = (rate_session[SHAPE_UP] || rate_session[SHAPE_DOWN] ||
+                 rate_total[SHAPE_UP] || rate_total[SHAPE_DOWN]);
+    if ( f_shaping )
+        debug("shaping: session %ld/%ld, total %ld/%ld bytes/sec\n",
+              rate_session[SHAPE_UP], rate_session[SHAPE_DOWN],
+              rate_total[SHAPE_UP], rate_total[SHAPE_DOWN]);
+}
+
+
+/** SPILL BUFFER **/
+
+/* With option 'P', data from remote while no local client is attached
+   is kept here, then delivered to the next client before anything
+   else.  It grows in memory up to spill_memory, then is moved to an
+   unlinked temporary file mapped into memory of spill_max bytes.
+   Data is kept contiguous, so it is a plain FIFO of bytes. */
+typedef struct {
+    char *buf;
+    long size;                                  /* allocated */
+    long ptr;                                   /* next byte to deliver */
+    long len;                                   /* end of data */
+    int mapped;                                 /* buf is mapped file */
+    int full;                                   /* reported to be full */
+} SPILL;
+
+SPILL spill = { NULL, 0, 0, 0, 0, 0 };
+
+/* bytes waiting to be delivered */
+#define spill_pending() (spill.len - spill.ptr)
+
+#ifndef _WIN32
+/* map unlinked temporary file of SIZE bytes.  Returns NULL on error. */
+char *
+spill_map( long size )
+{
+    char path[1024], *buf;
+    const char *dir = getenv("TMPDIR");
+    int fd;
+
+    if ( dir == NULL )
+        dir = "/tmp";
+    snprintf( path, sizeof(path), "%s/connect-spill.XXXXXX", dir );
+    if ( (fd = mkstemp( path )) < 0 ) {
+        error("cannot create spill file in %s, errno=%d\n", dir, errno);
+        return NULL;
+    }
+    unlink( path );
+    buf = MAP_FAILED;
+    if ( ftruncate( fd, size ) == 0 )
+        buf = mmap( NULL, size, PROT_READ|PROT_WRITE, MAP_SHARED, fd, 0 );
+    close( fd );                                /* mapping is kept */
+    if ( buf == MAP_FAILED ) {
+        error("cannot map spill file of %ld bytes, errno=%d\n", size, errno);
+        return NULL;
+    }
+    debug("spilling to file %s (%ld bytes)\n", path, size);
+    return buf;
+}
+#endif /* !_WIN32 */
+
+/* get free space at the end of spill, growing it as needed.
+   Returns pointer and its length in *ROOM, or NULL if full. */
+char *
+spill_wptr( int *room )
+{
+    char *buf;
+    long size;
+
+    if ( 0 < spill.ptr ) {                      /* make room */
+        memmove( spill.buf, spill.buf + spill.ptr, spill_pending() );
+        spill.len -= spill.ptr;
+        spill.ptr = 0;
+    }
+    if ( spill.len == spill.size && spill.size < spill_max ) {
+        if ( spill.size < spill_memory ) {
+            size = (spill.size == 0)? relay_bufsize: spill.size * 2;
+            if ( spill_memory < size )
+                size = spill_memory;
+            if ( spill_max < size )
+                size = spill_max;
+            if ( (buf = realloc( spill.buf, size )) != NULL ) {
+                spill.buf = buf;
+                spill.size = size;
+            }
+        }
+#ifndef _WIN32
+        else if ( !spill.mapped && (buf = spill_map( spill_max )) != NULL ) {
+            memcpy( buf, spill.buf, spill.len );
+            free( spill.buf );
+            spill.buf = buf;
+            spill.size = spill_max;
+            spill.mapped = 1;
+        }
+#endif /* !_WIN32 */
+    }
+    if ( spill.len == spill.size ) {
+        if ( !spill.full )
+            debug("spill buffer is full (%ld bytes), remote is held\n",
+                  spill.len);
+        spill.full = 1;
+        return NULL;
+    }
+    spill.full = 0;
+    size = spill.size - spill.len;
+    *room = (relay_bufsize < size)? relay_bufsize: size;
+    return spill.buf + spill.len;
+}
+
+/* data of LEN bytes was stored at spill_wptr() */
+void
+spill_commit( int len )
+{
+    spill.len += len;
+}
+
+/* LEN bytes were delivered */
+void
+spill_consume( int len )
+{
+    spill.ptr += len;
+    if ( spill.ptr == spill.len )
+        spill.ptr = spill.len = 0;
+}
+
+/* move data left in RING to spill, to be delivered to next client */
+void
+spill_ring( RING *ring )
+{
+    char *src, *dst;
+    int len, room;
+
+    while ( 0 < ring->len && (dst = spill_wptr( &room )) != NULL ) {
+        src = ring_rptr( ring, &len );
+        if ( room < len )
+            len = room;
+        memcpy( dst, src, len );
+        spill_commit( len );
+        ring_consume( ring, len );
+    }
+    if ( 0 < ring->len ) {
+        debug("%d bytes from remote are dropped\n", ring->len);
+        ring_consume( ring, ring->len );
+    }
+}
+
+
+/** RELAY SESSION **/
+
+/* State of relaying between one local peer and one remote socket.
+   A session is driven by session_relay() whenever one of its
+   descriptors gets ready, so many sessions can share an event loop. */
+typedef struct session {
+    int id;
+    SOCKET local_in, local_out, remote;
+    int is_socket;                              /* local is socket? */
+    RING lbuf;                                  /* local input buffer */
+    RING rbuf;                                  /* remote input buffer */
+    int f_local;                                /* read local input more? */
+    int f_remote;                               /* read remote input more? */
+    int f_shutdown;                             /* remote write side closed? */
+    int close_reason;                           /* reason of end repeating */
+    int f_done;                                 /* finished, to be freed */
+    EV_ITEM li, lo, ri;                         /* watched descriptors */
+    EV_ITEM *plo;                               /* &lo or &li if same fd */
+    METRICS m;                                  /* for CONNECT_METRICS */
+    int class;                                  /* CLASS_xxx */
+    BUCKET bucket[2];                           /* rate of each SHAPE_xxx */
+    long allow[2];                              /* may send now, -1 any */
+    long deficit[2];                            /* of round robin */
+    struct session *next;
+} SESSION;
+
+int n_sessions = 0;                             /* serial number */
+
+/* setup session SS and register its descriptors to EV. */
+int
+session_start( SESSION *ss, EVLOOP *ev,
+               SOCKET local_in, SOCKET local_out, SOCKET remote )
+{
+    memset( ss, 0, sizeof(*ss) );
+    ss->id = ++n_sessions;
+    ss->m = conn_metrics;
+    ss->local_in = local_in;
+    ss->local_out = local_out;
+    ss->remote = remote;
+    ss->is_socket = (local_type == LOCAL_SOCKET);
+    ss->f_local = 1;                            /* yes, read from local */
+    ss->f_remote = 1;                           /* yes, read from remote */
+    ss->close_reason = REASON_UNK;
+    ss->class = shaper_class( dest_host, dest_port );
+    bucket_init( &ss->bucket[SHAPE_UP], rate_session[SHAPE_UP] );
+    bucket_init( &ss->bucket[SHAPE_DOWN], rate_session[SHAPE_DOWN] );
+    ss->allow[SHAPE_UP] = ss->allow[SHAPE_DOWN] = -1;
+    ring_init( &ss->lbuf, relay_bufsize );
+    ring_init( &ss->rbuf, relay_bufsize );
+    line_reader_drain( remote, &ss->rbuf );     /* over-read response */
+
+    set_nonblock( remote, 1 );
+    ss->ri.fd = remote;
+    ss->ri.events = EV_READ | EV_WRITE;
+    ss->ri.data = ss;
+    ss->li.fd = local_in;
+    ss->li.data = ss;
+    ss->lo.fd = local_out;
+    ss->lo.data = ss;
+    ss->plo = &ss->lo;
+#ifdef _WIN32
+    if ( !ss->is_socket ) {
+        /* select() on Winsock is not accept standard handle,
+           do_repeater() checks it by another method. */
+        ss->li.events = EV_READ | EV_LEVEL;
+        ss->lo.events = EV_WRITE | EV_LEVEL;
+        return evloop_add( ev, &ss->ri );
+    }
+#endif /* _WIN32 */
+    if ( local_in == local_out ) {
+        ss->li.events = relay_fd_events( local_in, ss->is_socket,
+                                         EV_READ|EV_WRITE );
+        ss->plo = &ss->li;
+    } else {
+        ss->li.events = relay_fd_events( local_in, ss->is_socket, EV_READ );
+        ss->lo.events = relay_fd_events( local_out, ss->is_socket, EV_WRITE );
+    }
+    if ( evloop_add( ev, &ss->ri ) < 0 )
+        return -1;
+    if ( evloop_add( ev, &ss->li ) < 0 ) {
+        evloop_del( ev, &ss->ri );
+        return -1;
+    }
+    if ( ss->plo == &ss->lo && evloop_add( ev, &ss->lo ) < 0 ) {
+        evloop_del( ev, &ss->ri );
+        evloop_del( ev, &ss->li );
+        return -1;
+    }
+    debug("session #%d started (%s).\n", ss->id, class_names[ss->class]);
+    return 0;
+}
+
+/* unregister and release resources of session.
+   Descriptors are not closed. */
+void
+session_finish( SESSION *ss, EVLOOP *ev )
+{
+    metrics_stall( &ss->m.stall_up_since, &ss->m.stall_up, 0 );
+    metrics_stall( &ss->m.stall_down_since, &ss->m.stall_down, 0 );
+    metrics_emit( &ss->m, ss->id, ss->remote, ss->close_reason, 0 );
+    evloop_del( ev, &ss->ri );
+    evloop_del( ev, &ss->li );
+    if ( ss->plo == &ss->lo )
+        evloop_del( ev, &ss->lo );
+    ring_free( &ss->lbuf );
+    ring_free( &ss->rbuf );
+#ifndef _WIN32
+    /* give back blocking stdio to the parent */
+    if ( !ss->is_socket ) {
+        if ( !(ss->li.events & EV_LEVEL) )
+            set_nonblock( ss->local_in, 0 );
+        if ( ss->plo == &ss->lo && !(ss->lo.events & EV_LEVEL) )
+            set_nonblock( ss->local_out, 0 );
+    }
+#endif /* !_WIN32 */
+    debug("session #%d finished.\n", ss->id);
+}
+
+/* session SS sent LEN bytes in direction DIR */
+void
+session_sent( SESSION *ss, int dir, int len )
+{
+    if ( 0 < ss->allow[dir] )
+        ss->allow[dir] -= len;
+    bucket_take( &ss->bucket[dir], len );
+    bucket_take( &bucket_total[dir], len );
+    ss->deficit[dir] -= len;
+}
+
+/* tell event loop which local directions SS can do something for,
+   so that always ready local (regular file) is not polled in vain */
+void
+session_want( SESSION *ss, EVLOOP *ev )
+{
+    int in = 0, out = 0;
+
+    if ( ss->f_local && 0 < ring_space(&ss->lbuf) )
+        in = EV_READ;
+    if ( (0 < ss->rbuf.len || 0 < spill_pending()) &&
+         ss->allow[SHAPE_DOWN] != 0 )
+        out = EV_WRITE;
+    if ( ss->plo == &ss->li ) {
+        evloop_want( ev, &ss->li, in | out );
+    } else {
+        evloop_want( ev, &ss->li, in );
+        evloop_want( ev, &ss->lo, out );
+    }
+}
+
+/* move data of session as long as descriptors stay ready.
+   Sending is limited by ss->allow.
+   Returns 1 while session is alive, 0 if relaying is over. */
+int
+session_relay( SESSION *ss, EVLOOP *ev )
+{
+    int len, room, progress;
+    char *ptr;
+
+    do {
+        progress = 0;
+
+        /* remote => local */
+        if ( ss->f_remote && (ss->ri.ready & EV_READ) &&
+             0 < ring_space(&ss->rbuf) ) {
+            ptr = ring_wptr( &ss->rbuf, &room );
+            len = recv( ss->remote, ptr, room, 0);
+            if ( len == -1 && socket_wouldblock() ) {
+                evloop_clear( ev, &ss->ri, EV_READ );
+            } else if ( len == 0 ||
+                        (len == -1 && socket_errno() == ECONNRESET)) {
+                debug("connection %s by peer\n",
+                      (len==0)? "closed": "reset");
+                ss->close_reason = REASON_CLOSED_BY_REMOTE;
+                ss->f_remote = 0;               /* no more read from socket */
+                ss->f_local = 0;
+            } else if ( len == -1 ) {
+                /* error */
+                error("recv() failed, %d\n", socket_errno());
+                ss->close_reason = REASON_ERROR;
+                return 0;
+            } else {
+                TRACE(1, ("recv %d bytes\n", len));
+                tcp_quickack( ss->remote, &tcp_remote );
+                if ( TRACE_ON(2) )              /* more verbose */
+                    report_bytes( "<<<", ptr, len);
+                CAPTURE( TRACE_DOWN, ptr, len );
+                ring_commit( &ss->rbuf, len );
+                progress = 1;
+            }
+        }
+
+        /* local => remote */
+        if ( ss->f_local && (ss->li.ready & EV_READ) &&
+             0 < ring_space(&ss->lbuf) ) {
+            ptr = ring_wptr( &ss->lbuf, &room );
+            if (ss->is_socket)
+                len = recv(ss->local_in, ptr, room, 0);
+            else
+                len = read(ss->local_in, ptr, room);
+            if ( len == -1 && socket_wouldblock() ) {
+                evloop_clear( ev, &ss->li, EV_READ );
+            } else if ( len == 0 ) {
+                /* stdin is EOF */
+                debug("local input is EOF\n");
+                ss->f_local = 0;
+                ss->close_reason = REASON_CLOSED_BY_LOCAL;
+                if ( ss->plo != &ss->li )
+                    evloop_del( ev, &ss->li );  /* nothing to watch */
+            } else if ( len == -1 ) {
+                /* error on reading from stdin */
+                if (f_hold_session) {
+                    debug ("failed to read from local\n");
+                    ss->f_local = 0;
+                    ss->close_reason = REASON_CLOSED_BY_LOCAL;
+                } else {
+                    error("recv() failed, errno = %d\n", errno);
+                    ss->close_reason = REASON_ERROR;
+                    return 0;
+                }
+            } else {
+                /* repeat */
+                if ( ss->is_socket )
+                    tcp_quickack( ss->local_in, &tcp_local );
+                CAPTURE( TRACE_UP, ptr, len );
+                ring_commit( &ss->lbuf, len );
+                progress = 1;
+                if ( ss->li.events & EV_LEVEL )
+                    evloop_clear( ev, &ss->li, EV_READ );
+            }
+        }
+
+        /* flush data in buffer to socket */
+        if ( 0 < ss->lbuf.len && (ss->ri.ready & EV_WRITE) &&
+             ss->allow[SHAPE_UP] != 0 ) {
+            ptr = ring_rptr( &ss->lbuf, &room );
+            room = limit_min( room, ss->allow[SHAPE_UP] );
+            len = send(ss->remote, ptr, room, 0);
+            if ( len == -1 && socket_wouldblock() ) {
+                evloop_clear( ev, &ss->ri, EV_WRITE );
+            } else if ( len == -1 ) {
+                error("send() failed, %d\n", socket_errno());
+                ss->close_reason = REASON_ERROR;
+                return 0;
+            } else if ( 0 < len ) {
+                if ( TRACE_ON(2) )              /* more verbose */
+                    report_bytes( ">>>", ptr, len);
+                TRACE(1, ("sent %d bytes\n", len));
+                ring_consume( &ss->lbuf, len );
+                session_sent( ss, SHAPE_UP, len );
+                ss->m.bytes_up += len;
+                progress = 1;
+            }
+        }
+        if ( !ss->f_local && ss->lbuf.len == 0 && !ss->f_shutdown &&
+             !f_hold_session && ss->close_reason == REASON_CLOSED_BY_LOCAL ) {
+            shutdown(ss->remote, 1);            /* no-more writing */
+            ss->f_shutdown = 1;
+        }
+
+        /* flush data in buffer to local output, held one first.
+           Client which has gone while holding gets nothing more. */
+        if ( (0 < spill_pending() || 0 < ss->rbuf.len) &&
+             (ss->plo->ready & EV_WRITE) && ss->allow[SHAPE_DOWN] != 0 &&
+             !(f_hold_session && !ss->f_local &&
+               ss->close_reason == REASON_CLOSED_BY_LOCAL) ) {
+            if ( 0 < spill_pending() ) {
+                ptr = spill.buf + spill.ptr;
+                room = (relay_bufsize < spill_pending())?
+                    relay_bufsize: spill_pending();
+            } else {
+                ptr = ring_rptr( &ss->rbuf, &room );
+            }
+            room = limit_min( room, ss->allow[SHAPE_DOWN] );
+            if (ss->is_socket)
+                len = send( ss->local_out, ptr, room, 0);
+            else
+                len = write( ss->local_out, ptr, room);
+            if ( len == -1 && socket_wouldblock() ) {
+                evloop_clear( ev, ss->plo, EV_WRITE );
+            } else if ( len == -1 && f_hold_session && ss->is_socket ) {
+                /* client has gone, data is kept for next one */
+                debug ("failed to write to local\n");
+                ss->f_local = 0;
+                ss->close_reason = REASON_CLOSED_BY_LOCAL;
+                break;
+            } else if ( len == -1 ) {
+                error("output (local) failed, errno=%d\n", errno);
+                ss->close_reason = REASON_ERROR;
+                return 0;
+            } else {
+                if ( 0 < spill_pending() )
+                    spill_consume( len );
+                else
+                    ring_consume( &ss->rbuf, len );
+                session_sent( ss, SHAPE_DOWN, len );
+                ss->m.bytes_down += len;
+                progress = 1;
+            }
+        }
+    } while ( progress );
+    metrics_stall( &ss->m.stall_up_since, &ss->m.stall_up,
+                   ring_space(&ss->lbuf) == 0 );
+    metrics_stall( &ss->m.stall_down_since, &ss->m.stall_down,
+                   ring_space(&ss->rbuf) == 0 );
+
+    if (ss->f_local == 0 && f_hold_session &&
+        ss->close_reason == REASON_CLOSED_BY_LOCAL) {
+        debug ("closing local port without disconnecting from remote\n");
+        spill_ring( &ss->rbuf );                /* for next client */
+        ss->f_remote = 0;
+        shutdown (ss->local_out, 2);
+        close (ss->local_out);
+        return 0;
+    }
+    if ( ss->f_local || ss->f_remote || 0 < ss->rbuf.len ||
+         0 < spill_pending() ) {
+        session_want( ss, ev );
+        return 1;
+    }
+    return 0;
+}
+
+/* has session SS data to send in direction DIR now? */
+int
+session_backlog( SESSION *ss, int dir )
+{
+    if ( dir == SHAPE_UP )
+        return 0 < ss->lbuf.len && (ss->ri.ready & EV_WRITE);
+    return (0 < ss->rbuf.len || 0 < spill_pending()) &&
+        (ss->plo->ready & EV_WRITE);
+}
+
+/* set bytes SS may send by its own buckets */
+void
+session_allow( SESSION *ss )
+{
+    ss->allow[SHAPE_UP] = bucket_avail( &ss->bucket[SHAPE_UP] );
+    ss->allow[SHAPE_DOWN] = bucket_avail( &ss->bucket[SHAPE_DOWN] );
+}
+
+/* let SESSIONS send by deficit round robin over total buckets, higher
+   class first.  Sessions are relayed here for sending, and should be
+   relayed with nothing allowed on events.
+   Returns 1 if some session is waiting for tokens. */
+int
+shaper_run( SESSION *sessions, EVLOOP *ev )
+{
+    SESSION *ss;
+    double moved;
+    int class, dir, progress, waiting = 0;
+
+    for ( class = 0; class < N_CLASSES; class++ ) {
+        do {
+            progress = 0;
+            for ( ss = sessions; ss != NULL; ss = ss->next ) {
+                if ( ss->f_done || ss->class != class )
+                    continue;
+                session_allow( ss );
+                for ( dir = 0; dir < 2; dir++ ) {
+                    if ( !session_backlog( ss, dir ) ) {
+                        ss->deficit[dir] = 0;
+                        ss->allow[dir] = 0;
+                        continue;
+                    }
+                    if ( rate_total[dir] == 0 )
+                        continue;
+                    if ( ss->deficit[dir] < SHAPER_QUANTUM )
+                        ss->deficit[dir] += SHAPER_QUANTUM;
+                    ss->allow[dir] = limit_min( ss->allow[dir],
+                        limit_min( ss->deficit[dir],
+                                   bucket_avail( &bucket_total[dir] )));
+                }
+                if ( ss->allow[SHAPE_UP] == 0 && ss->allow[SHAPE_DOWN] == 0 )
+                    continue;
+                moved = ss->m.bytes_up + ss->m.bytes_down;
+                if ( !session_relay( ss, ev ) )
+                    ss->f_done = 1;
+                if ( moved < ss->m.bytes_up + ss->m.bytes_down )
+                    progress = 1;
+            }
+        } while ( progress );
+    }
+    for ( ss = sessions; ss != NULL; ss = ss->next ) {
+        ss->allow[SHAPE_UP] = ss->allow[SHAPE_DOWN] = 0;
+        if ( !ss->f_done && (session_backlog( ss, SHAPE_UP ) ||
+                             session_backlog( ss, SHAPE_DOWN )) )
+            waiting = 1;
+    }
+    return waiting;
+}
+
+/* relay byte from stdin to socket and fro socket to stdout.
+   returns reason of termination */
+int
+do_repeater( SOCKET local_in, SOCKET local_out, SOCKET remote )
+{
+    SESSION ss;
+    EVLOOP ev;
+    int timeout = -1, wait = -1;
+
+    evloop_init( &ev );
+#ifdef _WIN32
+    if ( local_type != LOCAL_SOCKET ) {
+        /* select() on Winsock is not accept standard handle.
+           So use select() with short timeout and checking data
+           in stdin by another method. */
+        timeout = 10;                           /* 10 ms */
+    }
+#endif /* _WIN32 */
+    if ( session_start( &ss, &ev, local_in, local_out, remote ) < 0 )
+        fatal("cannot watch descriptors for relaying.\n");
+
+    /* repeater between stdin/out and socket  */
+    while ( 1 ) {
+        if ( evloop_wait( &ev, wait ) < 0 ) {
+            /* some error */
+            error( "waiting events failed, %d\n", socket_errno());
+            ss.close_reason = REASON_ERROR;
+            break;
+        }
+        if ( f_metrics_dump ) {
+            f_metrics_dump = 0;
+            metrics_emit( &ss.m, ss.id, ss.remote, ss.close_reason, 1 );
+        }
+#ifdef _WIN32
+        /* fake readiness if local is stdio handle because
+           select() of Winsock does not accept stdio
+           handle. */
+        if ( 0 < timeout ) {
+            ss.lo.ready = EV_WRITE;             /* blocking handle */
+            if ( ss.f_local && 0 < stdindatalen() )
+                ss.li.ready |= EV_READ;         /* data ready */
+        }
+#endif
+        if ( f_shaping )
+            session_allow( &ss );
+        if ( !session_relay( &ss, &ev ) )
+            break;
+        wait = timeout;
+        if ( f_shaping && (session_backlog( &ss, SHAPE_UP ) ||
+                           session_backlog( &ss, SHAPE_DOWN )) )
+            wait = SHAPER_TICK;                 /* wait for tokens */
+    }
+    session_finish( &ss, &ev );
+    evloop_done( &ev );
+    return ss.close_reason;
+}
+
+#ifdef WITH_SPLICE
+/* one direction of zero-copy relay: SRC => pipe => DST */
+typedef struct {
+    int pipe[2];
+    int pending;                                /* bytes held in pipe */
+    int f_read;                                 /* read SRC more? */
+    double moved;                               /* bytes written to DST */
+} SPLICE_DIR;
+
+/* is descriptor FD usable with splice()? */
+static int
+splice_capable( int fd )
+{
+    struct stat st;
+    if ( fstat( fd, &st ) < 0 )
+        return 0;
+    return S_ISFIFO(st.st_mode) || S_ISSOCK(st.st_mode);
+}
+
+static int
+splice_dir_init( SPLICE_DIR *dir )
+{
+    dir->pending = 0;
+    dir->f_read = 1;
+    dir->moved = 0;
+    if ( pipe( dir->pipe ) < 0 )
+        return -1;
+    set_nonblock( dir->pipe[0], 1 );
+    set_nonblock( dir->pipe[1], 1 );
+    fcntl( dir->pipe[0], F_SETFD, FD_CLOEXEC );
+    fcntl( dir->pipe[1], F_SETFD, FD_CLOEXEC );
+#ifdef F_SETPIPE_SZ
+    fcntl( dir->pipe[1], F_SETPIPE_SZ, relay_bufsize );
+#endif /* F_SETPIPE_SZ */
+    return 0;
+}
+
+static void
+splice_dir_done( SPLICE_DIR *dir )
+{
+    close( dir->pipe[0] );
+    close( dir->pipe[1] );
+}
+
+#define SPLICE_CHUNK    (1024*1024)
+#define SPLICE_FLAGS    (SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+
+/* move bytes from SRC into pipe.
+   Returns 1 on progress, 0 for no progress, -1 for EOF and -2 for error */
+static int
+splice_in( EVLOOP *ev, EV_ITEM *src, SPLICE_DIR *dir )
+{
+    ssize_t len = splice( src->fd, NULL, dir->pipe[1], NULL,
+                          SPLICE_CHUNK, SPLICE_FLAGS );
+    if ( len == 0 )
+        return -1;
+    if ( len < 0 ) {
+        if ( errno != EAGAIN )
+            return -2;
+        /* EAGAIN is ambiguous while the pipe holds data: it may be
+           full.  Keep SRC ready and retry after the pipe drains. */
+        if ( dir->pending == 0 )
+            evloop_clear( ev, src, EV_READ );
+        return 0;
+    }
+    TRACE(1, ("splice in %d bytes\n", (int)len));
+    dir->pending += len;
+    return 1;
+}
+
+/* move bytes from pipe to DST.
+   Returns 1 on progress, 0 for no progress and -2 for error */
+static int
+splice_out( EVLOOP *ev, EV_ITEM *dst, SPLICE_DIR *dir )
+{
+    ssize_t len = splice( dir->pipe[0], NULL, dst->fd, NULL,
+                          dir->pending, SPLICE_FLAGS );
+    if ( len < 0 ) {
+        if ( errno != EAGAIN )
+            return -2;
+        evloop_clear( ev, dst, EV_WRITE );
+        return 0;
+    }
+    TRACE(1, ("splice out %d bytes\n", (int)len));
+    dir->pending -= len;
+    dir->moved += len;
+    return 1;
+}
+
+/* relay between local and remote with splice(2), payload never comes
+   into user space.  Returns REASON_UNSUPPORTED without touching any
+   data if descriptors are not suitable, then caller should use
+   do_repeater(). */
+int
+do_splice_repeater( SOCKET local_in, SOCKET local_out, SOCKET remote )
+{
+    SPLICE_DIR up, down;                        /* local=>remote, reverse */
+    METRICS m;
+    EVLOOP ev;
+    EV_ITEM li, lo, ri, *plo;
+    int close_reason = REASON_UNK;
+    int moved = 0, f_shutdown = 0, f_fallback = 0, progress, ret;
+
+    if ( !getparam_bool( ENV_CONNECT_SPLICE, 1 ) )
+        return REASON_UNSUPPORTED;              /* disabled by user */
+    if ( TRACE_ON(2) || trace_capture[0].size || f_hold_session ||
+         f_shaping || 0 < line_reader_pending(remote) )
+        return REASON_UNSUPPORTED;              /* need data in user space */
+    if ( !splice_capable( local_in ) || !splice_capable( local_out ) ) {
+        debug("local side is not splice capable.\n");
+        return REASON_UNSUPPORTED;
+    }
+    if ( splice_dir_init( &up ) < 0 )
+        return REASON_UNSUPPORTED;
+    if ( splice_dir_init( &down ) < 0 ) {
+        splice_dir_done( &up );
+        return REASON_UNSUPPORTED;
+    }
+    debug("relaying with splice().\n");
+
+    evloop_init( &ev );
+    memset( &li, 0, sizeof(li) );
+    memset( &lo, 0, sizeof(lo) );
+    memset( &ri, 0, sizeof(ri) );
+    set_nonblock( remote, 1 );
+    set_nonblock( local_in, 1 );
+    set_nonblock( local_out, 1 );
+    ri.fd = remote;
+    ri.events = EV_READ | EV_WRITE;
+    li.fd = local_in;
+    li.events = EV_READ;
+    lo.fd = local_out;
+    lo.events = EV_WRITE;
+    plo = &lo;
+    if ( local_in == local_out ) {
+        li.events |= EV_WRITE;
+        plo = &li;
+    }
+    if ( evloop_add( &ev, &ri ) < 0 || evloop_add( &ev, &li ) < 0 ||
+         (plo == &lo && evloop_add( &ev, &lo ) < 0) )
+        fatal("cannot watch descriptors for relaying.\n");
+
+    while ( up.f_read || down.f_read || 0 < down.pending ) {
+        if ( evloop_wait( &ev, -1 ) < 0 ) {
+            error( "waiting events failed, %d\n", errno);
+            close_reason = REASON_ERROR;
+            break;
+        }
+        if ( f_metrics_dump ) {
+            f_metrics_dump = 0;
+            m = conn_metrics;
+            m.bytes_up = up.moved;
+            m.bytes_down = down.moved;
+            metrics_emit( &m, n_sessions + 1, remote, close_reason, 1 );
+        }
+        do {
+            progress = 0;
+
+            /* remote => pipe => local */
+            if ( down.f_read && (ri.ready & EV_READ) ) {
+                ret = splice_in( &ev, &ri, &down );
+                if ( ret == -1 || (ret == -2 && errno == ECONNRESET) ) {
+                    debug("connection %s by peer\n",
+                          (ret==-1)? "closed": "reset");
+                    close_reason = REASON_CLOSED_BY_REMOTE;
+                    down.f_read = 0;
+                    up.f_read = 0;
+                } else if ( ret == -2 ) {
+                    if ( !moved && errno == EINVAL ) {
+                        f_fallback = 1;         /* not supported */
+                        break;
+                    }
+                    fatal("splice() from remote failed, errno=%d\n", errno);
+                } else if ( ret == 1 ) {
+                    progress = moved = 1;
+                }
+            }
+            if ( 0 < down.pending && (plo->ready & EV_WRITE) ) {
+                ret = splice_out( &ev, plo, &down );
+                if ( ret == -2 )
+                    fatal("output (local) failed, errno=%d\n", errno);
+                progress |= ret;
+            }
+
+            /* local => pipe => remote */
+            if ( up.f_read && (li.ready & EV_READ) ) {
+                ret = splice_in( &ev, &li, &up );
+                if ( ret == -1 ) {
+                    debug("local input is EOF\n");
+                    up.f_read = 0;
+                    close_reason = REASON_CLOSED_BY_LOCAL;
+                } else if ( ret == -2 ) {
+                    if ( !moved && errno == EINVAL ) {
+                        f_fallback = 1;         /* not supported */
+                        break;
+                    }
+                    fatal("splice() from local failed, errno=%d\n", errno);
+                } else if ( ret == 1 ) {
+                    progress = moved = 1;
+                }
+            }
+            if ( 0 < up.pending && (ri.ready & EV_WRITE) ) {
+                ret = splice_out( &ev, &ri, &up );
+                if ( ret == -2 )
+                    fatal("send() failed, %d\n", errno);
+                progress |= ret;
+            }
+            if ( !up.f_read && up.pending == 0 && !f_shutdown &&
+                 close_reason == REASON_CLOSED_BY_LOCAL ) {
+                shutdown(remote, 1);            /* no-more writing */
+                f_shutdown = 1;
+            }
+        } while ( progress );
+        if ( f_fallback ) {
+            debug("splice() is not supported, fallback.\n");
+            close_reason = REASON_UNSUPPORTED;
+            break;
+        }
+    }
+
+    if ( close_reason != REASON_UNSUPPORTED ) {
+        m = conn_metrics;
+        m.bytes_up = up.moved;
+        m.bytes_down = down.moved;
+        metrics_emit( &m, ++n_sessions, remote, close_reason, 0 );
+    }
+    evloop_done( &ev );
+    splice_dir_done( &up );
+    splice_dir_done( &down );
+    set_nonblock( local_in, 0 );
+    set_nonblock( local_out, 0 );
+    return close_reason;
+}
+#endif /* WITH_SPLICE */
+
+/** CONNECT **/
+
+/* Connecting to a host with several addresses.
+   Addresses given by the resolver are ordered to alternate between
+   families, then non-blocking connects are started one by one every
+   CONNECT_ATTEMPT_DELAY ms (or at once when the previous attempt
+   failed) and raced in an event loop.  The first established one
+   wins and the others are closed (RFC 8305). */
+#define CONNECT_ATTEMPT_DELAY   250             /* ms */
+
+/* printable form of address for debug */
+const char *
+connect_addr_str( CONNECT_ADDR *addr )
+{
+    static char buf[64];
+#ifdef WITH_GETADDRINFO
+    if ( getnameinfo( &addr->u.sa, addr->len, buf, sizeof(buf), NULL, 0,
+                      NI_NUMERICHOST ) != 0 )
+        strcpy( buf, "?" );
+#else
+    strncpy( buf, inet_ntoa( addr->u.in.sin_addr ), sizeof(buf)-1 );
+#endif /* !WITH_GETADDRINFO */
+    return buf;
+}
+
+/* resolve HOST into ADDRS, at most MAX entries, ordered to try.
+   Returns number of addresses or -1. */
+int
+resolve_addrs( const char *host, u_short port, CONNECT_ADDR *addrs, int max )
+{
+    CONNECT_ADDR *list;
+    int n, i, j, k;
+
+    list = xmalloc( sizeof(CONNECT_ADDR) * max );
+    n = resolve_host( host, list, max );
+    for ( i = 0; i < n; i++ ) {
+#ifdef AF_INET6
+        if ( list[i].u.sa.sa_family == AF_INET6 )
+            list[i].u.in6.sin6_port = htons(port);
+        else
+#endif /* AF_INET6 */
+            list[i].u.in.sin_port = htons(port);
+    }
+    /* interleave families, family of the first answer is preferred */
+    for ( i = j = k = 0; k < n; ) {
+        while ( i < n &&
+                list[i].u.sa.sa_family != list[0].u.sa.sa_family )
+            i++;
+        if ( i < n )
+            addrs[k++] = list[i++];
+        while ( j < n &&
+                list[j].u.sa.sa_family == list[0].u.sa.sa_family )
+            j++;
+        if ( j < n )
+            addrs[k++] = list[j++];
+    }
+    free( list );
+    for ( i = 0; i < n; i++ )
+        debug("address[%d] = %s\n", i, connect_addr_str( &addrs[i] ));
+    return n;
+}
+
+/* start connecting to ADDR.  Returns socket which is connected
+   (*PENDING=0) or in progress (*PENDING=1), or SOCKET_ERROR. */
+SOCKET
+connect_start( CONNECT_ADDR *addr, int *pending )
+{
+    SOCKET s;
+
+    debug("connecting to %s\n", connect_addr_str( addr ));
+    s = socket( addr->u.sa.sa_family, SOCK_STREAM, 0 );
+    if ( s == SOCKET_ERROR )
+        return SOCKET_ERROR;
+    apply_tcp_tuning( s, &tcp_remote );         /* buffers before SYN */
+#ifndef _WIN32
+    set_nonblock( s, 1 );
+#endif /* !_WIN32 */
+    *pending = 0;
+    if ( connect( s, &addr->u.sa, addr->len ) == 0 )
+        return s;
+#ifndef _WIN32
+    if ( socket_errno() == EINPROGRESS ) {
+        *pending = 1;
+        return s;
+    }
+#endif /* !_WIN32 */
+    debug("connect() failed, errno=%d\n", socket_errno());
+    closesocket( s );
+    return SOCKET_ERROR;
+}
+
+/* open socket listening at local PORT.
+   The socket is kept open and shared by following calls. */
+SOCKET
+open_listen_socket (u_short port)
+{
+    static SOCKET sock = -1;
+    struct sockaddr_in name;
+    int sockopt;
+
+    if (sock != -1)
+        return sock;                            /* already listening */
+
+    /* Create the socket. */
+    debug("Creating source port to forward.\n");
+    sock = socket (PF_INET, SOCK_STREAM, 0);
+    if (sock < 0)
+        fatal("socket() failed, errno=%d\n", socket_errno());
+    sockopt = 1;
+    setsockopt (sock, SOL_SOCKET, SO_REUSEADDR,
+                (void*)&sockopt, sizeof(sockopt));
+    apply_tcp_tuning (sock, &tcp_local);        /* inherited by accept() */
+
+    /* Give the socket a name. */
+    name.sin_family = AF_INET;
+    name.sin_port = htons (port);
+    /* proxy front-end is only for this host, it has no authentication */
+    name.sin_addr.s_addr = htonl (f_frontend? INADDR_LOOPBACK: INADDR_ANY);
+    if (bind (sock, (struct sockaddr *) &name, sizeof (name)) < 0)
+        fatal ("bind() failed, errno=%d\n", socket_errno());
+
+    if (listen( sock, f_daemon? SOMAXCONN: 1) < 0)
+        fatal ("listen() failed, errno=%d\n", socket_errno());
+    return sock;
+}
+
+int
+accept_connection (u_short port)
+{
+    SOCKET sock;
+    int connection;
+    struct sockaddr client;
+    int socklen;
+    fd_set ifds;
+    int nfds;
+
+    sock = open_listen_socket (port);
+
+    /* wait for new connection with watching EOF of stdin. */
+    debug ("waiting new connection at port %d (socket=%d)\n", port, sock);
+    nfds = sock + 1;
+    do {
+        int n;
+        struct timeval *ptmo = NULL;
+#ifdef _WIN32
+        struct timeval tmo;
+        tmo.tv_sec = 0;
+        tmo.tv_usec = 100*1000;                 /* On Windows, 100ms timeout */
+        ptmo = &tmo;
+#endif /* _WIN32 */
+        FD_ZERO (&ifds);
+        FD_SET ((SOCKET)sock, &ifds);
+#ifndef _WIN32
+        FD_SET (0, &ifds);                      /* watch stdin */
+#endif
+        n = select (nfds, &ifds, NULL, NULL, ptmo);
+        if (n == -1) {
+            fatal ("select() failed, %d\n", socket_errno());
+            exit (1);
+        }
+#ifdef _WIN32
+        if (0 < stdindatalen()) {
+            FD_SET (0, &ifds);          /* fake */
+            n++;
+        }
+#endif
+        if (0 < n) {
+            if (FD_ISSET(0, &ifds) && (getchar() <= 0)) {
+                /* EOF */
+                debug ("Give-up waiting port because stdin is closed.");
+                exit(0);
+            }
+            if (FD_ISSET(sock, &ifds))
+                break;                          /* socket is stimulated */
+        }
+    } while (1);
+    socklen = sizeof(client);
+    connection = accept( sock, &client, &socklen);
+    if ( connection < 0 )
+        fatal ("accept() failed, errno=%d\n", socket_errno());
+    apply_tcp_tuning (connection, &tcp_local);
+    return connection;
+}
+
+/* wait for next local client at PORT with holding REMOTE (option 'P').
+   Meanwhile remote is kept read into spill as far as it has room, so
+   the remote session never stalls on us.  Returns accepted socket. */
+SOCKET
+hold_session (SOCKET remote, u_short port)
+{
+    EVLOOP ev;
+    EV_ITEM lsn, in, ri;
+    SOCKET sock, connection = SOCKET_ERROR;
+    struct sockaddr client;
+    socklen_t socklen;
+    int len, room, timeout = -1;
+    char *ptr;
+
+    sock = open_listen_socket (port);
+    debug ("waiting new connection at port %d (socket=%d)\n", port, sock);
+    evloop_init (&ev);
+    memset (&lsn, 0, sizeof(lsn));
+    memset (&in, 0, sizeof(in));
+    memset (&ri, 0, sizeof(ri));
+    lsn.fd = sock;
+    lsn.events = EV_READ | EV_LEVEL;            /* accept one */
+    ri.fd = remote;
+    ri.events = EV_READ;
+    in.fd = 0;                                  /* watch EOF of stdin */
+    in.events = EV_READ | EV_LEVEL;
+    if (evloop_add (&ev, &lsn) < 0 || evloop_add (&ev, &ri) < 0)
+        fatal ("cannot watch descriptors for holding session.\n");
+#ifdef _WIN32
+    timeout = 100;                              /* check stdin by polling */
+#else  /* !_WIN32 */
+    if (evloop_add (&ev, &in) < 0)
+        fatal ("cannot watch descriptors for holding session.\n");
+#endif /* !_WIN32 */
+    while (connection == SOCKET_ERROR) {
+        if (evloop_wait (&ev, timeout) < 0)
+            fatal ("waiting events failed, %d\n", socket_errno());
+#ifdef _WIN32
+        if (0 < stdindatalen())
+            in.ready |= EV_READ;                /* fake */
+#endif /* _WIN32 */
+        if (in.ready & EV_READ) {
+            evloop_clear (&ev, &in, EV_READ);
+            if (getchar() <= 0) {
+                /* EOF */
+                debug ("Give-up waiting port because stdin is closed.\n");
+                exit(0);
+            }
+        }
+        while ((ri.ready & EV_READ) && (ptr = spill_wptr (&room)) != NULL) {
+            len = recv (remote, ptr, room, 0);
+            if (len == -1 && socket_wouldblock()) {
+                evloop_clear (&ev, &ri, EV_READ);
+            } else if (len <= 0) {
+                /* delivered to next client then session ends */
+                debug ("remote is closed while detached\n");
+                evloop_del (&ev, &ri);
+                ri.ready = 0;
+            } else {
+                CAPTURE( TRACE_DOWN, ptr, len );
+                spill_commit (len);
+            }
+        }
+        if (lsn.ready & EV_READ) {
+            evloop_clear (&ev, &lsn, EV_READ);
+            socklen = sizeof(client);
+            connection = accept (sock, &client, &socklen);
+            if (connection == SOCKET_ERROR)
+                fatal ("accept() failed, errno=%d\n", socket_errno());
+        }
+    }
+    evloop_done (&ev);
+    apply_tcp_tuning (connection, &tcp_local);
+    debug ("%ld bytes from remote are held\n", spill_pending());
+    return connection;
+}
+
+/** RELAY SERVER SELECTION **/
+
+/* When several relay servers are given, CONNECT_PROXY_STRATEGY tells
+   how to use them:
+     failover   try them in the given order (default)
+     race       negotiate with all at once, the first ready is used
+     latency    try them in order of time to get ready, measured before
+   In any strategy, a server which failed recently is tried after the
+   others for PROXY_BACKOFF seconds, doubled for each consecutive
+   failure.  The measured time and failures are kept in
+   ~/.cache/connect/proxies between invocations, so a dead server does
+   not cost every new connection the full timeout. */
+#define PROXY_STATE_FILE        ".cache/connect/proxies"
+#define PROXY_BACKOFF           30              /* seconds */
+#define PROXY_BACKOFF_MAX       600
+#define PROXY_SAVE_INTERVAL     10              /* seconds, for -D */
+
+#define STRATEGY_FAILOVER       0
+#define STRATEGY_RACE           1
+#define STRATEGY_LATENCY        2
+
+int proxy_strategy = -1;                        /* -1: not initialized */
+time_t proxy_state_saved = 0;
+
+#if !defined(_WIN32) || defined(cygwin)
+/* read health of relay servers in the list from state file */
+void
+proxy_state_load( void )
+{
+    char *path = home_path( PROXY_STATE_FILE );
+    char line[1024], host[1024];
+    FILE *fp;
+    long srtt, last_fail;
+    int i, port, fails;
+
+    fp = fopen( path, "r" );
+    free( path );
+    if ( fp == NULL )
+        return;
+    while ( fgets( line, sizeof(line), fp ) != NULL ) {
+        if ( sscanf( line, "%1023s %d %ld %d %ld", host, &port, &srtt,
+                     &fails, &last_fail ) != 5 )
+            continue;
+        for ( i = 0; i < n_proxy_list; i++ ) {
+            if ( proxy_list[i].port != port ||
+                 strcmp( proxy_list[i].host, host ) != 0 )
+                continue;
+            proxy_list[i].srtt = srtt;
+            proxy_list[i].fails = fails;
+            proxy_list[i].last_fail = (time_t)last_fail;
+        }
+    }
+    fclose( fp );
+}
+
+/* write health of relay servers, records of servers not in the list
+   are kept as they are. */
+void
+proxy_state_save( void )
+{
+    char *path = home_path( PROXY_STATE_FILE );
+    char *tmp, line[1024], host[1024];
+    FILE *in, *out;
+    int i, port, ok;
+
+    make_parent_dirs( path );
+    tmp = xmalloc( strlen(path) + 16 );
+    sprintf( tmp, "%s.%d", path, (int)getpid() );
+    out = fopen( tmp, "w" );
+    if ( out == NULL ) {
+        debug("cannot save relay server state, errno=%d\n", errno);
+        free( tmp );
+        free( path );
+        return;
+    }
+    for ( i = 0; i < n_proxy_list; i++ )
+        fprintf( out, "%s %d %ld %d %ld\n", proxy_list[i].host,
+                 proxy_list[i].port, proxy_list[i].srtt,
+                 proxy_list[i].fails, (long)proxy_list[i].last_fail );
+    if ( (in = fopen( path, "r" )) != NULL ) {
+        while ( fgets( line, sizeof(line), in ) != NULL ) {
+            if ( sscanf( line, "%1023s %d", host, &port ) != 2 )
+                continue;
+            for ( i = 0; i < n_proxy_list; i++ )
+                if ( proxy_list[i].port == port &&
+                     strcmp( proxy_list[i].host, host ) == 0 )
+                    break;
+            if ( i == n_proxy_list )
+                fputs( line, out );             /* other's record */
+        }
+        fclose( in );
+    }
+    ok = (fclose( out ) == 0);
+    if ( !ok || rename( tmp, path ) != 0 )
+        unlink( tmp );
+    proxy_state_saved = time( NULL );
+    free( tmp );
+    free( path );
+}
+#else /* _WIN32 */
+#define proxy_state_load()      /* not supported */
+#define proxy_state_save()      /* not supported */
+#endif /* _WIN32 */
+
+/* is relay server P in back-off after failures? */
+int
+proxy_degraded( PROXY_SERVER *p, time_t now )
+{
+    long backoff = PROXY_BACKOFF;
+    int i;
+
+    if ( p->fails == 0 )
+        return 0;
+    for ( i = 1; i < p->fails && backoff < PROXY_BACKOFF_MAX; i++ )
+        backoff *= 2;
+    if ( PROXY_BACKOFF_MAX < backoff )
+        backoff = PROXY_BACKOFF_MAX;
+    return now - p->last_fail < backoff;
+}
+
+/* list indexes of relay servers into ORDER in order to try.
+   Returns number of them. */
+int
+proxy_order( int *order )
+{
+    time_t now = time( NULL );
+    char *param;
+    int i, j, k, key_i, key_k;
+
+    if ( proxy_strategy < 0 ) {
+        proxy_strategy = STRATEGY_FAILOVER;
+        if ( (param = getparam( ENV_CONNECT_PROXY_STRATEGY )) != NULL ) {
+            if ( strcmp( param, "race" ) == 0 )
+                proxy_strategy = STRATEGY_RACE;
+            else if ( strcmp( param, "latency" ) == 0 )
+                proxy_strategy = STRATEGY_LATENCY;
+            else if ( strcmp( param, "failover" ) != 0 )
+                error("unknown %s: %s\n", ENV_CONNECT_PROXY_STRATEGY, param);
+        }
+        if ( 1 < n_proxy_list )
+            proxy_state_load();
+    }
+    /* stable insertion sort: healthy first, then faster if asked */
+    for ( i = 0; i < n_proxy_list; i++ ) {
+        k = i;
+        key_k = proxy_degraded( &proxy_list[k], now );
+        for ( j = i; 0 < j; j-- ) {
+            key_i = proxy_degraded( &proxy_list[order[j-1]], now );
+            if ( key_i < key_k )
+                break;
+            if ( key_i == key_k &&
+                 (proxy_strategy != STRATEGY_LATENCY ||
+                  proxy_list[order[j-1]].srtt <= proxy_list[k].srtt) )
+                break;
+            order[j] = order[j-1];
+        }
+        order[j] = k;
+    }
+    return n_proxy_list;
+}
+
+/* use relay server of index I */
+void
+proxy_select( int i )
+{
+    relay_host = proxy_list[i].host;
+    relay_port = proxy_list[i].port;
+    relay_user = proxy_list[i].user;
+}
+
+/* record result of using relay server I, MSEC is time to get ready
+   or -1 for failure. */
+void
+proxy_record( int i, long msec )
+{
+    PROXY_SERVER *p = &proxy_list[i];
+    int changed = (p->fails != 0 || msec < 0);
+
+    if ( msec < 0 ) {
+        p->fails++;
+        p->last_fail = time( NULL );
+        debug("relay server %s:%d failed %d time(s)\n",
+              p->host, p->port, p->fails);
+    } else {
+        p->fails = 0;
+        /* smoothed like TCP RTT */
+        p->srtt = (p->srtt == 0)? msec + 1: (7 * p->srtt + msec + 1) / 8;
+    }
+    if ( 1 < n_proxy_list && (changed || !f_daemon ||
+         PROXY_SAVE_INTERVAL <= time( NULL ) - proxy_state_saved) )
+        proxy_state_save();
+}
+
+
+/** CONNECTING WITHOUT BLOCKING **/
+
+/* A connection to the destination, directly or through a relay
+   server, is made by an ATTEMPT stepped from the event loop of the
+   caller.  Addresses of the first host are tried one more every
+   CONNECT_ATTEMPT_DELAY ms while earlier ones are pending, then the
+   negotiation with each hop of relay_chain and with the relay server
+   runs as NEGO state machine.  Relaying state (relay_xxx and
+   dest_xxx) is switched to the hop during each step, and restored
+   after it.  A DIAL tries relay servers by strategy with attempts,
+   all of them at once for "race" so that the first one to finish the
+   negotiation wins.  make_connection() runs a dial in its own loop. */
+#define AS_CONNECT              0               /* TCP connection */
+#define AS_NEGO                 1               /* negotiating with hop */
+#define AS_DONE                 2
+#define AS_FAILED               3               /* relay server failed */
+#define AS_ERROR                4               /* not to try others */
+#define AS_IDLE                 5               /* failure is recorded */
+#define ATTEMPT_RETRY_MAX       3               /* connections to retry */
+
+typedef struct {
+    int state;                                  /* AS_xxx */
+    const char *host;                           /* destination */
+    u_short port;
+    int method;                                 /* relay method */
+    int proxy;                                  /* in proxy_list, or -1 */
+    int flags;                                  /* NEGO_xxx to the server */
+    int hop;                                    /* in relay_chain */
+    int retry;                                  /* connections made again */
+    long start;                                 /* msec, for proxy_record() */
+    long next_start;                            /* msec to try next address */
+    long deadline;                              /* of connecting, 0: none */
+    METRICS *m;                                 /* phases, or NULL */
+    CONNECT_ADDR addrs[MAX_CONNECT_ADDRS];
+    EV_ITEM conn[MAX_CONNECT_ADDRS];            /* connecting to them */
+    int n_addrs, next, n_pending;
+    int last_err;                               /* errno of last failure */
+    struct sockaddr_in dest_addr;               /* of the hop */
+    SOCKET s;                                   /* connected */
+    EV_ITEM item;                               /* of s while negotiating */
+    NEGO ng;
+} ATTEMPT;
+
+/* relaying state saved by attempt_enter() */
+typedef struct {
+    int method;
+    char *host;
+    u_short port;
+    char *user;
+    int auth_type;
+    char *dest_host;
+    u_short dest_port;
+    struct sockaddr_in dest_addr;
+} RELAY_STATE;
+
+/* name of metrics phase of negotiation by METHOD */
+const char *
+method_phase( int method )
+{
+    switch ( method ) {
+    case METHOD_SOCKS:
+        return (socks_version == 5)? "socks5": "socks4";
+    case METHOD_HTTP:
+        return "http";
+    case METHOD_TELNET:
+        return "telnet";
+    }
+    return "direct";
+}
+
+/* switch relaying state to the hop A negotiates with, the current one
+   is saved into SAVE.  Relay server of A is left selected. */
+void
+attempt_enter( ATTEMPT *a, RELAY_STATE *save )
+{
+    RELAY *hop;
+
+    if ( 0 <= a->proxy )
+        proxy_select( a->proxy );
+    save->method = relay_method;
+    save->host = relay_host;
+    save->port = relay_port;
+    save->user = relay_user;
+    save->auth_type = proxy_auth_type;
+    save->dest_host = dest_host;
+    save->dest_port = dest_port;
+    save->dest_addr = dest_addr;
+    dest_addr = a->dest_addr;
+    if ( a->hop == n_relay_chain ) {
+        relay_method = a->method;
+        dest_host = (char *)a->host;
+        dest_port = a->port;
+        return;
+    }
+    if ( a->hop + 1 < n_relay_chain ) {
+        dest_host = relay_chain[a->hop+1].host;
+        dest_port = relay_chain[a->hop+1].port;
+    } else {
+        dest_host = relay_host;                 /* the relay server */
+        dest_port = relay_port;
+    }
+    hop = &relay_chain[a->hop];
+    relay_method = hop->method;
+    relay_host = hop->host;
+    relay_port = hop->port;
+    relay_user = hop->user;
+    proxy_auth_type = hop->auth_type;
+}
+
+/* restore relaying state saved by attempt_enter() */
+void
+attempt_leave( ATTEMPT *a, RELAY_STATE *save )
+{
+    a->dest_addr = dest_addr;
+    relay_method = save->method;
+    dest_host = save->dest_host;
+    dest_port = save->dest_port;
+    dest_addr = save->dest_addr;
+    if ( a->hop == n_relay_chain )
+        return;                                 /* auth type is learned */
+    relay_chain[a->hop].auth_type = proxy_auth_type; /* for retry */
+    relay_host = save->host;
+    relay_port = save->port;
+    relay_user = save->user;
+    proxy_auth_type = save->auth_type;
+}
+
+/* first host for A to connect to, and its port in *PORT */
+const char *
+attempt_target( ATTEMPT *a, u_short *port )
+{
+    if ( a->method == METHOD_DIRECT ) {
+        *port = a->port;
+        return a->host;
+    }
+    if ( 0 < n_relay_chain ) {
+        *port = relay_chain[0].port;
+        return relay_chain[0].host;
+    }
+    if ( 0 <= a->proxy ) {
+        *port = proxy_list[a->proxy].port;
+        return proxy_list[a->proxy].host;
+    }
+    *port = relay_port;
+    return relay_host;
+}
+
+/* close sockets of A, connecting or connected */
+void
+attempt_close( ATTEMPT *a, EVLOOP *ev )
+{
+    int i;
+
+    for ( i = 0; i < a->next; i++ ) {
+        if ( a->conn[i].fd == SOCKET_ERROR )
+            continue;
+        evloop_del( ev, &a->conn[i] );
+        closesocket( a->conn[i].fd );
+        a->conn[i].fd = SOCKET_ERROR;
+    }
+    a->n_pending = 0;
+    if ( a->s != SOCKET_ERROR ) {
+        evloop_del( ev, &a->item );
+        closesocket( a->s );
+        a->s = SOCKET_ERROR;
+    }
+    memset( a->ng.out, 0, sizeof(a->ng.out) ); /* erase password */
 }
 
-/* begin relaying via HTTP proxy
-   Directs CONNECT method to proxy server to connect to
-   destination host (and port). It may not be allowed on your
-   proxy server.
- */
-int
-begin_http_relay( SOCKET s )
+/* A got connected socket S, negotiate on it next */
+void
+attempt_connected( ATTEMPT *a, EVLOOP *ev, SOCKET s )
 {
-    char buf[1024];
-    int result;
-    char *auth_what;
+    attempt_close( a, ev );                     /* other addresses */
+    a->s = s;
+    if ( a->m != NULL )
+        metrics_phase( a->m, "connect" );
+    if ( a->method == METHOD_DIRECT ||
+         ((a->flags & NEGO_AUTH_ONLY) &&
+          (a->method != METHOD_SOCKS || socks_version != 5)) ) {
+        a->state = AS_DONE;                     /* nothing to negotiate */
+        return;
+    }
+    memset( &a->item, 0, sizeof(a->item) );
+    a->item.fd = s;
+    a->item.events = EV_READ | EV_WRITE;
+    if ( evloop_add( ev, &a->item ) < 0 ) {
+        closesocket( s );
+        a->s = SOCKET_ERROR;
+        a->state = AS_FAILED;
+        return;
+    }
+    memset( &a->ng, 0, sizeof(a->ng) );        /* nothing read yet */
+    a->state = AS_NEGO;
+}
 
-    debug("begin_http_relay()\n");
+/* start connections of A to addresses when their time has come, and
+   check results of pending ones */
+void
+attempt_connecting( ATTEMPT *a, EVLOOP *ev )
+{
+    EV_ITEM *item;
+    const char *host;
+    u_short port;
+    long now = now_msec();
+    int i, err, pending;
+    socklen_t len;
+    SOCKET s;
 
-    if (sendf(s,"CONNECT %s:%d HTTP/1.0\r\n", dest_host, dest_port) < 0)
-        return START_ERROR;
-    if (proxy_auth_type == PROXY_AUTH_BASIC && basic_auth (s) < 0)
-        return START_ERROR;
-    if (sendf(s,"\r\n") < 0)
-        return START_ERROR;
+    for ( i = 0; i < a->next; i++ ) {
+        item = &a->conn[i];
+        if ( item->fd == SOCKET_ERROR || !(item->ready & EV_WRITE) )
+            continue;
+        err = 0;
+        len = sizeof(err);
+        if ( getsockopt( item->fd, SOL_SOCKET, SO_ERROR,
+                         (void*)&err, &len ) < 0 )
+            err = socket_errno();
+        evloop_del( ev, item );
+        a->n_pending--;
+        s = item->fd;
+        item->fd = SOCKET_ERROR;
+        if ( err == 0 ) {
+            debug("connected to %s\n", connect_addr_str( &a->addrs[i] ));
+            attempt_connected( a, ev, s );
+            return;
+        }
+        debug("connect to %s failed, errno=%d\n",
+              connect_addr_str( &a->addrs[i] ), err);
+        closesocket( s );
+        a->last_err = err;
+        a->next_start = now;                    /* don't wait for it */
+    }
+    if ( a->deadline != 0 && a->deadline <= now ) {
+        error("connection timed out\n");
+#ifndef _WIN32
+        a->last_err = ETIMEDOUT;
+#endif /* !_WIN32 */
+        attempt_close( a, ev );
+        a->next = a->n_addrs;                   /* give up all */
+    }
+    while ( a->next < a->n_addrs && a->next_start <= now ) {
+        item = &a->conn[a->next];
+        memset( item, 0, sizeof(*item) );
+        item->fd = SOCKET_ERROR;
+        s = connect_start( &a->addrs[a->next++], &pending );
+        if ( s == SOCKET_ERROR ) {
+            a->last_err = socket_errno();
+            continue;                           /* try next at once */
+        }
+        if ( !pending ) {
+            attempt_connected( a, ev, s );
+            return;
+        }
+        item->fd = s;
+        item->events = EV_WRITE;
+        if ( evloop_add( ev, item ) < 0 ) {
+            closesocket( s );
+            item->fd = SOCKET_ERROR;
+            continue;
+        }
+        a->n_pending++;
+        a->next_start = now + CONNECT_ATTEMPT_DELAY;
+    }
+    if ( a->n_pending == 0 && a->n_addrs <= a->next ) {
+        host = attempt_target( a, &port );
+        if ( a->method == METHOD_DIRECT )
+            error( "Unable to connect to destination host, errno=%d\n",
+                   a->last_err );
+        else
+            error( "Unable to connect to relay host %s:%d, errno=%d\n",
+                   host, port, a->last_err );
+        a->state = AS_FAILED;
+    }
+}
+
+/* resolve the first host of A and start connecting to it */
+void
+attempt_begin( ATTEMPT *a, EVLOOP *ev )
+{
+    const char *host;
+    u_short port;
+
+    host = attempt_target( a, &port );
+    a->state = AS_CONNECT;
+    a->hop = 0;
+    a->next = a->n_pending = a->last_err = 0;
+    a->n_addrs = resolve_addrs( host, port, a->addrs, MAX_CONNECT_ADDRS );
+    if ( a->n_addrs <= 0 ) {
+        error("can't resolve hostname: %s\n", host);
+        a->state = AS_FAILED;
+        return;
+    }
+    if ( a->m != NULL )
+        metrics_phase( a->m, "dns" );
+    a->next_start = now_msec();
+    a->deadline = (0 < connect_timeout)?
+        a->next_start + connect_timeout * 1000L: 0;
+    attempt_connecting( a, ev );
+}
+
+/* begin negotiation of A with its hop, relaying state is entered */
+int
+attempt_nego_start( ATTEMPT *a )
+{
+    LINE_READER in = a->ng.in;                  /* left by previous hop */
 
-    /* get response */
-    if ( line_input(s, buf, sizeof(buf)) < 0 ) {
-        debug("failed to read http response.\n");
+#if !defined(_WIN32) && !defined(__CYGWIN32__)
+    if ( socks_ns.sin_addr.s_addr != 0 )
+        switch_ns( &socks_ns );
+#endif /* not _WIN32 && not __CYGWIN32__ */
+    memset( &dest_addr, 0, sizeof(dest_addr) );
+    if ( relay_method == METHOD_SOCKS && socks_resolve == RESOLVE_LOCAL &&
+         !(a->flags & NEGO_AUTH_ONLY) &&        /* destination is known */
+         local_resolve( dest_host, &dest_addr ) < 0 ) {
+        error("Unknown host: %s\n", dest_host);
+        a->state = AS_ERROR;
         return START_ERROR;
     }
+    memset( &a->ng, 0, sizeof(a->ng) );
+    a->ng.s = a->s;
+    a->ng.in = in;
+    a->ng.in.sock = a->s;
+    a->ng.method = relay_method;
+    a->ng.flags = (a->hop == n_relay_chain)? a->flags: 0;
+    a->ng.m = a->m;
+    if ( a->hop < n_relay_chain )
+        debug("hop %d: %s %s:%d to %s:%d\n", a->hop+1,
+              method_names[relay_method], relay_host, relay_port,
+              dest_host, dest_port);
+    return nego_start( &a->ng );
+}
 
-    /* check status */
-    if (!strchr(buf, ' ')) {
-	error ("Unexpected http response: '%s'.\n", buf);
-	return START_ERROR;
+/* negotiation of A with its hop by METHOD ended with RET */
+void
+attempt_nego_done( ATTEMPT *a, EVLOOP *ev, int method, int ret )
+{
+    switch ( ret ) {
+    case START_OK:
+        if ( a->m != NULL )
+            metrics_phase( a->m, method_phase( method ) );
+        if ( a->hop < n_relay_chain ) {
+            a->hop++;
+            a->ng.state = 0;                    /* begin with next hop */
+            return;
+        }
+        evloop_del( ev, &a->item );
+        memset( a->ng.out, 0, sizeof(a->ng.out) ); /* erase password */
+        a->state = AS_DONE;
+        return;
+    case START_RETRY:
+        attempt_close( a, ev );
+        if ( ATTEMPT_RETRY_MAX <= ++a->retry ) {
+            error("too many retries via %s.\n", method_names[method]);
+            a->state = AS_FAILED;
+            return;
+        }
+        debug("retrying on new connection.\n");
+        attempt_begin( a, ev );
+        return;
+    }
+    if ( a->state != AS_ERROR ) {
+        error("failed to begin relaying via %s.\n", method_names[method]);
+        a->state = AS_FAILED;
     }
-    result = atoi(strchr(buf,' '));
+    attempt_close( a, ev );
+}
 
-    switch ( result ) {
-    case 200:
-        /* Conguraturation, connected via http proxy server! */
-        debug("connected, start user session.\n");
-        break;
-    case 302:                                   /* redirect */
-        do {
-            if (line_input(s, buf, sizeof(buf)))
-                break;
-            downcase(buf);
-            if (expect(buf, "Location: ")) {
-                relay_host = cut_token(buf, "//");
-                cut_token(buf, "/");
-                relay_port = atoi(cut_token(buf, ":"));
+/* negotiate on connected A as far as possible without blocking */
+void
+attempt_nego( ATTEMPT *a, EVLOOP *ev )
+{
+    RELAY_STATE save;
+    int n, ret, method;
+
+    while ( a->state == AS_NEGO ) {
+        attempt_enter( a, &save );
+        method = relay_method;
+        n = 1;                                  /* try I/O at once */
+        if ( a->ng.state == 0 ) {               /* not begun */
+            ret = attempt_nego_start( a );
+        } else if ( (n = nego_io( &a->ng, ev, &a->item )) < 0 ) {
+            ret = START_ERROR;
+        } else if ( (ret = nego_step( &a->ng )) == START_AGAIN ) {
+            if ( a->ng.eof ) {
+                error("Connection closed by peer in %s phase.\n",
+                      a->ng.phase);
+                ret = START_ERROR;
+            } else if ( n == 0 && a->ng.deadline <= now_msec() ) {
+                error("timed out in %s phase.\n", a->ng.phase);
+                ret = START_ERROR;
             }
-        } while (strcmp(buf,"\r\n") != 0);
-        return START_RETRY;
-
-    /* We handle both 401 and 407 codes here: 401 is WWW-Authenticate, which
-     * not strictly the correct response, but some proxies do send this (e.g.
-     * Symantec's Raptor firewall) */
-    case 401:                                   /* WWW-Auth required */
-    case 407:                                   /* Proxy-Auth required */
-        /** NOTE: As easy implementation, we support only BASIC scheme
-            and ignore realm. */
-        /* If proxy_auth_type is PROXY_AUTH_BASIC and get
-         this result code, authentication was failed. */
-        if (proxy_auth_type != PROXY_AUTH_NONE) {
-            error("Authentication failed.\n");
-            return START_ERROR;
         }
-        auth_what = (result == 401) ? "WWW-Authenticate:" : "Proxy-Authenticate:";
-        do {
-            if ( line_input(s, buf, sizeof(buf)) ) {
+        attempt_leave( a, &save );
+        if ( ret != START_AGAIN )
+            attempt_nego_done( a, ev, method, ret );
+        else if ( n == 0 )
+            return;                             /* wait for events */
+    }
+}
+
+/* make progress of A as far as possible without blocking */
+void
+attempt_step( ATTEMPT *a, EVLOOP *ev )
+{
+    int state;
+
+    do {
+        state = a->state;
+        if ( a->state == AS_CONNECT )
+            attempt_connecting( a, ev );
+        if ( a->state == AS_NEGO )
+            attempt_nego( a, ev );
+    } while ( a->state != state && a->state < AS_DONE );
+}
+
+/* milli-seconds until A needs a step without events, -1 if none */
+long
+attempt_wait( ATTEMPT *a, long now )
+{
+    long wait = -1;
+
+    if ( a->state == AS_CONNECT ) {
+        if ( a->next < a->n_addrs )
+            wait = a->next_start - now;
+        if ( a->deadline != 0 )
+            wait = limit_min( wait, a->deadline - now );
+    } else if ( a->state == AS_NEGO ) {
+        wait = a->ng.deadline - now;
+    } else {
+        return -1;
+    }
+    return (wait < 0)? 0: wait;
+}
+
+#define DS_PENDING              0
+#define DS_DONE                 1
+#define DS_FAILED               2
+
+typedef struct dial {
+    int state;                                  /* DS_xxx */
+    char *host;                                 /* destination */
+    u_short port;
+    int method;                                 /* relay method */
+    METRICS m;
+    int *order;                                 /* relay servers to try */
+    int n_order, tried;
+    ATTEMPT *at;                                /* running attempts */
+    int n_at;
+    int win;                                    /* attempt succeeded */
+    int pooled;                                 /* at[0] is on pooled one */
+    SOCKET s;                                   /* connected */
+    SOCKET local_in, local_out;                 /* client of daemon */
+    struct front *front;                        /* or front-end client */
+    struct dial *next;
+} DIAL;
+
+/* begin attempt A of D with relay server PROXY (-1 for relay_host).
+   Phases are recorded unless RACING. */
+void
+dial_attempt( DIAL *d, ATTEMPT *a, int proxy, int racing, EVLOOP *ev )
+{
+    memset( a, 0, sizeof(*a) );
+    a->host = d->host;
+    a->port = d->port;
+    a->method = d->method;
+    a->proxy = proxy;
+    a->m = racing? NULL: &d->m;
+    a->s = SOCKET_ERROR;
+    a->start = now_msec();
+    attempt_begin( a, ev );
+}
+
+/* begin attempts of D with relay servers not tried yet, all of them
+   if racing, otherwise the next one in order */
+void
+dial_next( DIAL *d, EVLOOP *ev )
+{
+    int i, n = 1;
+
+    if ( proxy_strategy == STRATEGY_RACE && n_relay_chain == 0 )
+        n = d->n_order - d->tried;
+    d->pooled = 0;                              /* new connections */
+    free( d->at );
+    d->at = xmalloc( sizeof(ATTEMPT) * n );
+    d->n_at = n;
+    for ( i = 0; i < n; i++ )
+        dial_attempt( d, &d->at[i], d->order[d->tried++], 1 < n, ev );
+    if ( 1 < n )
+        metrics_phase( &d->m, "dns" );
+}
+
+/* attempt A of D has succeeded */
+void
+dial_won( DIAL *d, ATTEMPT *a )
+{
+    d->state = DS_DONE;
+    d->win = a - d->at;
+    d->s = a->s;
+    a->s = SOCKET_ERROR;                        /* not to be closed */
+    if ( a->proxy < 0 )
+        return;
+    proxy_select( a->proxy );
+    if ( !d->pooled )
+        proxy_record( a->proxy, now_msec() - a->start );
+    if ( 1 < d->n_at ) {
+        debug("relay server %s:%d won the race\n", relay_host, relay_port);
+        metrics_phase( &d->m, method_phase( d->method ) );
+    }
+}
+
+/* make progress of D as far as possible without blocking */
+void
+dial_step( DIAL *d, EVLOOP *ev )
+{
+    ATTEMPT *a;
+    int i, running;
+
+    while ( d->state == DS_PENDING ) {
+        running = 0;
+        for ( i = 0; d->state == DS_PENDING && i < d->n_at; i++ ) {
+            a = &d->at[i];
+            attempt_step( a, ev );
+            switch ( a->state ) {
+            case AS_DONE:
+                dial_won( d, a );
                 break;
+            case AS_FAILED:
+                if ( 0 <= a->proxy && !d->pooled )
+                    proxy_record( a->proxy, -1 );
+                a->state = AS_IDLE;
+                break;
+            case AS_ERROR:
+                d->state = DS_FAILED;
+                break;
+            case AS_IDLE:
+                break;
+            default:
+                running++;
             }
-            downcase(buf);
-            if (expect(buf, auth_what)) {
-                /* parse type and realm */
-                char *scheme, *realm;
-                scheme = cut_token(buf, " ");
-                realm = cut_token(scheme, " ");
-                if ( scheme == NULL || realm == NULL ) {
-                    debug("Invalid format of %s field.", auth_what);
-                    return START_ERROR;         /* fail */
-                }
-                /* check supported auth type */
-                if (expect(scheme, "basic")) {
-                    proxy_auth_type = PROXY_AUTH_BASIC;
-                } else {
-                    debug("Unsupported authentication type: %s", scheme);
-                }
-            }
-        } while (strcmp(buf,"\r\n") != 0);
-        if ( proxy_auth_type == PROXY_AUTH_NONE ) {
-            debug("Can't find %s in response header.", auth_what);
-            return START_ERROR;
+        }
+        if ( d->state != DS_PENDING || 0 < running )
+            break;
+        if ( d->n_order <= d->tried )
+            d->state = DS_FAILED;               /* all failed */
+        else
+            dial_next( d, ev );                 /* failover */
+    }
+}
+
+/* milli-seconds until D needs a step without events, -1 if none */
+long
+dial_wait( DIAL *d, long now )
+{
+    long wait = -1;
+    int i;
+
+    for ( i = 0; d->state == DS_PENDING && i < d->n_at; i++ )
+        wait = limit_min( wait, attempt_wait( &d->at[i], now ) );
+    return wait;
+}
+
+/** CONNECTION POOL **/
+
+/* In daemon mode, some connections to the relay server are opened in
+   advance.  They are negotiated as far as possible without knowing
+   the destination: SOCKS5 authentication is done, other methods have
+   only TCP connection.  A new client then pays only for the
+   CONNECT request.  Connections are opened by attempts in the daemon
+   loop, and after failure opening is retried with growing interval. */
+#define POOL_IDLE_DEFAULT 30                    /* seconds */
+#define POOL_RETRY_MIN  1000                    /* msec after failure */
+#define POOL_RETRY_MAX  60000
+
+typedef struct {
+    SOCKET s;
+    int proxy;                                  /* relay server in list */
+    time_t since;                               /* time when opened */
+} POOL_ITEM;
+
+POOL_ITEM *pool = NULL;
+ATTEMPT *pool_at = NULL;                        /* connections being opened */
+int pool_size = 0;                              /* target # of connections */
+int pool_len = 0;                               /* current # of connections */
+int pool_idle = POOL_IDLE_DEFAULT;              /* max idle seconds */
+long pool_backoff = 0;                          /* msec to wait after failure */
+long pool_retry = 0;                            /* msec to open again */
+
+void
+pool_init (void)
+{
+    char *param;
+    int i;
+
+    if ((param = getparam(ENV_CONNECT_POOL_SIZE)) != NULL)
+        pool_size = atoi(param);
+    if ((param = getparam(ENV_CONNECT_POOL_IDLE)) != NULL)
+        pool_idle = atoi(param);
+    if (pool_size <= 0 || relay_method == METHOD_DIRECT ||
+        0 < n_relay_chain) {
+        pool_size = 0;
+        return;
+    }
+    pool = xmalloc (sizeof(POOL_ITEM) * pool_size);
+    pool_at = xmalloc (sizeof(ATTEMPT) * pool_size);
+    memset (pool_at, 0, sizeof(ATTEMPT) * pool_size);
+    for (i = 0; i < pool_size; i++) {
+        pool_at[i].state = AS_IDLE;
+        pool_at[i].s = SOCKET_ERROR;
+    }
+    debug ("connection pool: %d connections, %d seconds idle\n",
+           pool_size, pool_idle);
+}
+
+/* start opening connection A for pool to the relay server to be
+   tried first, negotiated as far as destination is not needed. */
+void
+pool_open (ATTEMPT *a, EVLOOP *ev)
+{
+    int *order = xmalloc (sizeof(int) * n_proxy_list);
+
+    proxy_order (order);
+    memset (a, 0, sizeof(*a));
+    a->method = relay_method;
+    a->proxy = order[0];
+    a->flags = NEGO_AUTH_ONLY;
+    a->s = SOCKET_ERROR;
+    a->start = now_msec ();
+    free (order);
+    attempt_begin (a, ev);
+}
+
+/* is pooled socket S still usable? */
+int
+pool_alive (SOCKET s)
+{
+    char c;
+    int len;
+#ifdef _WIN32
+    set_nonblock (s, 1);
+    len = recv (s, &c, 1, MSG_PEEK);
+    set_nonblock (s, 0);
+#else  /* !_WIN32 */
+    len = recv (s, &c, 1, MSG_PEEK | MSG_DONTWAIT);
+#endif /* !_WIN32 */
+    /* closed (0), unexpected data (1) or error are not usable */
+    return (len == -1 && socket_wouldblock());
+}
+
+/* close connections idle too long or closed by server */
+void
+pool_expire (void)
+{
+    time_t now = time (NULL);
+    int i = 0;
+    while (i < pool_len) {
+        if (now - pool[i].since < pool_idle && pool_alive (pool[i].s)) {
+            i++;
+            continue;
+        }
+        debug ("pool: dropping connection (socket=%d)\n", pool[i].s);
+        closesocket (pool[i].s);
+        pool[i] = pool[--pool_len];
+    }
+}
+
+/* top up pool to configured size in EV unless waiting to retry, and
+   take connections got ready into it */
+void
+pool_fill (EVLOOP *ev)
+{
+    ATTEMPT *a;
+    int i, opening = 0, failed = 0;
+
+    if (pool_size == 0)
+        return;
+    pool_expire ();
+    for (i = 0; i < pool_size; i++)
+        if (pool_at[i].state != AS_IDLE)
+            opening++;
+    for (i = 0; i < pool_size && pool_len + opening < pool_size &&
+             pool_retry <= now_msec (); i++) {
+        if (pool_at[i].state != AS_IDLE)
+            continue;
+        pool_open (&pool_at[i], ev);
+        opening++;
+    }
+    for (i = 0; i < pool_size; i++) {
+        a = &pool_at[i];
+        attempt_step (a, ev);
+        if (a->state == AS_DONE) {
+            debug ("pool: new connection (socket=%d)\n", a->s);
+            pool[pool_len].s = a->s;
+            pool[pool_len].proxy = a->proxy;
+            pool[pool_len].since = time (NULL);
+            pool_len++;
+            a->s = SOCKET_ERROR;                /* now in pool */
+            a->state = AS_IDLE;
+            pool_backoff = 0;
+        } else if (a->state == AS_FAILED || a->state == AS_ERROR) {
+            attempt_close (a, ev);
+            a->state = AS_IDLE;
+            failed = 1;
+        }
+    }
+    if (failed) {
+        pool_backoff = (pool_backoff == 0)? POOL_RETRY_MIN:
+            limit_min (pool_backoff * 2, POOL_RETRY_MAX);
+        pool_retry = now_msec () + pool_backoff;
+        debug ("pool: opening again in %ld msec\n", pool_backoff);
+    }
+}
+
+/* milli-seconds until pool_fill() is needed without events, -1 if
+   pool is not used */
+long
+pool_wait (long now)
+{
+    long wait;
+    int i, opening = 0;
+
+    if (pool_size == 0)
+        return -1;
+    wait = pool_idle * 1000L / 2;               /* to expire */
+    for (i = 0; i < pool_size; i++) {
+        if (pool_at[i].state == AS_IDLE)
+            continue;
+        opening++;
+        wait = limit_min (wait, attempt_wait (&pool_at[i], now));
+    }
+    if (pool_len + opening < pool_size)
+        wait = limit_min (wait, (pool_retry < now)? 0: pool_retry - now);
+    return wait;
+}
+
+/* take a warm connection from pool and its relay server into *PROXY,
+   returns SOCKET_ERROR if no one is available. */
+SOCKET
+pool_take (int *proxy)
+{
+    POOL_ITEM item;
+    while (0 < pool_len) {
+        item = pool[--pool_len];                /* newest first */
+        if (time (NULL) - item.since < pool_idle && pool_alive (item.s)) {
+            debug ("pool: using connection (socket=%d)\n", item.s);
+            *proxy = item.proxy;
+            return item.s;
+        }
+        closesocket (item.s);
+    }
+    return SOCKET_ERROR;
+}
+
+/* start connecting to HOST:PORT by relay METHOD with EV.  Returns
+   new dial, which may be finished already. */
+DIAL *
+dial_start( EVLOOP *ev, const char *host, u_short port, int method )
+{
+    DIAL *d = xmalloc( sizeof(DIAL) );
+    SOCKET s;
+    int proxy;
+
+    memset( d, 0, sizeof(*d) );
+    d->host = strdup( host );
+    d->port = port;
+    d->method = check_direct( host )? METHOD_DIRECT: method;
+    d->s = SOCKET_ERROR;
+    metrics_begin( &d->m );
+    if ( d->method == METHOD_DIRECT ) {
+        d->at = xmalloc( sizeof(ATTEMPT) );
+        d->n_at = 1;
+        dial_attempt( d, &d->at[0], -1, 0, ev );
+    } else {
+        d->order = xmalloc( sizeof(int) * n_proxy_list );
+        d->n_order = proxy_order( d->order );
+        if ( (s = pool_take( &proxy )) != SOCKET_ERROR ) {
+            /* already authenticated, new connection if failed */
+            d->at = xmalloc( sizeof(ATTEMPT) );
+            d->n_at = 1;
+            d->pooled = 1;
+            memset( &d->at[0], 0, sizeof(ATTEMPT) );
+            d->at[0].host = d->host;
+            d->at[0].port = d->port;
+            d->at[0].method = d->method;
+            d->at[0].proxy = proxy;
+            d->at[0].flags = NEGO_CONNECT;
+            d->at[0].m = &d->m;
+            d->at[0].s = SOCKET_ERROR;
+            attempt_connected( &d->at[0], ev, s );
         } else {
-            return START_RETRY;
+            dial_next( d, ev );
         }
+    }
+    dial_step( d, ev );
+    return d;
+}
 
-    default:
-        /* Not allowed */
-        debug("http proxy is not allowed.\n");
-        return START_ERROR;
+/* release D and return its connected socket, or SOCKET_ERROR.  Bytes
+   read ahead are left in line_reader and metrics in conn_metrics for
+   the session. */
+SOCKET
+dial_finish( DIAL *d, EVLOOP *ev )
+{
+    SOCKET s = d->s;
+    int i;
+
+    for ( i = 0; i < d->n_at; i++ )
+        attempt_close( &d->at[i], ev );
+    conn_metrics = d->m;
+    conn_metrics.method = d->method;
+    if ( s != SOCKET_ERROR ) {
+        line_reader = d->at[d->win].ng.in;
+        line_reader.sock = s;
+        debug("connected\n");
     }
-    /* skip to end of response header */
-    do {
-        if ( line_input(s, buf, sizeof(buf) ) ) {
-            debug("Can't skip response headers\n");
-            return START_ERROR;
+    free( d->at );
+    free( d->order );
+    free( d->host );
+    free( d );
+    return s;
+}
+
+/* make connection to the destination host, directly or via relay
+   server, and finish negotiation of relaying.
+   Returns connected socket or SOCKET_ERROR. */
+SOCKET
+make_connection (void)
+{
+    EVLOOP ev;
+    DIAL *d;
+    SOCKET remote;
+
+    if (check_direct(dest_host))
+        relay_method = METHOD_DIRECT;
+    evloop_init (&ev);
+    d = dial_start (&ev, dest_host, dest_port, relay_method);
+    while (d->state == DS_PENDING) {
+        if (evloop_wait (&ev, dial_wait (d, now_msec())) < 0) {
+            error ("evloop_wait() failed, errno=%d\n", socket_errno());
+            break;
         }
-    } while ( strcmp(buf,"\r\n") != 0 );
+        dial_step (d, &ev);
+    }
+    remote = dial_finish (d, &ev);
+    evloop_done (&ev);
+#ifndef _WIN32
+    if (remote != SOCKET_ERROR)
+        set_nonblock (remote, 0);               /* as relay expects */
+#endif /* !_WIN32 */
+    return remote;
+}
 
-    return START_OK;
+#ifndef _WIN32
+/** RESIDENT **/
+
+/* With option 'U', the daemon listens on a Unix domain socket instead
+   of a TCP port.  A launcher, which is this program started with
+   CONNECT_RESIDENT in environment, sends its stdin and stdout over the
+   socket with SCM_RIGHTS together with the destination, then exits at
+   once.  The resident makes the connection and relays the descriptors
+   as a session, with its caches, pool and passwords already warm.
+
+   The message is "HOST\0PORT\0".  The launcher does nothing else
+   before handing off: no parameter file nor name lookup. */
+#define RESIDENT_MSG_MAX        1024
+#define RESIDENT_ARG_OPTIONS    "SHTcpPDwaRBOUAF" /* options with argument */
+#define RESIDENT_SELF_OPTIONS   "pPDUAFdVsnhtSHTc45aR" /* not to hand off */
+
+/* set destination given by a client of daemon */
+void
+set_destination( const char *host, u_short port )
+{
+    static char *client_host = NULL;
+
+    free( client_host );
+    dest_host = client_host = strdup( host );
+    dest_port = port;
+    memset( &dest_addr, 0, sizeof(dest_addr) );
 }
 
-/* begin relaying via TELNET proxy.
-   Sends string specified by telnet_command (-c option) with
-   replacing host name and port number to the socket.  */
+/* hand off stdin/stdout to the resident at CONNECT_RESIDENT.  Options
+   are skipped as getarg() does.  A launcher given its own relay server
+   or method runs by itself, as the resident would ignore them.
+   Returns 0 if handed, or -1 to run by itself. */
 int
-begin_telnet_relay( SOCKET s )
+resident_handoff( int argc, char **argv )
 {
-    char buf[1024];
-    char *cmd;
-    char *good_phrase = "connected to";
-    char *bad_phrase_list[] = {
-	" failed", " refused", " rejected", " closed"
-    };
-    char sep = ' ';
-    int i;
+    char *path = getenv( ENV_CONNECT_RESIDENT ), *ptr, *args[2];
+    char msg[RESIDENT_MSG_MAX];
+    union {
+        struct cmsghdr hdr;
+        char buf[CMSG_SPACE(2 * sizeof(int))];
+    } ctl;
+    struct sockaddr_un name;
+    struct msghdr mh;
+    struct iovec iov;
+    struct cmsghdr *cm;
+    int fds[2] = { 0, 1 };
+    int s, len, n;
+
+    if ( path == NULL || *path == '\0' ||
+         sizeof(name.sun_path) <= strlen( path ) )
+        return -1;
+    if ( isatty( 0 ) || isatty( 1 ) )
+        return -1;                              /* not for ProxyCommand */
+    for ( argc--, argv++; 0 < argc && **argv == '-'; argc--, argv++ ) {
+        for ( ptr = *argv + 1; *ptr; ptr++ ) {
+            if ( strchr( RESIDENT_SELF_OPTIONS, *ptr ) != NULL )
+                return -1;
+            if ( strchr( RESIDENT_ARG_OPTIONS, *ptr ) != NULL && 1 < argc )
+                argc--, argv++;                 /* skip argument */
+        }
+    }
+    if ( argc != 2 )
+        return -1;                              /* port from progname */
+    args[0] = argv[0];
+    args[1] = argv[1];
+    len = 0;
+    for ( n = 0; n < 2; n++ ) {
+        if ( sizeof(msg) <= len + strlen( args[n] ) )
+            return -1;
+        strcpy( msg + len, args[n] );
+        len += strlen( args[n] ) + 1;
+    }
 
-    debug("begin_telnet_relay()\n");
+    if ( (s = socket( AF_UNIX, SOCK_STREAM, 0 )) < 0 )
+        return -1;
+    memset( &name, 0, sizeof(name) );
+    name.sun_family = AF_UNIX;
+    strcpy( name.sun_path, path );
+    if ( connect( s, (struct sockaddr *)&name, sizeof(name) ) < 0 ) {
+        close( s );                             /* resident is not running */
+        return -1;
+    }
+    iov.iov_base = msg;
+    iov.iov_len = len;
+    memset( &mh, 0, sizeof(mh) );
+    mh.msg_iov = &iov;
+    mh.msg_iovlen = 1;
+    mh.msg_control = ctl.buf;
+    mh.msg_controllen = sizeof(ctl.buf);
+    cm = CMSG_FIRSTHDR( &mh );
+    cm->cmsg_level = SOL_SOCKET;
+    cm->cmsg_type = SCM_RIGHTS;
+    cm->cmsg_len = CMSG_LEN( sizeof(fds) );
+    memcpy( CMSG_DATA( cm ), fds, sizeof(fds) );
+    n = sendmsg( s, &mh, 0 );
+    close( s );
+    return (n == len)? 0: -1;
+}
 
-    /* report phrase */
-    debug("good phrase: '%s'\n", good_phrase);
-    debug("bad phrases");
-    sep = ':';
-    for (i=0; i< (sizeof(bad_phrase_list) / sizeof(char*)); i++) {
-	debug_("%c '%s'", sep, bad_phrase_list[i]);
-	sep = ',';
+/* listen at Unix domain socket PATH, only for the same user */
+SOCKET
+open_unix_socket( const char *path )
+{
+    struct sockaddr_un name;
+    SOCKET sock;
+    mode_t mask;
+
+    if ( sizeof(name.sun_path) <= strlen( path ) )
+        fatal("too long socket path: %s\n", path);
+    memset( &name, 0, sizeof(name) );
+    name.sun_family = AF_UNIX;
+    strcpy( name.sun_path, path );
+    if ( (sock = socket( AF_UNIX, SOCK_STREAM, 0 )) < 0 )
+        fatal("socket() failed, errno=%d\n", socket_errno());
+    if ( connect( sock, (struct sockaddr *)&name, sizeof(name) ) == 0 )
+        fatal("another process is listening at %s\n", path);
+    close( sock );
+    unlink( path );                             /* left by dead resident */
+    if ( (sock = socket( AF_UNIX, SOCK_STREAM, 0 )) < 0 )
+        fatal("socket() failed, errno=%d\n", socket_errno());
+    mask = umask( 077 );
+    if ( bind( sock, (struct sockaddr *)&name, sizeof(name) ) < 0 )
+        fatal("bind() to %s failed, errno=%d\n", path, socket_errno());
+    umask( mask );
+    if ( listen( sock, SOMAXCONN ) < 0 )
+        fatal("listen() failed, errno=%d\n", socket_errno());
+    return sock;
+}
+
+/* is peer of Unix domain socket C the same user?  Without a way to
+   know it, permission of the socket is trusted. */
+int
+unix_peer_ok( SOCKET c )
+{
+#if defined(__linux__) && defined(SO_PEERCRED)
+    struct ucred cred;
+    socklen_t len = sizeof(cred);
+
+    if ( getsockopt( c, SOL_SOCKET, SO_PEERCRED, &cred, &len ) < 0 ||
+         cred.uid != getuid() ) {
+        error("peer of other user is rejected.\n");
+        return 0;
     }
-    debug_("\n");
+#elif defined(__FreeBSD__) || defined(__OpenBSD__) || \
+      defined(__NetBSD__) || defined(__APPLE__)
+    uid_t uid;
+    gid_t gid;
+
+    if ( getpeereid( c, &uid, &gid ) < 0 || uid != getuid() ) {
+        error("peer of other user is rejected.\n");
+        return 0;
+    }
+#endif
+    return 1;
+}
 
-    /* make request string with replacing %h by destination hostname
-       and %p by port number, etc. */
-    cmd = expand_host_and_port(telnet_command, dest_host, dest_port);
-    
-    /* Sorry, we send request string now without waiting a prompt. */
-    if (sendf(s, "%s\r\n", cmd) < 0) {
-	free(cmd);
-        return START_ERROR;
+/* receive descriptors and destination from launcher on S, and set
+   dest_host and dest_port.  Returns 0 on success, -1 on error. */
+int
+resident_receive( SOCKET s, int *in, int *out )
+{
+    char msg[RESIDENT_MSG_MAX], *port;
+    union {
+        struct cmsghdr hdr;
+        char buf[CMSG_SPACE(2 * sizeof(int))];
+    } ctl;
+    struct msghdr mh;
+    struct iovec iov;
+    struct cmsghdr *cm;
+    int fds[2], len;
+    u_short num;
+
+    if ( !unix_peer_ok( s ) )
+        return -1;                              /* not our launcher */
+    iov.iov_base = msg;
+    iov.iov_len = sizeof(msg) - 1;
+    memset( &mh, 0, sizeof(mh) );
+    mh.msg_iov = &iov;
+    mh.msg_iovlen = 1;
+    mh.msg_control = ctl.buf;
+    mh.msg_controllen = sizeof(ctl.buf);
+    if ( (len = recvmsg( s, &mh, 0 )) <= 0 ) {
+        error("receiving from launcher failed, errno=%d\n", socket_errno());
+        return -1;
+    }
+    cm = CMSG_FIRSTHDR( &mh );
+    if ( cm == NULL || cm->cmsg_level != SOL_SOCKET ||
+         cm->cmsg_type != SCM_RIGHTS ||
+         cm->cmsg_len != CMSG_LEN( sizeof(fds) ) ) {
+        error("no descriptors from launcher.\n");
+        return -1;
+    }
+    memcpy( fds, CMSG_DATA( cm ), sizeof(fds) );
+    msg[len] = '\0';
+    port = msg + strlen( msg ) + 1;
+    if ( msg + len <= port || (num = resolve_port( port )) == 0 ) {
+        error("invalid destination from launcher.\n");
+        close( fds[0] );
+        close( fds[1] );
+        return -1;
+    }
+    set_destination( msg, num );
+    debug("handed off for %s:%d (fd=%d,%d)\n",
+          dest_host, dest_port, fds[0], fds[1]);
+    *in = fds[0];
+    *out = fds[1];
+    return 0;
+}
+
+/** PROXY FRONT-END **/
+
+/* With option 'F', the daemon is a SOCKS5 and HTTP proxy server for
+   local clients.  Each client gives its own destination by SOCKS5
+   CONNECT (without authentication) or HTTP CONNECT, and it is reached
+   directly or via the relay server by the direct list as usual.  The
+   request is read in the event loop, then the connection is made in
+   the loop too like '-D', and the client gets the reply when it is
+   ready. */
+#define FRONT_BUFSIZ            1024
+#define FS_NEW                  0               /* protocol unknown */
+#define FS_SOCKS5_HELLO         1               /* method selection */
+#define FS_SOCKS5_REQUEST       2
+#define FS_HTTP                 3               /* request header */
+
+typedef struct front {
+    SOCKET s;
+    EV_ITEM item;
+    int state;                                  /* FS_xxx */
+    long deadline;                              /* msec to give up */
+    int len;
+    unsigned char buf[FRONT_BUFSIZ+1];          /* request received */
+    struct front *next;
+} FRONT;
+
+/* send reply of LEN bytes in BUF to client F.  Returns -1 on error. */
+int
+front_reply( FRONT *f, const void *buf, int len )
+{
+    if ( send( f->s, buf, len, 0 ) != len ) {
+        error("cannot reply to client, errno=%d\n", socket_errno());
+        return -1;
     }
-    free(cmd);
+    return 0;
+}
 
-    /* Process answer from proxy until good or bad phrase is detected.  We
-       assume that the good phrase should be appeared only in the final
-       line of proxy responses. Bad keywods in the line causes operation
-       fail. First checks a good phrase, then checks bad phrases.
-       If no match, continue reading line from proxy. */
-    while (!line_input(s, buf, sizeof(buf)) && buf[0] != '\0') {
-	downcase(buf);
-	/* first, check good phrase */
-        if (strstr(buf, good_phrase)) {
-	    debug("good phrase is detected: '%s'\n", good_phrase);
-            return START_OK;
-        }
-	/* then, check bad phrase */
-	for (i=0; i<(sizeof(bad_phrase_list)/sizeof(char*)); i++) {
-	    if (strstr(buf, bad_phrase_list[i]) != NULL) {
-		debug("bad phrase is detected: '%s'\n", bad_phrase_list[i]);
-		return START_ERROR;
-	    }
-        }
-    }
-    debug("error reading from telnet proxy\n");
+/* reply SOCKS5 REP code to client F */
+int
+front_socks5_reply( FRONT *f, int rep )
+{
+    unsigned char buf[10];
 
-    return START_ERROR;
+    memset( buf, 0, sizeof(buf) );
+    buf[0] = 5;
+    buf[1] = rep;
+    buf[3] = SOCKS5_ATYP_IPv4;                  /* bound 0.0.0.0:0 */
+    return front_reply( f, buf, sizeof(buf) );
 }
 
+/* discard LEN bytes of request consumed */
+void
+front_consume( FRONT *f, int len )
+{
+    memmove( f->buf, f->buf + len, f->len - len );
+    f->len -= len;
+}
 
-#ifdef _WIN32
-/* ddatalen()
-   Returns 1 if data is available, otherwise return 0
- */
+/* parse request of client F for destination into HOST of SIZE bytes
+   and *PORT.  Returns 1 if got, 0 if not yet or -1 on error. */
 int
-stdindatalen (void)
+front_parse( FRONT *f, char *host, int size, u_short *port )
 {
-    DWORD len = 0;
-    struct stat st;
-    fstat( 0, &st );
-    if ( st.st_mode & _S_IFIFO ) {
-        /* in case of PIPE */
-        if ( !PeekNamedPipe( GetStdHandle(STD_INPUT_HANDLE),
-                             NULL, 0, NULL, &len, NULL) ) {
-            if ( GetLastError() == ERROR_BROKEN_PIPE ) {
-                /* PIPE source is closed */
-                /* read() will detects EOF */
-                len = 1;
-            } else {
-                fatal("PeekNamedPipe() failed, errno=%d\n",
-                      GetLastError());
-            }
+    static const char *http_405 = "HTTP/1.1 405 Method Not Allowed\r\n"
+        "Allow: CONNECT\r\nContent-Length: 0\r\n\r\n";
+    unsigned char *p = f->buf, reply[2];
+    char method[16], target[256], *sep;
+    int need;
+
+    if ( f->state == FS_NEW && 0 < f->len )
+        f->state = (p[0] == 5)? FS_SOCKS5_HELLO: FS_HTTP;
+    if ( f->state == FS_SOCKS5_HELLO ) {
+        if ( f->len < 2 || f->len < 2 + p[1] )
+            return 0;
+        reply[0] = 5;
+        reply[1] = (memchr( p+2, SOCKS5_AUTH_NOAUTH, p[1] ) != NULL)?
+            SOCKS5_AUTH_NOAUTH: SOCKS5_AUTH_REJECT;
+        if ( front_reply( f, reply, 2 ) < 0 )
+            return -1;
+        if ( reply[1] == SOCKS5_AUTH_REJECT ) {
+            error("client needs authentication.\n");
+            return -1;
         }
-    } else if ( st.st_mode & _S_IFREG ) {
-        /* in case of regular file (redirected) */
-        len = 1;                        /* always data ready */
-    } else if ( _kbhit() ) {
-        /* in case of console */
-        len = 1;
+        front_consume( f, 2 + p[1] );
+        f->state = FS_SOCKS5_REQUEST;
     }
-    return len;
+    if ( f->state == FS_SOCKS5_REQUEST ) {
+        if ( f->len < 5 )
+            return 0;
+        if ( p[3] == SOCKS5_ATYP_IPv4 )
+            need = 4 + 4 + 2;
+        else if ( p[3] == SOCKS5_ATYP_FQDN )
+            need = 4 + 1 + p[4] + 2;
+        else {
+            error("address type %d of client is not supported.\n", p[3]);
+            front_socks5_reply( f, SOCKS5_REP_ANOTSUP );
+            return -1;
+        }
+        if ( f->len < need )
+            return 0;
+        if ( p[1] != SOCKS5_CMD_CONNECT ) {
+            error("command %d of client is not supported.\n", p[1]);
+            front_socks5_reply( f, SOCKS5_REP_CNOTSUP );
+            return -1;
+        }
+        if ( p[3] == SOCKS5_ATYP_IPv4 )
+            snprintf( host, size, "%d.%d.%d.%d", p[4], p[5], p[6], p[7] );
+        else
+            snprintf( host, size, "%.*s", p[4], (char *)p + 5 );
+        *port = (p[need-2] << 8) | p[need-1];
+        front_consume( f, need );
+        return 1;
+    }
+
+    /* HTTP */
+    f->buf[f->len] = '\0';
+    if ( (sep = strstr( (char *)f->buf, "\r\n\r\n" )) == NULL ) {
+        if ( f->len < FRONT_BUFSIZ )
+            return 0;
+        error("too long request header from client.\n");
+        return -1;
+    }
+    need = sep + 4 - (char *)f->buf;
+    if ( sscanf( (char *)f->buf, "%15s %255s", method, target ) != 2 ||
+         strcmp( method, "CONNECT" ) != 0 ||
+         (sep = strrchr( target, ':' )) == NULL ) {
+        error("unsupported request from client: %.*s\n",
+              (int)strcspn( (char *)f->buf, "\r\n" ), (char *)f->buf);
+        front_reply( f, http_405, strlen( http_405 ) );
+        return -1;
+    }
+    *sep++ = '\0';
+    snprintf( host, size, "%s", target );
+    *port = resolve_port( sep );
+    front_consume( f, need );
+    return 1;
 }
-#endif /* _WIN32 */
 
-/* relay byte from stdin to socket and fro socket to stdout.
-   returns reason of termination */
+/* read request of client F as far as possible.  Returns 1 if
+   destination is decided into HOST and *PORT, 0 if not yet or -1 on
+   error or close. */
 int
-do_repeater( SOCKET local_in, SOCKET local_out, SOCKET remote )
+front_read( FRONT *f, EVLOOP *ev, char *host, int size, u_short *port )
 {
-    /** vars for local input data **/
-    char lbuf[1024];                            /* local input buffer */
-    int lbuf_len;                               /* available data in lbuf */
-    int f_local;                                /* read local input more? */
-    /** vars for remote input data **/
-    char rbuf[1024];                            /* remote input buffer */
-    int rbuf_len;                               /* available data in rbuf */
-    int f_remote;                               /* read remote input more? */
-    int close_reason = REASON_UNK;              /* reason of end repeating */
-    /** other variables **/
-    int nfds, len;
-    fd_set ifds, ofds;
-    struct timeval *tmo;
-#ifdef _WIN32
-    struct timeval win32_tmo;
-#endif /* _WIN32 */
+    int len, ret;
 
-    /* repeater between stdin/out and socket  */
-    nfds = ((local_in<remote)? remote: local_in) +1;
-    f_local = 1;                                /* yes, read from local */
-    f_remote = 1;                               /* yes, read from remote */
-    lbuf_len = 0;
-    rbuf_len = 0;
-
-    while ( f_local || f_remote ) {
-        FD_ZERO(&ifds );
-        FD_ZERO(&ofds );
-        tmo = NULL;
-
-        /** prepare for reading local input **/
-        if ( f_local && (lbuf_len < (int)sizeof(lbuf)) ) {
-#ifdef _WIN32
-            if ( local_type != LOCAL_SOCKET ) {
-                /* select() on Winsock is not accept standard handle.
-                   So use select() with short timeout and checking data
-                   in stdin by another method. */
-                win32_tmo.tv_sec = 0;
-                win32_tmo.tv_usec = 10*1000;    /* 10 ms */
-                tmo = &win32_tmo;
-            } else
-#endif /* !_WIN32 */
-            FD_SET( local_in, &ifds );
+    while ( 1 ) {
+        if ( (ret = front_parse( f, host, size, port )) != 0 )
+            return ret;
+        len = recv( f->s, f->buf + f->len, FRONT_BUFSIZ - f->len, 0 );
+        if ( len == SOCKET_ERROR && socket_wouldblock() ) {
+            evloop_clear( ev, &f->item, EV_READ );
+            return 0;
         }
-
-        /** prepare for reading remote input **/
-        if ( f_remote && (rbuf_len < (int)sizeof(rbuf)) ) {
-            FD_SET( remote, &ifds );
+        if ( len <= 0 ) {
+            debug("client closed before request.\n");
+            return -1;
         }
+        f->len += len;
+    }
+}
+
+/* start session of client LOCAL_IN and LOCAL_OUT with REMOTE in EV.
+   Returns new session, or NULL with them closed. */
+SESSION *
+daemon_session (EVLOOP *ev, SOCKET local_in, SOCKET local_out, SOCKET remote)
+{
+    SESSION *ss = xmalloc (sizeof(SESSION));
+
+    if (session_start (ss, ev, local_in, local_out, remote) < 0) {
+        closesocket (local_in);
+        if (local_out != local_in)
+            closesocket (local_out);
+        closesocket (remote);
+        free (ss);
+        return NULL;
+    }
+    if (f_shaping)
+        ss->allow[SHAPE_UP] = ss->allow[SHAPE_DOWN] = 0;
+    return ss;
+}
 
-        /* FD_SET( local_out, ofds ); */
-        /* FD_SET( remote, ofds ); */
+/* reply to front-end client F whether connection REMOTE is made, and
+   start its session.  Returns new session, or NULL with the client
+   closed. */
+SESSION *
+front_connect( FRONT *f, EVLOOP *ev, SOCKET remote )
+{
+    static const char *http_200 =
+        "HTTP/1.1 200 Connection established\r\n\r\n";
+    static const char *http_502 =
+        "HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n";
+    SESSION *ss;
+    char *ptr;
+    int len, ret;
 
-        if ( select( nfds, &ifds, &ofds, (fd_set*)NULL, tmo ) == -1 ) {
-            /* some error */
-            error( "select() failed, %d\n", socket_errno());
-            return REASON_ERROR;
+    if ( remote == SOCKET_ERROR ) {
+        if ( f->state == FS_HTTP )
+            front_reply( f, http_502, strlen( http_502 ) );
+        else
+            front_socks5_reply( f, SOCKS5_REP_HUNREACH );
+        closesocket( f->s );
+        return NULL;
+    }
+    if ( f->state == FS_HTTP )
+        ret = front_reply( f, http_200, strlen( http_200 ) );
+    else
+        ret = front_socks5_reply( f, SOCKS5_REP_SUCCEEDED );
+    if ( ret < 0 ) {
+        closesocket( f->s );
+        closesocket( remote );
+        return NULL;
+    }
+    if ( (ss = daemon_session( ev, f->s, f->s, remote )) == NULL )
+        return NULL;
+    if ( 0 < f->len ) {                         /* sent with request */
+        ptr = ring_wptr( &ss->lbuf, &len );
+        if ( f->len < len )
+            len = f->len;
+        memcpy( ptr, f->buf, len );
+        ring_commit( &ss->lbuf, len );
+    }
+    return ss;
+}
+
+/* start session of the client of finished dial D in EV.  Returns new
+   session, or NULL with the client closed. */
+SESSION *
+daemon_dialed (EVLOOP *ev, DIAL *d)
+{
+    FRONT *f = d->front;
+    SOCKET local_in = d->local_in, local_out = d->local_out;
+    SOCKET remote = dial_finish (d, ev);
+    SESSION *ss;
+
+    if (f != NULL) {
+        ss = front_connect (f, ev, remote);
+        free (f);
+        return ss;
+    }
+    if (remote == SOCKET_ERROR) {
+        closesocket (local_in);
+        if (local_out != local_in)
+            closesocket (local_out);
+        return NULL;
+    }
+    return daemon_session (ev, local_in, local_out, remote);
+}
+
+/* serve many local clients in one process (option 'D').
+   Each accepted client gets its own connection to the destination
+   and all of them are negotiated and relayed in one event loop, so
+   a slow relay server doesn't stop other sessions.  With option 'U',
+   clients are launchers handing off their stdio. */
+void
+run_daemon (u_short port)
+{
+    EVLOOP ev;
+    EV_ITEM listener;
+    SESSION *sessions = NULL, *ss, **pss;
+    FRONT *fronts = NULL, *f, **pf;
+    DIAL *dials = NULL, *d, **pd;
+    SOCKET sock, local;
+    struct sockaddr client;
+    socklen_t socklen;
+    int i, wait = -1, method = relay_method;
+    int local_in, local_out;
+    char host[256];
+    u_short dport;
+    long now;
+
+    signal (SIGPIPE, SIG_IGN);                  /* get EPIPE instead */
+    if (resident_path != NULL)
+        sock = open_unix_socket (resident_path);
+    else
+        sock = open_listen_socket (port);
+    set_nonblock (sock, 1);
+    evloop_init (&ev);
+    memset (&listener, 0, sizeof(listener));
+    listener.fd = sock;
+    listener.events = EV_READ;
+    listener.data = NULL;
+    if (evloop_add (&ev, &listener) < 0)
+        fatal ("cannot watch listening socket.\n");
+    if (resident_path != NULL)
+        debug ("resident at %s (socket=%d)\n", resident_path, sock);
+    else
+        debug ("serving %sat local port %d (socket=%d)\n",
+               f_frontend? "as proxy ": "", port, sock);
+    pool_init ();
+    pool_fill (&ev);
+
+    while (1) {
+        wait = limit_min (wait, pool_wait (now_msec ()));
+        if (evloop_wait (&ev, wait) < 0)
+            fatal ("waiting events failed, %d\n", socket_errno());
+        if (f_metrics_dump) {
+            f_metrics_dump = 0;
+            for (ss = sessions; ss != NULL; ss = ss->next)
+                metrics_emit (&ss->m, ss->id, ss->remote, ss->close_reason, 1);
         }
-#ifdef _WIN32
-        /* fake ifds if local is stdio handle because
-           select() of Winsock does not accept stdio
-           handle. */
-        if (f_local && (local_type!=LOCAL_SOCKET) && (0<stdindatalen()))
-            FD_SET(0,&ifds);            /* data ready */
-#endif
 
-        /* remote => local */
-        if ( FD_ISSET(remote, &ifds) && (rbuf_len < (int)sizeof(rbuf)) ) {
-            len = recv( remote, rbuf + rbuf_len, sizeof(rbuf)-rbuf_len, 0);
-            if ( len == 0 || (len == -1 && socket_errno() == ECONNRESET)) {
-                debug("connection %s by peer\n",
-                      (len==0)? "closed": "reset");
-                close_reason = REASON_CLOSED_BY_REMOTE;
-                f_remote = 0;                   /* no more read from socket */
-                f_local = 0;
-            } else if ( len == -1 ) {
-                /* error */
-                fatal("recv() failed, %d\n", socket_errno());
+        /* relay sessions got ready, sending is done by shaper_run() */
+        for (i = 0; i < ev.n_fired; i++) {
+            ss = ev.fired[i]->data;
+            if (ss != NULL && !ss->f_done && !session_relay (ss, &ev))
+                ss->f_done = 1;
+        }
+        wait = -1;
+        if (f_shaping && shaper_run (sessions, &ev))
+            wait = SHAPER_TICK;                 /* wait for tokens */
+
+        /* accept new clients */
+        while (listener.ready & EV_READ) {
+            socklen = sizeof(client);
+            local = accept (sock, &client, &socklen);
+            if (local == SOCKET_ERROR) {
+                if (!socket_wouldblock())
+                    error ("accept() failed, errno=%d\n", socket_errno());
+                evloop_clear (&ev, &listener, EV_READ);
+                break;
+            }
+            debug ("accepted new client (socket=%d)\n", local);
+            if (resident_path != NULL) {
+                i = resident_receive (local, &local_in, &local_out);
+                closesocket (local);            /* launcher is gone */
+                if (i < 0)
+                    continue;
+            } else if (f_frontend) {
+                /* wait for request telling destination */
+                apply_tcp_tuning (local, &tcp_local);
+                set_nonblock (local, 1);
+                f = xmalloc (sizeof(FRONT));
+                memset (f, 0, sizeof(FRONT));
+                f->s = local;
+                f->item.fd = local;
+                f->item.events = EV_READ;
+                f->item.data = NULL;
+                f->deadline = now_msec () + 1000L * ((0 < connect_timeout)?
+                    connect_timeout: NEGO_TIMEOUT_DEFAULT);
+                if (evloop_add (&ev, &f->item) < 0) {
+                    closesocket (local);
+                    free (f);
+                    continue;
+                }
+                f->next = fronts;
+                fronts = f;
+                continue;
             } else {
-                debug("recv %d bytes\n", len);
-                if ( 1 < f_debug )              /* more verbose */
-                    report_bytes( "<<<", rbuf+rbuf_len, len);
-                rbuf_len += len;
+                apply_tcp_tuning (local, &tcp_local);
+                local_in = local_out = local;
             }
+            /* negotiation goes on in the loop */
+            d = dial_start (&ev, dest_host, dest_port, method);
+            d->local_in = local_in;
+            d->local_out = local_out;
+            d->next = dials;
+            dials = d;
         }
 
-        /* local => remote */
-        if ( FD_ISSET(local_in, &ifds) && (lbuf_len < (int)sizeof(lbuf)) ) {
-            if (local_type == LOCAL_SOCKET)
-                len = recv(local_in, lbuf + lbuf_len,
-                           sizeof(lbuf)-lbuf_len, 0);
-            else
-                len = read(local_in, lbuf + lbuf_len, sizeof(lbuf)-lbuf_len);
-            if ( len == 0 ) {
-                /* stdin is EOF */
-                debug("local input is EOF\n");
-                if (!f_hold_session)
-                    shutdown(remote, 1);        /* no-more writing */
-                f_local = 0;
-                close_reason = REASON_CLOSED_BY_LOCAL;
-            } else if ( len == -1 ) {
-                /* error on reading from stdin */
-                if (f_hold_session) {
-                    debug ("failed to read from local\n");
-                    f_local = 0;
-                    close_reason = REASON_CLOSED_BY_LOCAL;
-                } else
-                    fatal("recv() failed, errno = %d\n", errno);
+        /* front-end clients telling destination */
+        now = now_msec ();
+        pf = &fronts;
+        while ((f = *pf) != NULL) {
+            i = 0;
+            if (f->item.ready & EV_READ)
+                i = front_read (f, &ev, host, sizeof(host), &dport);
+            if (i == 0 && now < f->deadline) {
+                wait = limit_min (wait, f->deadline - now);
+                pf = &f->next;
+                continue;
+            }
+            *pf = f->next;
+            evloop_del (&ev, &f->item);
+            if (i == 0) {
+                debug ("client sent no request in time.\n");
+                closesocket (f->s);
+            } else if (i < 0) {
+                closesocket (f->s);
+            } else if (dport == 0) {
+                front_connect (f, &ev, SOCKET_ERROR);   /* refused */
+                free (f);
             } else {
-                /* repeat */
-                lbuf_len += len;
+                debug ("client asks for %s:%d\n", host, dport);
+                d = dial_start (&ev, host, dport, method);
+                d->front = f;
+                d->next = dials;
+                dials = d;
             }
         }
 
-        /* flush data in buffer to socket */
-        if ( 0 < lbuf_len ) {
-            len = send(remote, lbuf, lbuf_len, 0);
-            if ( len == -1 ) {
-                fatal("send() failed, %d\n", socket_errno());
-            } else if ( 0 < len ) {
-                if ( 1 < f_debug )              /* more verbose */
-                    report_bytes( ">>>", lbuf, len);
-                /* move data on to top of buffer */
-                debug("sent %d bytes\n", len);
-                lbuf_len -= len;
-                if ( 0 < lbuf_len )
-                    memcpy( lbuf, lbuf+len, lbuf_len );
-                assert( 0 <= lbuf_len );
+        /* connections being made */
+        pd = &dials;
+        while ((d = *pd) != NULL) {
+            dial_step (d, &ev);
+            if (d->state == DS_PENDING) {
+                wait = limit_min (wait, dial_wait (d, now));
+                pd = &d->next;
+                continue;
+            }
+            *pd = d->next;
+            if ((ss = daemon_dialed (&ev, d)) != NULL) {
+                ss->next = sessions;
+                sessions = ss;
             }
         }
 
-        /* flush data in buffer to local output */
-        if ( 0 < rbuf_len ) {
-            if (local_type == LOCAL_SOCKET)
-                len = send( local_out, rbuf, rbuf_len, 0);
-            else
-                len = write( local_out, rbuf, rbuf_len);
-            if ( len == -1 ) {
-                fatal("output (local) failed, errno=%d\n", errno);
+        /* prepare connections for next clients */
+        pool_fill (&ev);
+
+        /* sweep finished sessions */
+        pss = &sessions;
+        while ((ss = *pss) != NULL) {
+            if (!ss->f_done) {
+                pss = &ss->next;
+                continue;
             }
-            rbuf_len -= len;
-            if ( len < rbuf_len )
-                memcpy( rbuf, rbuf+len, rbuf_len );
-            assert( 0 <= rbuf_len );
-        }
-        if (f_local == 0 && f_hold_session) {
-            debug ("closing local port without disconnecting from remote\n");
-            f_remote = 0;
-            shutdown (local_out, 2);
-            close (local_out);
-            break;
+            *pss = ss->next;
+            session_finish (ss, &ev);
+            closesocket (ss->remote);
+            closesocket (ss->local_in);
+            if (ss->local_out != ss->local_in)
+                closesocket (ss->local_out);
+            free (ss);
         }
     }
-
-    return close_reason;
 }
 
-int
-accept_connection (u_short port)
-{
-    static int sock = -1;
-    int connection;
-    struct sockaddr_in name;
-    struct sockaddr client;
-    int socklen;
-    fd_set ifds;
-    int nfds;
-    int sockopt;
-
-    /* Create the socket. */
-    debug("Creating source port to forward.\n");
-    sock = socket (PF_INET, SOCK_STREAM, 0);
-    if (sock < 0)
-        fatal("socket() failed, errno=%d\n", socket_errno());
-    sockopt = 1;
-    setsockopt (sock, SOL_SOCKET, SO_REUSEADDR,
-                (void*)&sockopt, sizeof(sockopt));
-
-    /* Give the socket a name. */
-    name.sin_family = AF_INET;
-    name.sin_port = htons (port);
-    name.sin_addr.s_addr = htonl (INADDR_ANY);
-    if (bind (sock, (struct sockaddr *) &name, sizeof (name)) < 0)
-        fatal ("bind() failed, errno=%d\n", socket_errno());
+#if !defined(MAP_ANONYMOUS) && defined(MAP_ANON)
+#define MAP_ANONYMOUS MAP_ANON
+#endif
 
-    if (listen( sock, 1) < 0)
-        fatal ("listen() failed, errno=%d\n", socket_errno());
+/* serve one request on C with ENTRIES kept for TTL seconds */
+void
+agent_serve( SOCKET c, AGENT_MEMORY *mem, int ttl )
+{
+    AGENT_ENTRY *entries = mem->entries;
+    char *line = mem->line, *key, *pass;
+    AGENT_ENTRY *e, *slot = NULL;
+    time_t now = time( NULL );
+    int i, n, len = 0;
+    struct timeval tv;
+
+    tv.tv_sec = AGENT_TIMEOUT;                  /* never stuck by client */
+    tv.tv_usec = 0;
+    setsockopt( c, SOL_SOCKET, SO_RCVTIMEO, (void *)&tv, sizeof(tv) );
+    while ( len < (int)sizeof(mem->line) - 1 &&
+            (n = recv( c, line + len, sizeof(mem->line) - 1 - len, 0 )) > 0 ) {
+        len += n;
+        if ( memchr( line, '\n', len ) != NULL )
+            break;
+    }
+    line[len] = '\0';
+    line[strcspn( line, "\r\n" )] = '\0';
 
-    /* wait for new connection with watching EOF of stdin. */
-    debug ("waiting new connection at port %d (socket=%d)\n", port, sock);
-    nfds = sock + 1;
-    do {
-        int n;
-        struct timeval *ptmo = NULL;
-#ifdef _WIN32
-        struct timeval tmo;
-        tmo.tv_sec = 0;
-        tmo.tv_usec = 100*1000;                 /* On Windows, 100ms timeout */
-        ptmo = &tmo;
-#endif /* _WIN32 */
-        FD_ZERO (&ifds);
-        FD_SET ((SOCKET)sock, &ifds);
-#ifndef _WIN32
-        FD_SET (0, &ifds);                      /* watch stdin */
-#endif
-        n = select (nfds, &ifds, NULL, NULL, ptmo);
-        if (n == -1) {
-            fatal ("select() failed, %d\n", socket_errno());
-            exit (1);
+    for ( i = 0; i < AGENT_MAX_ENTRIES; i++ ) { /* forget expired */
+        if ( entries[i].expire != 0 && entries[i].expire <= now )
+            memset( &entries[i], 0, sizeof(AGENT_ENTRY) );
+    }
+    key = line + 4;
+    pass = NULL;
+    if ( len < 4 || line[3] != ' ' ) {
+        send( c, "NO\n", 3, 0 );
+        goto done;
+    }
+    if ( strncmp( line, "PUT", 3 ) == 0 ) {
+        if ( (pass = strchr( key, ' ' )) == NULL ) {
+            send( c, "NO\n", 3, 0 );
+            goto done;
         }
-#ifdef _WIN32
-        if (0 < stdindatalen()) {
-            FD_SET (0, &ifds);          /* fake */
-            n++;
+        *pass++ = '\0';
+    }
+    if ( sizeof(entries->key) <= strlen( key ) ||
+         (pass != NULL && sizeof(entries->pass) <= strlen( pass )) ) {
+        debug("credential agent: too long request\n");
+        send( c, "NO\n", 3, 0 );                /* not to mix up keys */
+        goto done;
+    }
+    for ( i = 0, e = NULL; i < AGENT_MAX_ENTRIES; i++ ) {
+        if ( entries[i].expire == 0 ) {
+            if ( slot == NULL )
+                slot = &entries[i];
+        } else if ( strcmp( entries[i].key, key ) == 0 ) {
+            e = &entries[i];
         }
-#endif
-        if (0 < n) {
-            if (FD_ISSET(0, &ifds) && (getchar() <= 0)) {
-                /* EOF */
-                debug ("Give-up waiting port because stdin is closed.");
-                exit(0);
-            }
-            if (FD_ISSET(sock, &ifds))
-                break;                          /* socket is stimulated */
+    }
+    if ( strncmp( line, "GET", 3 ) == 0 ) {
+        if ( e == NULL ) {
+            send( c, "NO\n", 3, 0 );
+        } else {
+            snprintf( line, sizeof(mem->line), "OK %s\n", e->pass );
+            send( c, line, strlen( line ), 0 );
         }
-    } while (1);
-    socklen = sizeof(client);
-    connection = accept( sock, &client, &socklen);
-    if ( connection < 0 )
-        fatal ("accept() failed, errno=%d\n", socket_errno());
-    return connection;
+    } else if ( strncmp( line, "PUT", 3 ) == 0 ) {
+        if ( e == NULL )
+            e = (slot != NULL)? slot: &entries[0];  /* full, drop one */
+        memset( e, 0, sizeof(AGENT_ENTRY) );
+        strcpy( e->key, key );
+        strcpy( e->pass, pass );
+        e->expire = now + ttl;
+        debug("credential agent: keeping password of %s\n", key);
+        send( c, "OK\n", 3, 0 );
+    } else if ( strncmp( line, "DEL", 3 ) == 0 ) {
+        if ( e != NULL ) {
+            memset( e, 0, sizeof(AGENT_ENTRY) );
+            debug("credential agent: forgot password of %s\n", key);
+        }
+        send( c, "OK\n", 3, 0 );
+    } else {
+        send( c, "NO\n", 3, 0 );
+    }
+done:
+    memset( line, 0, sizeof(mem->line) );
 }
 
-
+/* run as credential agent at PATH (option 'A'), never returns */
+void
+run_agent( const char *path )
+{
+    AGENT_MEMORY *mem;
+    size_t size = sizeof(AGENT_MEMORY);
+    char *param;
+    SOCKET sock, c;
+    int ttl = AGENT_TTL_DEFAULT;
+
+    if ( (param = getparam( ENV_CONNECT_AGENT_TTL )) != NULL )
+        ttl = atoi( param );
+    if ( ttl <= 0 )
+        fatal("invalid %s: %s\n", ENV_CONNECT_AGENT_TTL, param);
+    mem = mmap( NULL, size, PROT_READ|PROT_WRITE,
+                MAP_PRIVATE|MAP_ANONYMOUS, -1, 0 );
+    if ( mem == MAP_FAILED )
+        fatal("cannot allocate memory for passwords, errno=%d\n", errno);
+    /* never keep passwords where they can be swapped out */
+    if ( mlock( mem, size ) < 0 )
+        fatal("cannot lock memory for passwords, errno=%d "
+              "(check ulimit -l)\n", errno);
+#ifdef MADV_DONTDUMP
+    madvise( (void *)mem, size, MADV_DONTDUMP );
+#endif /* MADV_DONTDUMP */
+    signal( SIGPIPE, SIG_IGN );
+    sock = open_unix_socket( path );
+    debug("credential agent at %s, ttl=%d\n", path, ttl);
+    while ( 1 ) {
+        if ( (c = accept( sock, NULL, NULL )) < 0 )
+            continue;
+        if ( unix_peer_ok( c ) )
+            agent_serve( c, mem, ttl );
+        close( c );
+    }
+}
+#endif /* !_WIN32 */
 
 /** Main of program **/
 int
 main( int argc, char **argv )
 {
-    int ret;
     int remote;                                 /* socket */
     int local_in;                               /* Local input */
     int local_out;                              /* Local output */
@@ -2860,13 +9190,31 @@ main( int argc, char **argv )
     WSAStartup( 0x101, &wsadata);
 #endif /* _WIN32 */
 
+#ifndef _WIN32
+    /* launcher, nothing else is needed */
+    if ( resident_handoff( argc, argv ) == 0 )
+        return 0;
+#endif /* not _WIN32 */
+
     /* initialization */
     make_revstr();
     getarg( argc, argv );
     debug("Program is $Revision: 100 $\n");
+#ifndef _WIN32
+    if ( agent_path != NULL )
+        run_agent( agent_path );                /* never returns */
+    signal( SIGUSR1, sig_metrics );             /* dump session metrics */
+    if ( f_hold_session )
+        signal( SIGPIPE, SIG_IGN );             /* client may go any time */
+#endif /* not _WIN32 */
+    if ( getparam( ENV_CONNECT_TRACE_CAPTURE ) != NULL )
+        trace_capture_init( atoi( getparam( ENV_CONNECT_TRACE_CAPTURE ) ) );
+    shaper_init();
 
     /* Open local_in and local_out if forwarding a port */
-    if ( local_type == LOCAL_SOCKET ) {
+    if ( f_daemon ) {
+        local_in = local_out = -1;              /* per client */
+    } else if ( local_type == LOCAL_SOCKET ) {
         /* Relay between local port and destination */
         local_in = local_out = accept_connection( local_port );
     } else {
@@ -2879,75 +9227,24 @@ main( int argc, char **argv )
 #endif
     }
 
-retry:
 #ifndef _WIN32
-    if (0 < connect_timeout)
-        set_timeout (connect_timeout);
-#endif /* not _WIN32 */
-
-    if (check_direct(dest_host))
-        relay_method = METHOD_DIRECT;
-    /* make connection */
-    if ( relay_method == METHOD_DIRECT ) {
-        remote = open_connection (dest_host, dest_port);
-        if ( remote == SOCKET_ERROR )
-            fatal( "Unable to connect to destination host, errno=%d\n",
-                   socket_errno());
-    } else {
-        remote = open_connection (relay_host, relay_port);
-        if ( remote == SOCKET_ERROR )
-            fatal( "Unable to connect to relay host, errno=%d\n",
-                   socket_errno());
-    }
-
-    /** resolve destination host (SOCKS) **/
-#if !defined(_WIN32) && !defined(__CYGWIN32__)
-    if (socks_ns.sin_addr.s_addr != 0)
-        switch_ns (&socks_ns);
-#endif /* not _WIN32 && not __CYGWIN32__ */
-    if (relay_method == METHOD_SOCKS &&
-        socks_resolve == RESOLVE_LOCAL &&
-        local_resolve (dest_host, &dest_addr) < 0) {
-        fatal("Unknown host: %s", dest_host);
+    if ( f_daemon ) {
+        /* never returns */
+        run_daemon( local_port );
     }
-
-    /** relay negociation **/
-    switch ( relay_method ) {
-    case METHOD_SOCKS:
-        if ( ((socks_version == 5) && (begin_socks5_relay(remote) < 0)) ||
-             ((socks_version == 4) && (begin_socks4_relay(remote) < 0)) )
-            fatal( "failed to begin relaying via SOCKS.\n");
-        break;
-
-    case METHOD_HTTP:
-        ret = begin_http_relay(remote);
-        switch (ret) {
-        case START_ERROR:
-            close (remote);
-            fatal("failed to begin relaying via HTTP.\n");
-        case START_OK:
-            break;
-        case START_RETRY:
-            /* retry with authentication */
-            close (remote);
-            goto retry;
-        }
-        break;
-    case METHOD_TELNET:
-        if (begin_telnet_relay(remote) < 0)
-             fatal("failed to begin relaying via telnet.\n");
-        break;
-    }
-    debug("connected\n");
-
-#ifndef _WIN32
-    if (0 < connect_timeout)
-        set_timeout (0);
 #endif /* not _WIN32 */
 
+    remote = make_connection();
+    if ( remote == SOCKET_ERROR )
+        exit(EXIT_FAILURE);
+
     /* main loop */
     debug ("start relaying.\n");
 do_repeater:
+#ifdef WITH_SPLICE
+    reason = do_splice_repeater(local_in, local_out, remote);
+    if (reason == REASON_UNSUPPORTED)
+#endif /* WITH_SPLICE */
     reason = do_repeater(local_in, local_out, remote);
     debug ("relaying done.\n");
     if (local_type == LOCAL_SOCKET &&
@@ -2955,7 +9252,7 @@ do_repeater:
         f_hold_session) {
         /* re-wait at local port without closing remote session */
         debug ("re-waiting at local port %d\n", local_port);
-        local_in = local_out = accept_connection( local_port );
+        local_in = local_out = hold_session( remote, local_port );
         debug ("re-start relaying\n");
         goto do_repeater;
     }
@@ -2967,7 +9264,7 @@ do_repeater:
 #endif /* _WIN32 */
     debug ("that's all, bye.\n");
 
-    return 0;
+    return (reason == REASON_ERROR)? EXIT_FAILURE: 0;
 }
 
 /* ------------------------------------------------------------